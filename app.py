@@ -1,14 +1,11 @@
 import streamlit as st
-import pandas as pd
-import io
 import os
 import logging
 import sys
-import re
-from extract_invoices import extract_invoice_data, classify_content
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils import get_column_letter
+import time
+from jobs import JobQueue, QUEUED, RUNNING, FAILED, REPORT_FILE
+from result_store import ResultCache
+from xml_invoice import is_invoice_xml, pair_invoice_sources
 
 # Configure logging to stdout
 logging.basicConfig(
@@ -18,9 +15,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Configure page
-st.set_page_config(page_title="Invoice Extractor", page_icon="🧾", layout="wide")
-
 # Category options for dropdown
 CATEGORY_OPTIONS = [
     "Tự động nhận diện",  # Auto-detect based on invoice content
@@ -33,425 +27,193 @@ CATEGORY_OPTIONS = [
     "Khác (Nhập tay)"
 ]
 
-# Initialize Session State
-if "processing_complete" not in st.session_state:
-    st.session_state["processing_complete"] = False
-if "processed_df" not in st.session_state:
-    st.session_state["processed_df"] = None
-if "report_type" not in st.session_state:
-    st.session_state["report_type"] = "Kế toán"
-
-# --- Main Application Logic (no login required) ---
-
-# Sidebar
-with st.sidebar:
-    st.markdown("**Invoice Extractor**")
-    st.markdown("---")
-    st.caption("Phan tich va trich xuat du lieu tu hoa don PDF")
-
-# App Title
-st.title("Invoice Extraction Tool")
-
-# --- WIZARD FLOW ---
-
-if st.session_state["processing_complete"] and st.session_state["processed_df"] is not None:
-    # === STEP 4: RESULTS & EXPORT ===
-    st.markdown("### ✅ Kết quả xử lý")
-    
-    col_res1, col_res2 = st.columns([1, 4])
-    with col_res1:
+@st.cache_resource
+def get_result_cache():
+    """One result cache shared by all sessions of this server process."""
+    return ResultCache()
+
+@st.cache_resource
+def get_job_queue():
+    """One job queue (and its worker threads) shared by all sessions of this server process."""
+    return JobQueue(cache=get_result_cache())
+
+def open_job(job_id):
+    st.session_state["job_id"] = job_id
+    if job_id:
+        st.query_params["job"] = job_id
+    else:
+        st.query_params.clear()
+
+
+def main():
+    # Configure page
+    st.set_page_config(page_title="Invoice Extractor", page_icon="🧾", layout="wide")
+
+    job_queue = get_job_queue()
+
+    # Initialize Session State (a job ID in the URL reopens that job after a refresh)
+    if "job_id" not in st.session_state:
+        st.session_state["job_id"] = st.query_params.get("job")
+
+    # --- Main Application Logic (no login required) ---
+
+    # Sidebar
+    with st.sidebar:
+        st.markdown("**Invoice Extractor**")
+        st.markdown("---")
+        st.caption("Phan tich va trich xuat du lieu tu hoa don PDF")
+        st.markdown("---")
+        # Reattach to a job started earlier (e.g. after closing the tab)
+        reopen_id = st.text_input("Mã công việc", placeholder="Dán mã để mở lại kết quả")
+        if st.button("🔎 Mở lại") and reopen_id.strip():
+            open_job(reopen_id.strip())
+            st.rerun()
+
+    # App Title
+    st.title("Invoice Extraction Tool")
+
+    # --- WIZARD FLOW ---
+
+    job_id = st.session_state["job_id"]
+    job = job_queue.get(job_id) if job_id else None
+
+    if job_id and job is None:
+        st.error(f"Không tìm thấy công việc `{job_id}` (mã sai hoặc đã quá hạn lưu trữ).")
         if st.button("⬅️ Làm việc với file khác"):
-            st.session_state["processing_complete"] = False
-            st.session_state["processed_df"] = None
+            open_job(None)
             st.rerun()
-    
-    df = st.session_state["processed_df"]
-    
-    # Excel Export with Merge Logic
-    output = io.BytesIO()
-    report_type = st.session_state.get("report_type", "Kế toán")
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name="Hóa đơn")
-        worksheet = writer.sheets["Hóa đơn"]
-        
-        # Styles
-        header_font = Font(bold=True, color="FFFFFF", size=11, name="Arial")
-        header_fill = PatternFill("solid", fgColor="4F81BD")
-        border_style = Side(style='thin', color="000000")
-        border = Border(left=border_style, right=border_style, top=border_style, bottom=border_style)
-        
-        # Format Header
-        for cell in worksheet[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-            cell.border = border
-            
-        worksheet.freeze_panes = 'A2'
-        worksheet.auto_filter.ref = worksheet.dimensions
-
-        if report_type == "Kinh doanh":
-            # === BUSINESS FORMAT ===
-            # Column widths for Business format (based on hoadon_tonghop.xlsx structure)
-            # A:Team, B:NV, C:File, D:Ngay, E:So...
-            widths = {'A': 15, 'B': 20, 'C': 30, 'D': 12, 'E': 10, 'F': 25, 'G': 15, 
-                      'H': 15, 'I': 12, 'J': 12, 'K': 12, 'L': 12, 'M': 10, 'N': 15, 
-                      'O': 15, 'P': 30, 'Q': 15, 'R': 15, 'S': 20, 'T': 10}
-            
-            for i, (col_letter, width) in enumerate(widths.items()):
-                 if i < worksheet.max_column:
-                    worksheet.column_dimensions[get_column_letter(i+1)].width = width
-
-            money_cols = ["Số tiền trước Thuế", "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác", "Tiền thuế", "Số tiền sau"]
-            money_col_indices = [df.columns.get_loc(c) + 1 for c in money_cols if c in df.columns]
-
-            for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-                for cell in row:
-                    cell.border = border
-                    cell.font = Font(name="Arial", size=10)
-                    if cell.col_idx in money_col_indices:
-                        cell.number_format = '#,##0'
-                    
-                    cell.alignment = Alignment(vertical="center", wrap_text=True)
-                    
+
+    elif job and job["status"] in (QUEUED, RUNNING):
+        # === PROCESSING: poll the job until it finishes ===
+        st.markdown("### ⚙️ Đang xử lý dữ liệu")
+        st.info(f"Mã công việc: `{job_id}` - có thể đóng trang và mở lại kết quả bằng mã này.")
+        if job["status"] == QUEUED:
+            st.write(f"⏳ Đang chờ trong hàng đợi ({job['queue_position']} công việc phía trước)...")
         else:
-            # === ACCOUNTING FORMAT (Existing) ===
-            # Column widths
-            widths = {'A': 15, 'B': 15, 'C': 12, 'D': 15, 'E': 15, 'F': 20, 'G': 30, 'H': 18, 
-                      'I': 15, 'J': 12, 'K': 10, 'L': 15, 'M': 18, 'N': 35}
-            for col_letter, width in widths.items():
-                worksheet.column_dimensions[col_letter].width = width
-
-            # Format Data
-            # New Columns: 
-            # A:Team, B:SoHD, C:Ngay, D:MST, E:KyHieu, F:MaTraCuu, G:Link, H:PhanLoai
-            # I:TruocVAT, J:VAT, K:ThueSuat, L:SauThue, M:NV, N:File
-            money_cols_idx = [9, 10, 12]  # I, J, L
-            center_cols_idx = [1, 2, 3, 4, 5, 11]  # A-E, K
-            
-            for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-                for cell in row:
-                    if isinstance(cell, openpyxl.cell.cell.MergedCell): continue
-                    cell.border = border
-                    cell.font = Font(name="Arial", size=10)
-                    if cell.col_idx in money_cols_idx:
-                        cell.number_format = '#,##0'
-                        cell.alignment = Alignment(horizontal="right", vertical="center")
-                    elif cell.col_idx in center_cols_idx:
-                        cell.alignment = Alignment(horizontal="center", vertical="center")
-                    else:
-                        cell.alignment = Alignment(vertical="center", wrap_text=True)
-            
-            # Merge cells for multi-tax-rate invoices
-            # Columns to merge by filename: I(Trước VAT), J(VAT), L(Sau thuế)
-            # Team column (A) ALWAYS merged by Team value
-            merge_by_file_cols = [9, 10, 12]  # I, J, L
-            
-            # First: Merge Team column by Team value (column A = 1)
-            if len(df) > 0:
-                start_row = 2
-                current_team = worksheet.cell(row=2, column=1).value
-                
-                for excel_row in range(3, worksheet.max_row + 2):
-                    if excel_row > worksheet.max_row:
-                        cell_value = None
-                    else:
-                        cell_value = worksheet.cell(row=excel_row, column=1).value
-                    
-                    if cell_value != current_team:
-                        end_row = excel_row - 1
-                        if end_row > start_row:
-                            worksheet.merge_cells(f"A{start_row}:A{end_row}")
-                            top_cell = worksheet.cell(row=start_row, column=1)
-                            top_cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-                        
-                        start_row = excel_row
-                        current_team = cell_value
-        
-        # NOTE: Money columns (H, I, K) are NO LONGER merged
-        # Each row shows its own tax rate and amount for clarity
-
-    output.seek(0)
-    
-    st.download_button(
-        label="💾 Tải file Excel kết quả",
-        data=output,
-        file_name="hoadon_tonghop.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        type="primary",
-        use_container_width=True
-    )
-
-    st.divider()
-    st.dataframe(df, use_container_width=True)
-
-else:
-    # === STEP 1: REQUIRED INPUTS ===
-    st.markdown("### 📝 Bước 1: Thông tin bắt buộc")
-    
-    col1, col2 = st.columns(2)
-    with col1:
-        team_input = st.text_input("Team *", placeholder="Ví dụ: Team A, Team B...")
-    with col2:
-        employee_input = st.text_input("Tên nhân viên *", placeholder="Ví dụ: Nguyễn Văn A...")
-    
-    # === STEP 2: OPTIONAL CLASSIFICATION ===
-    st.markdown("### 🏷️ Bước 2: Phân loại (Tùy chọn)")
-    
-    col_cat1, col_cat2 = st.columns(2)
-    with col_cat1:
-        category_select = st.selectbox("Chọn phân loại:", CATEGORY_OPTIONS)
-    with col_cat2:
-        custom_category = ""
-        if category_select == "Khác (Nhập tay)":
-            custom_category = st.text_input("Nhập phân loại tùy chỉnh:")
-
-    # Report Type Selection
-    report_type = st.radio("Chọn loại báo cáo đầu ra:", ["Kế toán", "Kinh doanh"], horizontal=True)
-
-    
-    st.divider()
-    
-    # === STEP 3: FILE UPLOAD ===
-    st.markdown("### 📂 Bước 3: Tải hóa đơn (PDF)")
-    
-    # Check if required inputs are filled
-    can_upload = bool(team_input.strip()) and bool(employee_input.strip())
-    
-    if not can_upload:
-        st.warning("⚠️ Vui lòng nhập **Team** và **Tên nhân viên** trước khi tải file!")
-    
-    uploaded_files = st.file_uploader(
-        "Kéo thả hoặc chọn nhiều file PDF vào đây", 
-        type="pdf", 
-        accept_multiple_files=True,
-        disabled=not can_upload
-    )
-
-    if uploaded_files:
-        st.divider()
-        st.markdown("### ⚙️ Bước 4: Xử lý dữ liệu")
-        st.write(f"Đã chọn **{len(uploaded_files)}** file.")
-        
-        if st.button("🚀 Bắt đầu trích xuất dữ liệu", type="primary"):
-            logger.info(f"--- ACTION: Team={team_input}, Employee={employee_input} started processing {len(uploaded_files)} files ---")
-            
-            progress_bar = st.progress(0)
-            status_box = st.empty()
-            
-            all_rows = []
-            
-            for i, uploaded_file in enumerate(uploaded_files):
-                status_box.info(f"⏳ Đang xử lý: **{uploaded_file.name}** ({i+1}/{len(uploaded_files)})")
-                progress_bar.progress((i + 1) / len(uploaded_files))
-                
-                try:
-                    data, line_items = extract_invoice_data(uploaded_file, filename=uploaded_file.name)
-                    uploaded_file.seek(0)
-                    
-                    # Determine classification
-                    if category_select == "Khác (Nhập tay)" and custom_category.strip():
-                        final_category = custom_category.strip()
-                    elif category_select == "Tự động nhận diện":
-                        # First check if OCR already set a classification
-                        if data.get("Phân loại") and data.get("Phân loại") != "Khác":
-                            final_category = data.get("Phân loại")
-                        elif line_items:
-                            all_item_names = " ".join([item.get("name", "") for item in line_items])
-                            final_category = classify_content(all_item_names, data.get("Đơn vị bán", ""))
-                        else:
-                            final_category = classify_content("", data.get("Đơn vị bán", ""))
-                    else:
-                        final_category = category_select
-                    
-                    # Determine tax rate(s)
-                    tax_rates = []
-                    for rate in ["0%", "5%", "8%", "10%"]:
-                        col_name = f"Thuế {rate}"
-                        if data.get(col_name) and data.get(col_name) != "":
-                            tax_rates.append(rate)
-                    
-                    if data.get("Thuế khác"):
-                        tax_rates.append("Khác")
-                    
-                    if not tax_rates:
-                        tax_rates = ["N/A"]
-                    
-                    # Create row(s) for this invoice
-                    base_row = {
-                        "Team": team_input.strip(),
-                        "Số hóa đơn": data.get("Số hóa đơn", ""),
-                        "Ngày hóa đơn": data.get("Ngày hóa đơn", ""),
-                        "Mã số thuế bên bán": data.get("Mã số thuế", ""),
-                        "Số ký hiệu": data.get("Ký hiệu", ""),
-                        "Mã tra cứu": data.get("Mã tra cứu", ""),
-                        "Link tra cứu": data.get("Link lấy hóa đơn", "") or data.get("Mã tra cứu", ""),
-                        "Phân loại": final_category,
-                        "Số tiền trước VAT": data.get("Số tiền trước Thuế", ""),
-                        "Tổng tiền sau thuế": data.get("Số tiền sau", ""),
-                        "Tên nhân viên": employee_input.strip(),
-                        "Tên file": uploaded_file.name
-                    }
-                    
-                    # Handle multi-rate invoices
-                    # Helper function to parse money string
-                    def parse_money_str(s):
-                        if not s or pd.isna(s):
-                            return 0
-                        s = str(s).strip()
-                        # Robust decimal handling: check order of separators
-                        if '.' in s and ',' in s:
-                            if s.rfind(',') > s.rfind('.'):
-                                s = s[:s.rfind(',')]  # Cut decimal part
-                            else:
-                                s = s[:s.rfind('.')]
-                        elif re.search(r'[,.]\d{2}$', s) and not re.search(r'[,.]\d{3}$', s):
-                            s = s[:-3]  # Remove 2-digit decimal suffix
-                        s = s.replace(',', '').replace('.', '')
-                        try:
-                            return int(s)
-                        except:
-                            return 0
-                    
-                    # Helper function to calculate amounts per tax rate
-                    def calc_amounts_for_rate(vat_amount, rate_str):
-                        """Calculate before-VAT and total from VAT amount and rate"""
-                        vat_val = parse_money_str(vat_amount)
-                        rate_map = {"0%": 0, "5%": 0.05, "8%": 0.08, "10%": 0.10}
-                        rate = rate_map.get(rate_str, 0)
-                        
-                        if vat_val and rate > 0:
-                            before_vat = int(round(vat_val / rate))
-                            total = before_vat + vat_val
-                            return before_vat, vat_val, total
-                        elif vat_val:
-                            return 0, vat_val, vat_val
-                        return 0, 0, 0
-                    
-                    if report_type == "Kinh doanh":
-                        # === BUSINESS FORMAT LOGIC (Wide) ===
-                        business_row = {
-                            "Team": team_input.strip(),
-                            "Tên nhân viên": employee_input.strip(),
-                            "Tên file": uploaded_file.name,
-                            "Ngày hóa đơn": data.get("Ngày hóa đơn", ""),
-                            "Số hóa đơn": data.get("Số hóa đơn", ""),
-                            "Đơn vị bán": data.get("Đơn vị bán", ""),
-                            "Phân loại": final_category,
-                            "Số tiền trước Thuế": data.get("Số tiền trước Thuế", ""),
-                            "Thuế 0%": data.get("Thuế 0%", ""),
-                            "Thuế 5%": data.get("Thuế 5%", ""),
-                            "Thuế 8%": data.get("Thuế 8%", ""),
-                            "Thuế 10%": data.get("Thuế 10%", ""),
-                            "Thuế khác": data.get("Thuế khác", ""),
-                            "Tiền thuế": data.get("Tiền thuế", ""),
-                            "Số tiền sau": data.get("Số tiền sau", ""),
-                            "Link lấy hóa đơn": data.get("Link lấy hóa đơn", "") or data.get("Mã tra cứu", ""),
-                            "Mã tra cứu": data.get("Mã tra cứu", ""),
-                            "Mã số thuế": data.get("Mã số thuế", ""),
-                            "Mã CQT": data.get("Mã CQT", ""),
-                            "Ký hiệu": data.get("Ký hiệu", "")
-                        }
-                        all_rows.append(business_row)
-                    else:
-                        # === ACCOUNTING FORMAT LOGIC (Long) ===
-                        if len(tax_rates) == 1:
-                            # Single rate - simple case
-                            rate = tax_rates[0]
-                            if rate == "N/A":
-                                base_row["VAT"] = data.get("Tiền thuế", "")
-                                base_row["Thuế suất"] = ""
-                                # Keep original totals for N/A
-                            else:
-                                vat_str = data.get(f"Thuế {rate}", data.get("Tiền thuế", ""))
-                                base_row["VAT"] = vat_str
-                                base_row["Thuế suất"] = rate
-                                # ONLY calculate if extracted values are MISSING
-                                # DO NOT overwrite already-extracted values!
-                                if not base_row.get("Số tiền trước VAT") or not str(base_row.get("Số tiền trước VAT")).strip():
-                                    before_vat, vat_val, total = calc_amounts_for_rate(vat_str, rate)
-                                    if before_vat:
-                                        base_row["Số tiền trước VAT"] = before_vat
-                                    if total:
-                                        base_row["Tổng tiền sau thuế"] = total
-                            all_rows.append(base_row)
-                        else:
-                            # Multiple rates - create multiple rows with calculated amounts
-                            for rate in tax_rates:
-                                row = base_row.copy()
-                                if rate == "Khác":
-                                    row["VAT"] = data.get("Thuế khác", "")
-                                    row["Thuế suất"] = "Khác"
-                                else:
-                                    vat_str = data.get(f"Thuế {rate}", "")
-                                    before_vat, vat_val, total = calc_amounts_for_rate(vat_str, rate)
-                                    row["VAT"] = vat_val if vat_val else vat_str
-                                    row["Thuế suất"] = rate
-                                    if before_vat:
-                                        row["Số tiền trước VAT"] = before_vat
-                                    if total:
-                                        row["Tổng tiền sau thuế"] = total
-                                all_rows.append(row)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing {uploaded_file.name}: {e}")
-                    status_box.error(f"Lỗi khi xử lý {uploaded_file.name}")
-            
-            status_box.success("✅ Đã xử lý xong tất cả!")
-            logger.info(f"--- COMPLETION: Team={team_input}, Employee={employee_input} finished processing ---")
-            
-            # Create DataFrame with appropriate columns
-            if report_type == "Kinh doanh":
-                columns = [
-                    "Team", "Tên nhân viên", "Tên file", "Ngày hóa đơn", "Số hóa đơn", 
-                    "Đơn vị bán", "Phân loại", "Số tiền trước Thuế", 
-                    "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác", 
-                    "Tiền thuế", "Số tiền sau", "Link lấy hóa đơn", 
-                    "Mã tra cứu", "Mã số thuế", "Mã CQT", "Ký hiệu"
-                ]
-            else:
-                 columns = [
-                    "Team", "Số hóa đơn", "Ngày hóa đơn", "Mã số thuế bên bán", 
-                    "Số ký hiệu", "Mã tra cứu", "Link tra cứu", "Phân loại", 
-                    "Số tiền trước VAT", "VAT", "Thuế suất", "Tổng tiền sau thuế",
-                    "Tên nhân viên", "Tên file"
-                ]
-
-            df = pd.DataFrame(all_rows)
-            for col in columns:
-                if col not in df.columns:
-                    df[col] = ""
-            df = df[columns]
-            
-            # Convert money columns
-            if report_type == "Kinh doanh":
-                 money_columns = ["Số tiền trước Thuế", "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác", "Tiền thuế", "Số tiền sau"]
-            else:
-                 money_columns = ["Số tiền trước VAT", "VAT", "Tổng tiền sau thuế"]
-
-            for col in money_columns:
-                def convert_to_number(x):
-                    if pd.isna(x) or x == '': return None
-                    x_str = str(x).strip()
-                    if re.search(r',\d{2}$', x_str):
-                        x_str = x_str.replace('.', '').replace(',', '.')
-                    else:
-                        x_str = x_str.replace('.', '').replace(',', '')
-                    try:
-                        return round(float(x_str))
-                    except:
-                        return x
-                if col in df.columns:
-                    df[col] = df[col].apply(convert_to_number)
-            
-            # Save to session state
-            st.session_state["report_type"] = report_type
-            
-            # Save to session state
-            st.session_state["processed_df"] = df
-            st.session_state["processing_complete"] = True
+            st.write(f"⏳ Đã xử lý: **{job['done']}/{job['total']}** file")
+        st.progress(job["done"] / job["total"] if job["total"] else 0.0)
+        if st.button("⬅️ Làm việc với file khác"):
+            open_job(None)  # The job keeps running in the background
+            st.rerun()
+        time.sleep(1)
+        st.rerun()
+
+    elif job and job["status"] == FAILED:
+        st.error(f"Lỗi khi xử lý công việc `{job_id}`: {job['error']}")
+        if st.button("⬅️ Làm việc với file khác"):
+            open_job(None)
             st.rerun()
+
+    elif job:
+        # === STEP 4: RESULTS & EXPORT ===
+        st.markdown("### ✅ Kết quả xử lý")
+
+        col_res1, col_res2 = st.columns([1, 4])
+        with col_res1:
+            if st.button("⬅️ Làm việc với file khác"):
+                open_job(None)
+                st.rerun()
+        with col_res2:
+            st.caption(f"Mã công việc: `{job_id}`")
+
+        df = job_queue.report_df(job_id)
+
+        for file_name, error in job_queue.failed_files(job_id):
+            st.error(f"Lỗi khi xử lý {file_name}")
+
+        if job["cache_hits"] is not None:
+            st.caption(f"♻️ Bộ nhớ đệm: {job['cache_hits']} file dùng lại kết quả cũ, {job['cache_misses']} file xử lý mới")
+
+        # Excel report written by the job (streaming export, Team merges in the same pass)
+        with open(job_queue.report_path(job_id), 'rb') as f:
+            output = f.read()
+
+        st.download_button(
+            label="💾 Tải file Excel kết quả",
+            data=output,
+            file_name=REPORT_FILE,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            type="primary",
+            use_container_width=True
+        )
+
+        st.divider()
+        st.dataframe(df, use_container_width=True)
+
     else:
-        st.info("👆 Vui lòng tải file lên để tiếp tục.")
+        # === STEP 1: REQUIRED INPUTS ===
+        st.markdown("### 📝 Bước 1: Thông tin bắt buộc")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            team_input = st.text_input("Team *", placeholder="Ví dụ: Team A, Team B...")
+        with col2:
+            employee_input = st.text_input("Tên nhân viên *", placeholder="Ví dụ: Nguyễn Văn A...")
+
+        # === STEP 2: OPTIONAL CLASSIFICATION ===
+        st.markdown("### 🏷️ Bước 2: Phân loại (Tùy chọn)")
+
+        col_cat1, col_cat2 = st.columns(2)
+        with col_cat1:
+            category_select = st.selectbox("Chọn phân loại:", CATEGORY_OPTIONS)
+        with col_cat2:
+            custom_category = ""
+            if category_select == "Khác (Nhập tay)":
+                custom_category = st.text_input("Nhập phân loại tùy chỉnh:")
+
+        # Report Type Selection
+        report_type = st.radio("Chọn loại báo cáo đầu ra:", ["Kế toán", "Kinh doanh"], horizontal=True)
+
+
+        st.divider()
+
+        # === STEP 3: FILE UPLOAD ===
+        st.markdown("### 📂 Bước 3: Tải hóa đơn (PDF / XML)")
+
+        # Check if required inputs are filled
+        can_upload = bool(team_input.strip()) and bool(employee_input.strip())
+
+        if not can_upload:
+            st.warning("⚠️ Vui lòng nhập **Team** và **Tên nhân viên** trước khi tải file!")
+
+        uploaded_files = st.file_uploader(
+            "Kéo thả hoặc chọn nhiều file PDF vào đây (kèm file XML hóa đơn điện tử cùng tên nếu có - đọc từ XML chính xác và nhanh hơn)", 
+            type=["pdf", "xml"], 
+            accept_multiple_files=True,
+            disabled=not can_upload
+        )
+
+        if uploaded_files:
+            # A PDF uploaded with its e-invoice XML is read from the XML; other XML files are skipped
+            uploads = [(f.name, f.getbuffer()) for f in uploaded_files]
+            sources = pair_invoice_sources(uploads)
+            skipped = [name for name, payload in uploads
+                       if name.lower().endswith('.xml') and not is_invoice_xml(payload)]
+
+            st.divider()
+            st.markdown("### ⚙️ Bước 4: Xử lý dữ liệu")
+            st.write(f"Đã chọn **{len(uploaded_files)}** file.")
+            if skipped:
+                st.warning(f"⚠️ Bỏ qua {len(skipped)} file XML không phải hóa đơn điện tử: {', '.join(skipped)}")
+
+            if not sources:
+                st.error("Không có file hóa đơn nào để xử lý.")
+            elif st.button("🚀 Bắt đầu trích xuất dữ liệu", type="primary"):
+                logger.info(f"--- ACTION: Team={team_input}, Employee={employee_input} queued {len(sources)} files ---")
+
+                # Extraction runs in the background job queue; this session only polls its progress
+                new_job = job_queue.submit(
+                    sources,
+                    team_input.strip(), employee_input.strip(),
+                    category_select, custom_category, report_type
+                )
+                open_job(new_job)
+                st.rerun()
+        else:
+            st.info("👆 Vui lòng tải file lên để tiếp tục.")
+
 
+# Streamlit runs this script as __main__. Batch worker processes are spawned and
+# import it again as __mp_main__; they must not build the page or start a job queue.
+if __name__ == "__main__":
+    main()
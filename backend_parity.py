@@ -0,0 +1,117 @@
+"""
+Parity check between two PDF text backends.
+
+Runs extract_invoice_data() on every PDF of a folder once with the reference
+backend (pdfplumber) and once with the candidate (pdfium), and lists every
+field and line item that differs, plus the time each backend spent reading the
+text layer. A clean run on a representative set of invoices is what it takes to
+switch PDF_TEXT_BACKEND (HOADON_PDF_BACKEND) to the candidate.
+
+Usage:
+    python backend_parity.py                          # invoices_input, pdfplumber vs pdfium
+    python backend_parity.py D:/hoadon/2024 --text    # also show the first differing text lines
+    python backend_parity.py invoices_input --check   # exit with status 1 on any difference
+"""
+import argparse
+import contextlib
+import difflib
+import io
+import os
+import sys
+
+import extract_invoices as ei
+
+
+def find_pdfs(folder):
+    """Every .pdf under folder (recursive), sorted."""
+    pdfs = []
+    for root, _, files in os.walk(folder):
+        pdfs.extend(os.path.join(root, name) for name in files if name.lower().endswith('.pdf'))
+    return sorted(pdfs)
+
+
+def run_backend(pdf_path, backend):
+    """(data, line_items, page_texts, pdf_text ms) of one file with one backend."""
+    trace = ei.ExtractionTrace()
+    # The extractor prints per-file diagnostics; keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, line_items = ei.extract_invoice_data(pdf_path, trace=trace, backend=backend)
+    try:
+        page_texts = ei.read_pdf_pages(pdf_path, backend)
+    except Exception as e:
+        page_texts = [f"<{type(e).__name__}: {e}>"]
+    text_ms = sum(span["wall_ms"] for span in trace.spans if span["stage"] == "pdf_text")
+    return data, line_items, page_texts, text_ms
+
+
+def field_diffs(ref, cand):
+    """[(field, reference value, candidate value)] for every differing field."""
+    keys = list(ref) + [key for key in cand if key not in ref]
+    return [(key, ref.get(key), cand.get(key)) for key in keys if ref.get(key) != cand.get(key)]
+
+
+def item_diffs(ref_items, cand_items):
+    """Readable differences between two line item lists."""
+    diffs = []
+    if len(ref_items) != len(cand_items):
+        diffs.append(f"{len(ref_items)} vs {len(cand_items)} line items")
+    for i, (ref, cand) in enumerate(zip(ref_items, cand_items), 1):
+        for key, ref_val, cand_val in field_diffs(ref, cand):
+            diffs.append(f"item {i} {key}: {ref_val!r} vs {cand_val!r}")
+    return diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare extracted invoice fields across PDF text backends.")
+    parser.add_argument("folder", nargs="?", default="invoices_input", help="Folder of PDFs (default: invoices_input)")
+    parser.add_argument("--reference", default="pdfplumber", choices=sorted(ei.PDF_TEXT_BACKENDS),
+                        help="Reference backend (default: pdfplumber)")
+    parser.add_argument("--candidate", default="pdfium", choices=sorted(ei.PDF_TEXT_BACKENDS),
+                        help="Backend under test (default: pdfium)")
+    parser.add_argument("--text", action="store_true", help="Show the first differing text lines of each file")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if any file differs")
+    args = parser.parse_args()
+
+    pdfs = find_pdfs(args.folder)
+    if not pdfs:
+        print(f"No PDF files found in {args.folder}")
+        sys.exit(1)
+    print(f"Comparing {args.reference} (reference) with {args.candidate} on {len(pdfs)} PDFs in {args.folder}")
+
+    differing = 0
+    text_differing = 0
+    ref_ms = cand_ms = 0.0
+    for pdf_path in pdfs:
+        ref_data, ref_items, ref_pages, ms = run_backend(pdf_path, args.reference)
+        ref_ms += ms
+        cand_data, cand_items, cand_pages, ms = run_backend(pdf_path, args.candidate)
+        cand_ms += ms
+
+        diffs = [f"{key}: {ref_val!r} vs {cand_val!r}" for key, ref_val, cand_val in field_diffs(ref_data, cand_data)]
+        diffs += item_diffs(ref_items, cand_items)
+        text_same = ref_pages == cand_pages
+        text_differing += not text_same
+        if not diffs and (text_same or not args.text):
+            continue
+
+        differing += bool(diffs)
+        print(f"{os.path.relpath(pdf_path, args.folder)}{'' if text_same else ' (text differs)'}")
+        for diff in diffs:
+            print(f"  {diff}")
+        if args.text and not text_same:
+            lines = difflib.unified_diff(ei.join_pages(ref_pages).splitlines(), ei.join_pages(cand_pages).splitlines(),
+                                         args.reference, args.candidate, n=0, lineterm="")
+            for line in list(lines)[:12]:
+                print(f"    {line}")
+
+    print(f"\nFields identical: {len(pdfs) - differing}/{len(pdfs)} files")
+    print(f"Text identical:   {len(pdfs) - text_differing}/{len(pdfs)} files")
+    speedup = f" ({ref_ms / cand_ms:.1f}x)" if cand_ms else ""
+    print(f"Text layer time:  {args.reference} {ref_ms / 1000:.2f}s, {args.candidate} {cand_ms / 1000:.2f}s{speedup}")
+
+    if args.check and differing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
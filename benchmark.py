@@ -0,0 +1,540 @@
+"""
+Extraction benchmark on a synthetic invoice corpus.
+
+Generates text-layer PDFs for the vendor layouts the regexes target (MISA, VNPT,
+M-INVOICE, C26MAP, Golden Gate 5-column) and Petrolimex-style OCR text, then
+times every stage of extract_invoice_data() separately, the end-to-end
+throughput and the Excel export, and compares the result with a stored baseline.
+
+Usage:
+    python benchmark.py                       # run, compare with benchmark_baseline.json
+    python benchmark.py --save-baseline       # store this run as the new baseline
+    python benchmark.py --invoices 50 --seed 7 --keep bench_pdfs
+
+Generating the PDFs needs a TrueType font with Vietnamese glyphs (DejaVu Sans,
+Arial, ...); pass --font if none of the usual locations has one.
+"""
+import argparse
+import contextlib
+import ctypes
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+
+import extract_invoices as ei
+from excel_export import write_invoice_report
+from report import build_report_df, invoice_rows
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    "/Library/Fonts/Arial Unicode.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+    r"C:\Windows\Fonts\arial.ttf",
+]
+
+LINES_PER_PAGE = 55
+
+# ============ SYNTHETIC CORPUS ============
+
+FOOD_ITEMS = [
+    ("Lẩu hải sản thập cẩm", "Phần"), ("Gỏi ngó sen tôm thịt", "Dĩa"), ("Cơm chiên hải sản", "Dĩa"),
+    ("Bò lúc lắc khoai tây", "Phần"), ("Cá chẽm hấp xì dầu", "Con"), ("Trà đá", "Ly"),
+    ("Nước suối", "Chai"), ("Coca Cola", "Lon"), ("Set lẩu bò Mỹ", "Set"), ("Khăn lạnh", "Cái"),
+]
+HOTEL_ITEMS = [
+    ("Tiền thuê phòng Deluxe", "Ngày"), ("Phòng họp nửa ngày", "Lần"),
+    ("Giặt ủi", "Lần"), ("Ăn sáng buffet", "Suất"),
+]
+SERVICE_ITEMS = [
+    ("Cước dịch vụ internet cáp quang", "Tháng"), ("Hộp quà tết cao cấp", "Hộp"),
+    ("Giỏ quà trái cây nhập khẩu", "Giỏ"), ("Bó hoa hồng đỏ", "Bó"),
+]
+
+
+def vnd(n):
+    """1234000 -> '1.234.000'"""
+    return f"{n:,}".replace(',', '.')
+
+
+def _items(rng, pool, count):
+    """[(name, unit, qty, price, amount)] with prices in whole thousands."""
+    items = []
+    for _ in range(count):
+        name, unit = rng.choice(pool)
+        qty = rng.randint(1, 6)
+        price = rng.randint(10, 900) * 1000
+        items.append((name, unit, qty, price, qty * price))
+    return items
+
+
+def _code(rng, length, alphabet=string.ascii_uppercase + string.digits):
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def _invoice_ids(rng):
+    return {
+        "no": f"{rng.randint(1, 99999999):08d}",
+        "mst": f"03{rng.randint(0, 99999999):08d}",
+        "serial": f"1C{rng.randint(24, 26)}T{_code(rng, 2, string.ascii_uppercase)}",
+        "day": rng.randint(1, 28),
+        "month": rng.randint(1, 12),
+        "year": rng.choice([2025, 2026]),
+        "lookup": _code(rng, 10),
+    }
+
+
+def layout_misa(rng, n_items):
+    ids, items = _invoice_ids(rng), _items(rng, FOOD_ITEMS, n_items)
+    before = sum(i[4] for i in items)
+    vat = before * 8 // 100
+    lines = [
+        "CÔNG TY TNHH NHÀ HÀNG HẢI SẢN BIỂN ĐÔNG",
+        f"Mã số thuế: {ids['mst']}",
+        "Địa chỉ: 12 Nguyễn Huệ, Quận 1, TP Hồ Chí Minh",
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        f"Ký hiệu (Serial): {ids['serial']}",
+        f"Số (No.): {ids['no']}",
+        f"Ngày {ids['day']:02d} tháng {ids['month']:02d} năm {ids['year']}",
+        "Tên đơn vị (Company): CÔNG TY CỔ PHẦN PSD",
+        "STT Tên hàng hóa, dịch vụ Đơn vị tính Số lượng Đơn giá Thành tiền",
+    ]
+    lines += [f"{n} {name} {unit} {qty} {vnd(price)} {vnd(amount)}"
+              for n, (name, unit, qty, price, amount) in enumerate(items, 1)]
+    lines += [
+        f"Cộng tiền hàng (Total amount before VAT): {vnd(before)}",
+        "Thuế suất GTGT (VAT rate): 8%",
+        f"Tiền thuế GTGT (VAT amount): {vnd(vat)}",
+        f"Tổng tiền thanh toán (Total amount): {vnd(before + vat)}",
+        f"Mã tra cứu hóa đơn (Invoice code): {ids['lookup']}",
+        "Tra cứu hóa đơn tại: https://www.meinvoice.vn/tra-cuu",
+    ]
+    return lines, before + vat
+
+
+def layout_vnpt(rng, n_items):
+    ids, items = _invoice_ids(rng), _items(rng, FOOD_ITEMS, n_items)
+    before = sum(i[4] for i in items)
+    vat = before * 8 // 100
+    lines = [
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        f"(RESTAURANT BILL) {ids['no']}",
+        f"Ký hiệu(Serial): {ids['serial']}",
+        f"Ngày (date) {ids['day']:02d} tháng (month) {ids['month']:02d} năm (year) {ids['year']}",
+        "Tên người bán (Seller): CÔNG TY TNHH ẨM THỰC SÀI GÒN XANH",
+        "Mã số thuế (Tax code): " + " ".join(ids["mst"]),
+        "Địa chỉ (Address): 45 Lê Lợi, Quận 1",
+        "STT Tên hàng hóa, dịch vụ Đơn vị tính Số lượng Đơn giá Thành tiền Thuế suất",
+    ]
+    lines += [f"{n} {name} {unit} {qty} {vnd(price)} {vnd(amount)} 8%"
+              for n, (name, unit, qty, price, amount) in enumerate(items, 1)]
+    lines += [
+        f"Cộng tiền hàng: {vnd(before)}",
+        f"Tiền thuế GTGT ( 8% ) {vnd(vat)}",
+        f"Tổng cộng tiền thanh toán (Total payment): {vnd(before + vat)}",
+        f"Mã tra cứu(Lookup code):HCM{ids['lookup']}",
+        "Tra cứu hóa đơn tại (Lookup the invoice at):https://hcm.vnpt-invoice.com.vn",
+        "Ký bởi: VNPT Giải pháp hóa đơn điện tử MST 0106869738",
+    ]
+    return lines, before + vat
+
+
+def layout_minvoice(rng, n_items):
+    ids, items = _invoice_ids(rng), _items(rng, SERVICE_ITEMS, n_items)
+    before = sum(i[4] for i in items)
+    vat = before // 10
+    seller = "CHI NHÁNH CÔNG TY CỔ PHẦN DỊCH VỤ VIỄN THÔNG MIỀN NAM"
+    lines = [
+        seller,
+        f"Đơn vị bán hàng (Seller): {seller}",
+        f"Mã số thuế (Tax code): {ids['mst']}-001",
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        f"Ký hiệu (Serial No): {ids['serial']}",
+        f"Số (No.): {ids['no']}",
+        f"Ngày {ids['day']:02d} tháng {ids['month']:02d} năm {ids['year']}",
+        "STT Tên hàng hóa, dịch vụ ĐVT Số lượng Đơn giá Thành tiền",
+    ]
+    for n, (name, unit, qty, price, amount) in enumerate(items, 1):
+        lines.append(f"{n} {name} {unit} {qty} {vnd(price)} {vnd(amount)}")
+        if unit == "Tháng":
+            lines.append(f"(từ ngày 01/{ids['month']:02d}/{ids['year']} đến ngày 28/{ids['month']:02d}/{ids['year']})")
+    lines += [
+        f"Tổng tiền chưa thuế: {vnd(before)}",
+        f"Tổng tiền chịu thuế suất: 10% {vnd(before)} {vnd(vat)} {vnd(before + vat)}",
+        f"Tổng tiền thuế: {vnd(vat)}",
+        f"Tổng tiền thanh toán (Total amount): {vnd(before + vat)}",
+        f"Mã của cơ quan thuế: 00{_code(rng, 15)}",
+        f"Tra cứu hóa đơn tại: https://tracuu.minvoice.com.vn Mã tra cứu: {ids['lookup']}",
+    ]
+    return lines, before + vat
+
+
+def layout_c26map(rng, n_items):
+    ids, items = _invoice_ids(rng), _items(rng, HOTEL_ITEMS, n_items)
+    before = sum(i[4] for i in items)
+    vat = before * 8 // 100
+    lines = [
+        "CÔNG TY TNHH KHÁCH SẠN BẾN THÀNH",
+        f"Mã số thuế: {ids['mst']}",
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        f"Ký hiệu / Serial: {ids['serial']}",
+        "Số HĐ / Invoice No.:",
+        ids["no"],
+        f"Ngày {ids['day']:02d} tháng {ids['month']:02d} năm {ids['year']}",
+        "STT Tên hàng hóa, dịch vụ Đơn vị tính Số lượng Đơn giá Thành tiền",
+    ]
+    lines += [f"{n} {name} {unit} {qty} {vnd(price)} {vnd(amount)}"
+              for n, (name, unit, qty, price, amount) in enumerate(items, 1)]
+    lines += [
+        f"Cộng tiền hàng / Total charges: {vnd(before)}",
+        f"Tiền thuế GTGT / VAT: {vnd(vat)}",
+        f"Tổng cộng / Total Amount: {vnd(before + vat)}",
+        f"Mã tra cứu hoá đơn: {ids['lookup']}",
+    ]
+    return lines, before + vat
+
+
+def layout_goldengate(rng, n_items):
+    ids, items = _invoice_ids(rng), _items(rng, FOOD_ITEMS, n_items)
+    before = sum(i[4] for i in items)
+    discount = before // 20 // 1000 * 1000
+    after_discount = before - discount
+    vat = after_discount * 8 // 100
+    summary = f"{vnd(before)} {vnd(discount)} {vnd(after_discount)} {vnd(vat)} {vnd(after_discount + vat)}"
+    lines = [
+        "CHI NHÁNH CÔNG TY CỔ PHẦN TẬP ĐOÀN GOLDEN GATE",
+        f"Mã số thuế: {ids['mst']}-068",
+        "HÓA ĐƠN GIÁ TRỊ GIA TĂNG",
+        f"Ký hiệu (Serial): {ids['serial']}",
+        f"Số (No.): {ids['no']}",
+        f"Ngày {ids['day']:02d} tháng {ids['month']:02d} năm {ids['year']}",
+        "STT Tên hàng hóa Đơn vị tính Số lượng Đơn giá Thành tiền",
+    ]
+    lines += [f"{n} {name} {unit} {qty} {vnd(price)} {vnd(amount)}"
+              for n, (name, unit, qty, price, amount) in enumerate(items, 1)]
+    lines += [
+        f"Thuế suất khác (Other VAT rate): 8% {summary}",
+        f"Tổng cộng tiền thanh toán (Total amount) {summary}",
+        f"Mã tra cứu: {ids['lookup']}",
+    ]
+    return lines, after_discount + vat
+
+
+def layout_petrolimex_ocr(rng, n_items):
+    """Tesseract-style text of a scanned Petrolimex receipt (OCR typos included)."""
+    ids = _invoice_ids(rng)
+    litres = rng.randint(50, 600) / 10
+    price = rng.choice([19870, 20650, 23450, 25100])
+    total = int(round(litres * price))
+    before = int(round(total / 1.08))
+    lines = [
+        "CÔNG TY XĂNG DẦU KHU VỰC II - TNHH MỘT THÀNH VIÊN",
+        f"CỬA HÀNG XĂNG DẦU PETROLIMEX SỐ {rng.randint(1, 99)}",
+        f"Ma sé thué: {ids['mst']}",
+        f"Ký hiệu: {ids['serial']}",
+        f"sé: {ids['no'][1:]}",
+        f"Ngày {ids['day']:02d} tháng {ids['month']:02d} năm {ids['year']}",
+        f"1 Xăng RON 95-III Lít {str(litres).replace('.', ',')} {vnd(price)} {vnd(total)}",
+        f"ông tiên hàng: {vnd(before)}",
+        f"lên thuê GTGT (8% ) {vnd(total - before)}",
+        f"ông sô tiên thanh toán: {vnd(total)}",
+    ]
+    return lines, total
+
+
+PDF_LAYOUTS = {
+    "misa": layout_misa,
+    "vnpt": layout_vnpt,
+    "minvoice": layout_minvoice,
+    "c26map": layout_c26map,
+    "goldengate": layout_goldengate,
+}
+OCR_LAYOUTS = {
+    "petrolimex_ocr": layout_petrolimex_ocr,
+}
+
+
+def find_font(font_path=None):
+    for path in ([font_path] if font_path else FONT_CANDIDATES):
+        if path and os.path.exists(path):
+            return path
+    raise SystemExit("No TrueType font with Vietnamese glyphs found - pass --font /path/to/font.ttf")
+
+
+def write_text_pdf(lines, path, font_path):
+    """Write lines as a text-layer PDF (A4, 9pt), LINES_PER_PAGE lines per page."""
+    pdf = pdfium.PdfDocument.new()
+    with open(font_path, 'rb') as f:
+        font_data = f.read()
+    font_buf = (ctypes.c_uint8 * len(font_data)).from_buffer_copy(font_data)
+    font = pdfium_c.FPDFText_LoadFont(pdf.raw, font_buf, len(font_data), pdfium_c.FPDF_FONT_TRUETYPE, True)
+    for start in range(0, len(lines), LINES_PER_PAGE):
+        page = pdf.new_page(595, 842)
+        y = 800
+        for line in lines[start:start + LINES_PER_PAGE]:
+            obj = pdfium_c.FPDFPageObj_CreateTextObj(pdf.raw, font, 9)
+            text = (line + "\x00").encode("utf-16-le")
+            pdfium_c.FPDFText_SetText(obj, ctypes.cast(ctypes.c_char_p(text), ctypes.POINTER(pdfium_c.FPDF_WCHAR)))
+            pdfium_c.FPDFPageObj_Transform(obj, 1, 0, 0, 1, 40, y)
+            pdfium_c.FPDFPage_InsertObject(page.raw, obj)
+            y -= 13
+        pdfium_c.FPDFPage_GenerateContent(page.raw)
+        page.close()
+    pdf.save(path)
+    pdf.close()
+
+
+def build_corpus(directory, invoices, seed, max_items, font_path):
+    """
+    Write invoices PDFs per PDF layout into directory and make as many OCR texts.
+    Returns ([(layout, path, expected_total)], [(layout, text, expected_total)]).
+    Every 10th invoice gets 5x the items so multi-page documents are covered.
+    """
+    rng = random.Random(seed)
+    pdfs, texts = [], []
+    for layout, make in PDF_LAYOUTS.items():
+        for i in range(invoices):
+            n_items = rng.randint(1, max_items) * (5 if i % 10 == 9 else 1)
+            lines, total = make(rng, n_items)
+            path = os.path.join(directory, f"{layout}_{i:04d}.pdf")
+            write_text_pdf(lines, path, font_path)
+            pdfs.append((layout, path, total))
+    for layout, make in OCR_LAYOUTS.items():
+        for i in range(invoices):
+            lines, total = make(rng, 1)
+            texts.append((layout, "\n".join(lines), total))
+    return pdfs, texts
+
+
+# ============ TIMING ============
+
+class StageTimer:
+    """Wall-clock samples (seconds) per stage name."""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        rows = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            rows[name] = {
+                "calls": len(samples),
+                "total_s": sum(samples),
+                "mean_ms": statistics.mean(samples) * 1000,
+                "p50_ms": statistics.median(samples) * 1000,
+                "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            }
+        return rows
+
+
+def _check_total(correct, layout, data, expected):
+    """Count per layout whether "Số tiền sau" matches the generated total: [right, total]."""
+    counts = correct.setdefault(layout, [0, 0])
+    counts[0] += ei._parse_amount(data.get("Số tiền sau")) == expected
+    counts[1] += 1
+
+
+def time_stages(pdfs, texts, rounds, timer):
+    """Run each stage of extract_invoice_data() on its own; returns {layout: [right totals, invoices]}."""
+    correct = {}
+    for round_no in range(rounds):
+        for layout, path, expected in pdfs:
+            filename = os.path.basename(path)
+            data = ei._empty_invoice_data(filename)
+            with timer.stage("pdf_text"):
+                full_text = ei.join_pages(ei.read_pdf_pages(path))
+            with timer.stage("clean_text"):
+                full_text = ei.clean_pdf_text(full_text, data)
+            with timer.stage("document"):
+                doc = ei.Document(full_text)
+            with timer.stage("services"):
+                services = ei.extract_services_from_text(doc)
+            with timer.stage("header"):
+                ei.extract_header_fields(doc, data, filename, path)
+            with timer.stage("reconcile"):
+                ei.reconcile_amounts(doc, data, services)
+            with timer.stage("finalize"):
+                ei.finalize_invoice_data(data, full_text)
+            if round_no == 0:
+                _check_total(correct, layout, data, expected)
+        for layout, text, expected in texts:
+            with timer.stage("ocr_fields"):
+                data = ei.extract_ocr_invoice_fields(text, f"{layout}.pdf")
+            if round_no == 0:
+                _check_total(correct, layout, data, expected)
+    return correct
+
+
+def time_end_to_end(pdfs, rounds, timer):
+    """extract_invoice_data() per file, in this process; returns [(data, line_items)] of the last round."""
+    results = []
+    for _ in range(rounds):
+        results = []
+        for layout, path, expected in pdfs:
+            with timer.stage("extract_invoice_data"):
+                results.append(ei.extract_invoice_data(path))
+    return results
+
+
+def time_excel(results, rows_target, timer):
+    """Build the "Kế toán" report from the results (repeated up to rows_target rows) and export it."""
+    rows = []
+    while len(rows) < rows_target:
+        for data, line_items in results:
+            rows.extend(invoice_rows(data, line_items, data["Tên file"], "Team Bench", "Benchmark",
+                                     "Dịch vụ ăn uống", "Kế toán"))
+    rows = rows[:rows_target]
+    with timer.stage("excel_export"):
+        df = build_report_df(rows, "Kế toán")
+        write_invoice_report(df, io.BytesIO(), "Kế toán")
+    return len(rows)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# ============ REPORT ============
+
+def compare(current, baseline, tolerance):
+    """Print stage medians next to the baseline; returns names of stages slower than tolerance."""
+    slower = []
+    print(f"\n{'stage':<22}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}{'baseline':>11}{'change':>9}")
+    for name, row in current["stages"].items():
+        line = f"{name:<22}{row['calls']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['total_s']:>10.2f}"
+        base = (baseline or {}).get("stages", {}).get(name)
+        if base and base["p50_ms"] > 0:
+            change = (row["p50_ms"] - base["p50_ms"]) / base["p50_ms"] * 100
+            flag = "  SLOWER" if change > tolerance else ""
+            if flag:
+                slower.append(name)
+            line += f"{base['p50_ms']:>11.2f}{change:>+8.0f}%{flag}"
+        print(line)
+
+    base_tp = (baseline or {}).get("throughput")
+    tp_line = f"\nThroughput: {current['throughput']:.1f} invoices/s"
+    if base_tp:
+        tp_line += f" (baseline {base_tp:.1f}, {(current['throughput'] - base_tp) / base_tp * 100:+.0f}%)"
+    print(tp_line)
+    if current["peak_rss_mb"] is not None:
+        rss_line = f"Peak RSS: {current['peak_rss_mb']:.0f} MB"
+        if baseline and baseline.get("peak_rss_mb"):
+            rss_line += f" (baseline {baseline['peak_rss_mb']:.0f} MB)"
+        print(rss_line)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark invoice extraction on a synthetic corpus.")
+    parser.add_argument("--invoices", type=int, default=20, help="Invoices per layout (default: 20)")
+    parser.add_argument("--max-items", type=int, default=12, help="Max line items per invoice (default: 12)")
+    parser.add_argument("--rounds", type=int, default=2, help="Timed passes over the corpus (default: 2)")
+    parser.add_argument("--excel-rows", type=int, default=5000, help="Rows in the exported report (default: 5000)")
+    parser.add_argument("--seed", type=int, default=1, help="Corpus random seed (default: 1)")
+    parser.add_argument("--font", help="TrueType font for the generated PDFs")
+    parser.add_argument("--backend", default=ei.PDF_TEXT_BACKEND, choices=sorted(ei.PDF_TEXT_BACKENDS),
+                        help=f"PDF text backend (default: {ei.PDF_TEXT_BACKEND})")
+    parser.add_argument("--keep", metavar="DIR", help="Write the corpus to DIR and keep it")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=15.0,
+                        help="Percent a stage median may grow before it is flagged (default: 15)")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if a stage is flagged")
+    args = parser.parse_args()
+
+    font_path = find_font(args.font)
+    ei.PDF_TEXT_BACKEND = args.backend
+    corpus_dir = args.keep or tempfile.mkdtemp(prefix="invoice_bench_")
+    os.makedirs(corpus_dir, exist_ok=True)
+    try:
+        print(f"Generating corpus in {corpus_dir} ...")
+        pdfs, texts = build_corpus(corpus_dir, args.invoices, args.seed, args.max_items, font_path)
+        print(f"  {len(pdfs)} PDFs ({', '.join(PDF_LAYOUTS)}), {len(texts)} OCR texts ({', '.join(OCR_LAYOUTS)})")
+
+        timer = StageTimer()
+        # The extractor prints per-file diagnostics; keep them out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Warm-up: compile lazy regexes and fill the token cache outside the timings
+            time_stages(pdfs[:len(PDF_LAYOUTS)], texts[:1], 1, StageTimer())
+            correct = time_stages(pdfs, texts, args.rounds, timer)
+            results = time_end_to_end(pdfs, args.rounds, timer)
+        excel_rows = time_excel(results, args.excel_rows, timer)
+    finally:
+        if not args.keep:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    stages = timer.summary()
+    current = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "invoices_per_layout": args.invoices,
+            "max_items": args.max_items,
+            "rounds": args.rounds,
+            "seed": args.seed,
+            "backend": args.backend,
+            "excel_rows": excel_rows,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "stages": stages,
+        "throughput": stages["extract_invoice_data"]["calls"] / stages["extract_invoice_data"]["total_s"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"Baseline: {args.baseline} ({baseline['meta'].get('date', '?')})")
+        if baseline["meta"].get("seed") != args.seed or baseline["meta"].get("invoices_per_layout") != args.invoices:
+            print("  WARNING: baseline was made with a different corpus (--seed/--invoices)")
+        if baseline["meta"].get("backend", args.backend) != args.backend:
+            print(f"  WARNING: baseline was made with the {baseline['meta']['backend']} PDF text backend")
+
+    slower = compare(current, baseline, args.tolerance)
+    print("Totals extracted correctly: " + ", ".join(f"{layout} {right}/{n}" for layout, (right, n) in correct.items()))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"Saved baseline: {args.baseline}")
+
+    if args.check and slower:
+        print(f"Slower than baseline: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Streaming Excel export for the consolidated invoice report.
+
+Rows are written with openpyxl's write-only mode: every cell gets one of a few
+shared named styles as it is written, merge ranges for the Team column are
+collected in the same pass, and the finished file is never loaded back. Memory
+stays flat and time grows linearly with the number of rows.
+"""
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange, MultiCellRange
+
+SHEET_NAME = "Hóa đơn"
+
+# Report layouts: column widths (1-based column -> width), which columns are
+# money / centered, how money cells are aligned, and whether consecutive rows of
+# the same Team are merged in column A.
+REPORT_LAYOUTS = {
+    # extract_invoices.main(): one row per invoice
+    # A=Tên file, B=Ngày, C=Số HĐ, D=Đơn vị bán, E=Phân loại
+    # F=Trước thuế, G=Thuế 0%, H=Thuế 5%, I=Thuế 8%, J=Thuế 10%, K=Thuế khác
+    # L=Tiền thuế, M=Sau thuế, N=Link, O=Mã tra cứu, P=MST, Q=Mã CQT, R=Ký hiệu
+    "Tổng hợp": {
+        "widths": [30, 12, 15, 40, 18, 18, 12, 12, 12, 12, 12, 12, 15, 18, 15, 20, 15, 15],
+        "money_cols": [6, 7, 8, 9, 10, 11, 12, 13],
+        "center_cols": [2, 3, 5, 16, 18],
+        "money_style": "invoice_money",
+        "merge_team": False,
+    },
+    # app.py business report: A:Team, B:NV, C:File, D:Ngay, E:So...
+    "Kinh doanh": {
+        "widths": [15, 20, 30, 12, 10, 25, 15, 15, 12, 12, 12, 12, 10, 15, 15, 30, 15, 15, 20, 10],
+        "money_names": ["Số tiền trước Thuế", "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác", "Tiền thuế", "Số tiền sau"],
+        "center_cols": [],
+        "money_style": "invoice_money_wrap",
+        "merge_team": False,
+    },
+    # app.py accounting report
+    # A:Team, B:SoHD, C:Ngay, D:MST, E:KyHieu, F:MaTraCuu, G:Link, H:PhanLoai
+    # I:TruocVAT, J:VAT, K:ThueSuat, L:SauThue, M:NV, N:File
+    "Kế toán": {
+        "widths": [15, 15, 12, 15, 15, 20, 30, 18, 15, 12, 10, 15, 18, 35],
+        "money_cols": [9, 10, 12],
+        "center_cols": [1, 2, 3, 4, 5, 11],
+        "money_style": "invoice_money",
+        "merge_team": True,
+    },
+}
+
+
+def _named_styles():
+    border_side = Side(style='thin', color="000000")
+    border = Border(left=border_side, right=border_side, top=border_side, bottom=border_side)
+    body_font = Font(name="Arial", size=10)
+    return [
+        NamedStyle(name="invoice_header", border=border,
+                   font=Font(bold=True, color="FFFFFF", size=11, name="Arial"),
+                   fill=PatternFill("solid", fgColor="4F81BD"),
+                   alignment=Alignment(horizontal="center", vertical="center", wrap_text=True)),
+        NamedStyle(name="invoice_text", border=border, font=body_font,
+                   alignment=Alignment(vertical="center", wrap_text=True)),
+        NamedStyle(name="invoice_center", border=border, font=body_font,
+                   alignment=Alignment(horizontal="center", vertical="center")),
+        # Top cell of a merged Team block
+        NamedStyle(name="invoice_center_wrap", border=border, font=body_font,
+                   alignment=Alignment(horizontal="center", vertical="center", wrap_text=True)),
+        NamedStyle(name="invoice_money", border=border, font=body_font, number_format='#,##0',
+                   alignment=Alignment(horizontal="right", vertical="center")),
+        NamedStyle(name="invoice_money_wrap", border=border, font=body_font, number_format='#,##0',
+                   alignment=Alignment(vertical="center", wrap_text=True)),
+    ]
+
+
+def write_invoice_report(df, target, layout):
+    """
+    Write the report DataFrame to an .xlsx file path or binary file object.
+    :param layout: Key of REPORT_LAYOUTS
+    """
+    spec = REPORT_LAYOUTS[layout]
+    columns = list(df.columns)
+    n_cols = len(columns)
+
+    wb = Workbook(write_only=True)
+    for style in _named_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet(SHEET_NAME)
+
+    # Sheet-level settings must be in place before the first row is written
+    for col_idx, width in enumerate(spec["widths"][:n_cols], start=1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = width
+    ws.freeze_panes = 'A2'
+    ws.auto_filter.ref = f"A1:{get_column_letter(max(n_cols, 1))}{len(df) + 1}"
+
+    money_cols = set(spec.get("money_cols", []))
+    money_cols.update(columns.index(c) + 1 for c in spec.get("money_names", []) if c in columns)
+    center_cols = set(spec["center_cols"])
+    col_styles = []
+    for col_idx in range(1, n_cols + 1):
+        if col_idx in money_cols:
+            col_styles.append(spec["money_style"])
+        elif col_idx in center_cols:
+            col_styles.append("invoice_center")
+        else:
+            col_styles.append("invoice_text")
+
+    def styled_row(values, styles):
+        row = []
+        for value, style in zip(values, styles):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = style
+            row.append(cell)
+        return row
+
+    ws.append(styled_row(columns, ["invoice_header"] * n_cols))
+
+    # Empty cells (NaN/None) are written as styled blanks
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    teams = df.iloc[:, 0].tolist() if spec["merge_team"] and n_cols else []
+    team_start = 0  # index of the first row of the current Team block
+    team_merges = []
+    for i, values in enumerate(rows):
+        styles = col_styles
+        if teams:
+            if i > team_start and teams[i] == teams[team_start]:
+                values = (None,) + values[1:]  # Covered by the merged cell above
+            else:
+                team_start = i
+                if i + 1 < len(teams) and teams[i + 1] == teams[i]:
+                    styles = ["invoice_center_wrap"] + col_styles[1:]
+            # Close the block on its last row
+            if i > team_start and (i + 1 == len(teams) or teams[i + 1] != teams[team_start]):
+                team_merges.append(CellRange(f"A{team_start + 2}:A{i + 2}"))
+        ws.append(styled_row(values, styles))
+
+    # Blocks never overlap, so skip MultiCellRange.add()'s overlap check (quadratic in the number of merges)
+    ws.merged_cells = MultiCellRange(team_merges)
+    wb.save(target)
@@ -1,18 +1,29 @@
 import re
 import os
+import io
+import time
+import queue
+import threading
+import ctypes
+import bisect
+import multiprocessing
+from multiprocessing import connection as mp_connection
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import pdfplumber
+from pdfplumber.utils import extract_text as chars_to_text
+from pdfplumber.utils import extract_words as chars_to_words
 import pandas as pd
-import openpyxl
 import ast  # Added for parsing dict strings
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from openpyxl.utils import get_column_letter
 
 # OCR imports (optional - for scanned PDFs)
 OCR_AVAILABLE = False
 POPPLER_PATH = None  # Use system default on Linux
 try:
     import pytesseract
-    from pdf2image import convert_from_path
+    from pdf2image import convert_from_bytes, convert_from_path, pdfinfo_from_bytes, pdfinfo_from_path
     from PIL import Image
     OCR_AVAILABLE = True
     # Configure Tesseract path (Windows only, Linux uses system default)
@@ -23,6 +34,95 @@ try:
 except ImportError:
     pass  # OCR not available, will skip scanned PDFs
 
+# tesserocr (optional) - Tesseract C API: language models are loaded once per
+# engine instead of once per page (see TesserocrEngine)
+TESSEROCR_AVAILABLE = False
+try:
+    import tesserocr
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    pass
+
+# pypdfium2 (installed with pdfplumber) - faster PDF text backend and embedded
+# scan images. PDFium is not thread-safe: every call goes through PDFIUM_LOCK.
+PDFIUM_AVAILABLE = False
+PDFIUM_LOCK = threading.RLock()
+try:
+    import pypdfium2 as pdfium
+    import pypdfium2.raw as pdfium_c
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    pass
+
+# Bump whenever a change alters what extract_invoice_data returns, so cached
+# results from older extractor code are not reused.
+EXTRACTOR_VERSION = 7
+
+# ============ KEYWORD MATCHING ============
+# Keyword lists are compiled once into a trie-shaped regex (common prefixes shared),
+# so a text is scanned once for all keywords instead of once per keyword.
+
+def _keyword_trie_pattern(keywords):
+    """Regex matching the LONGEST keyword at a position: one branch per distinct next character."""
+    trie = {}
+    for kw in keywords:
+        node = trie
+        for ch in kw:
+            node = node.setdefault(ch, {})
+        node[''] = {}  # End of a keyword
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        group = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            # A keyword ends here: try the longer ones first, fall back to this one
+            return ('(?:' + group + ')?') if len(branches) == 1 else group + '?'
+        return group
+
+    return build(trie)
+
+
+def _is_word_char(ch):
+    # Same definition as \w in re for str patterns
+    return ch.isalnum() or ch == '_'
+
+
+def _at_word_boundaries(text, start, end):
+    """Same result as r'\b' + keyword + r'\b' matching text[start:end]."""
+    def boundary(i):
+        before = i > 0 and _is_word_char(text[i - 1])
+        after = i < len(text) and _is_word_char(text[i])
+        return before != after
+    return boundary(start) and boundary(end)
+
+
+class KeywordMatcher:
+    """Multi-keyword matcher: every occurrence of every keyword in a single regex pass."""
+
+    def __init__(self, keywords):
+        self.keywords = sorted(set(keywords))
+        pattern = _keyword_trie_pattern(self.keywords)
+        self._any = re.compile(pattern)
+        # Zero-width lookahead so overlapping occurrences are found too
+        self._all = re.compile('(?=(' + pattern + '))')
+        # The regex reports the longest keyword at a position; the shorter keywords
+        # that are prefixes of it match at the same position
+        self._prefixes = {kw: [k for k in self.keywords if kw.startswith(k)] for kw in self.keywords}
+
+    def contains_any(self, text):
+        """True if any keyword occurs in text (like any(kw in text for kw in keywords))."""
+        return self._any.search(text) is not None
+
+    def iter_matches(self, text):
+        """Yield (keyword, start) for every occurrence, overlapping ones included."""
+        for m in self._all.finditer(text):
+            start = m.start()
+            for kw in self._prefixes[m.group(1)]:
+                yield kw, start
+
+
 # Category mapping based on extracted services
 CATEGORY_KEYWORDS = {
     "Dịch vụ ăn uống": [
@@ -53,10 +153,28 @@ CATEGORY_KEYWORDS = {
     ]
 }
 
+# Categories matched as plain substrings instead of whole words: for "Xăng xe",
+# OCR often concatenates (e.g. "XăngRON95")
+SUBSTRING_CATEGORIES = {"Xăng xe"}
+
+
+def _build_category_index():
+    """keyword (lowercase) -> [(category, whole_word)]"""
+    index = {}
+    for category, keywords in CATEGORY_KEYWORDS.items():
+        for kw in keywords:
+            index.setdefault(kw.lower(), []).append((category, category not in SUBSTRING_CATEGORIES))
+    return index
+
+
+CATEGORY_KEYWORD_INDEX = _build_category_index()
+CATEGORY_MATCHER = KeywordMatcher(CATEGORY_KEYWORD_INDEX)
+
 # F&B brand names for seller-based classification
 FB_BRANDS = ["KATINAT", "HIGHLANDS", "STARBUCKS", "PHÚC LONG", "COFFEE HOUSE", 
              "TRUNG NGUYÊN", "GOLDEN GATE", "PIZZA", "KFC", "LOTTERIA", 
              "JOLLIBEE", "MCDONALD", "DOMINO"]
+FB_BRAND_MATCHER = KeywordMatcher(FB_BRANDS)
 
 def classify_content(services_text, seller_name=""):
     """Classify services into categories using keyword matching with word boundaries."""
@@ -64,27 +182,29 @@ def classify_content(services_text, seller_name=""):
     # Priority: Check Seller Name for known F&B brands
     if seller_name:
         seller_upper = seller_name.upper()
-        if any(brand in seller_upper for brand in FB_BRANDS):
+        if FB_BRAND_MATCHER.contains_any(seller_upper):
             return "Dịch vụ ăn uống"
 
     if not services_text:
         return "Khác"
     text_lower = services_text.lower()
     
+    # Score = number of distinct keywords of the category found in the text.
+    # Whole-word match avoids partial matches (e.g. "thấp" matching "hấp"),
+    # except for SUBSTRING_CATEGORIES.
+    found = set()
+    for kw, start in CATEGORY_MATCHER.iter_matches(text_lower):
+        for category, whole_word in CATEGORY_KEYWORD_INDEX[kw]:
+            if (category, kw) in found:
+                continue
+            if whole_word and not _at_word_boundaries(text_lower, start, start + len(kw)):
+                continue
+            found.add((category, kw))
+    
+    # Keep CATEGORY_KEYWORDS order so ties resolve to the first category
     scores = {}
-    for category, keywords in CATEGORY_KEYWORDS.items():
-        score = 0
-        for kw in keywords:
-            # Use regex word boundary to avoid partial matches (e.g. "thấp" matching "hấp")
-            # BUT for "Xăng xe", OCR often concatenates (e.g. "XăngRON95"), so use substring match
-            if category == "Xăng xe":
-                if kw.lower() in text_lower:
-                    score += 1
-            else:
-                pattern = r'\b' + re.escape(kw.lower()) + r'\b'
-                if re.search(pattern, text_lower):
-                    score += 1
-        
+    for category in CATEGORY_KEYWORDS:
+        score = sum(1 for c, _ in found if c == category)
         if score > 0:
             scores[category] = score
     
@@ -139,6 +259,7 @@ JUNK_TEXT_KEYWORDS = [
     'gtgt', 'rate)', 'amount)', 'rate%)', 'tên h', 'đơ n v', 's ố l', 
     'vị tính', 'sau thuế', 'chiết khấu', 'a b c'
 ]
+JUNK_TEXT_MATCHER = KeywordMatcher(JUNK_TEXT_KEYWORDS)
 
 # Keywords for detecting surcharge/fee items
 SURCHARGE_KEYWORDS = ['phụ thu', 'phí dịch vụ', 'phí phục vụ', 'service charge', 'surcharge']
@@ -153,7 +274,7 @@ def is_junk_text(text):
         return True
     if re.match(r'^[\d\s()=x+]+$', text):
         return True
-    if any(w in t for w in JUNK_TEXT_KEYWORDS):
+    if JUNK_TEXT_MATCHER.contains_any(t):
         return True
     if len(t) > 50 and sum(1 for c in t if c in '()') > 4:
         return True
@@ -204,66 +325,767 @@ def parse_vietnamese_number(value):
         return 0
 
 
-def ocr_pdf_to_text(pdf_source, filename=None):
+# ============ HEADER FIELD PATTERN REGISTRY ============
+# Regexes for the header/footer fields, compiled once at import and grouped per
+# field in priority order (more specific vendor formats first). Each group also
+# holds one combined regex of all its patterns: a single scan of the document
+# finds the first position where ANY format can match, so the per-pattern
+# searches start there - or are skipped entirely when the field is absent.
+# Per-pattern hit counters show which vendor formats match in production.
+
+class PatternGroup:
+    """Compiled, prioritized patterns for one field, with per-pattern hit counters."""
+
+    def __init__(self, name, patterns, flags=0):
+        self.name = name
+        self.patterns = []  # compiled regexes, in priority order
+        self.info = []      # extra tuple items per pattern (e.g. target column, group index)
+        for item in patterns:
+            pattern, info = (item[0], item[1:]) if isinstance(item, tuple) else (item, ())
+            self.patterns.append(re.compile(pattern, flags))
+            self.info.append(info)
+        self.hits = [0] * len(self.patterns)
+        self._any = re.compile("|".join(f"(?:{p.pattern})" for p in self.patterns), flags)
+
+    def _start(self, text):
+        """Position of the earliest match of any pattern, or None if none can match."""
+        m = self._any.search(text)
+        return m.start() if m else None
+
+    def record(self, index):
+        self.hits[index] += 1
+
+    def search(self, text):
+        """First pattern (by priority) that matches anywhere in text, like re.search per pattern."""
+        for index, match in self.searches(text):
+            self.record(index)
+            return match
+        return None
+
+    def searches(self, text):
+        """Yield (index, match) for every pattern that matches, in priority order. Caller records the winner."""
+        pos = self._start(text)
+        if pos is None:
+            return
+        for index, pattern in enumerate(self.patterns):
+            match = pattern.search(text, pos)
+            if match:
+                yield index, match
+
+    def finditer(self, text):
+        """Yield (index, matches) for every pattern with at least one match, in priority order."""
+        pos = self._start(text)
+        if pos is None:
+            return
+        for index, pattern in enumerate(self.patterns):
+            matches = list(pattern.finditer(text, pos))
+            if matches:
+                yield index, matches
+
+    def findall(self, text):
+        """Like finditer(), but with re.findall() results (group values instead of match objects)."""
+        pos = self._start(text)
+        if pos is None:
+            return
+        for index, pattern in enumerate(self.patterns):
+            matches = pattern.findall(text, pos)
+            if matches:
+                yield index, matches
+
+
+PATTERN_REGISTRY = {}
+
+
+def _register(name, patterns, flags=0):
+    group = PatternGroup(name, patterns, flags)
+    PATTERN_REGISTRY[name] = group
+    return group
+
+
+def pattern_hit_counts(reset=False):
+    """Snapshot of hit counters: {group_name: [hits per pattern]}. reset=True zeroes them afterwards."""
+    counts = {name: list(group.hits) for name, group in PATTERN_REGISTRY.items()}
+    if reset:
+        for group in PATTERN_REGISTRY.values():
+            group.hits = [0] * len(group.patterns)
+    return counts
+
+
+def merge_pattern_hits(counts):
+    """Add hit counters collected elsewhere (e.g. in a batch worker process)."""
+    for name, hits in counts.items():
+        group = PATTERN_REGISTRY.get(name)
+        if group:
+            for index, n in enumerate(hits):
+                group.hits[index] += n
+
+
+def pattern_hit_report():
+    """Rows of (group, index, hits, pattern) sorted by group then priority. hits == 0 marks dead patterns."""
+    return [(name, index, group.hits[index], pattern.pattern)
+            for name, group in PATTERN_REGISTRY.items()
+            for index, pattern in enumerate(group.patterns)]
+
+
+OCR_INVOICE_NO_PATTERNS = _register("ocr_invoice_no", [
+    r'[Ss][oố]\s*hóa\s*đơn[:\s]+(\d{5,})',
+    r'[Ss]ố\s*(?:HĐ)[:\s]*(\d+)',
+    r'[Ss][oố][:\s]+(\d{6,})',
+    r'[Nn]o\.?[:\s]*(\d{5,})',
+    r'[Ii]nvoice\s*[Nn]o\.?[:\s]*(\d+)',
+])
+
+OCR_TAX_CODE_PATTERNS = _register("ocr_tax_code", [
+    r'[Mm]a\s*số\s*thuế[:\s]*([\d\-\u00AD\s]+)',
+    r'MST[:\s]*([\d\-\u00AD\s]+)',
+    r'[Mm]ã\s*số\s*thuế[:\s]*([\d\-\u00AD\s]+)',
+    r'[Mm]a\s*s[eoc]\s*thu[eé][:\s]*([\d\-\u00AD\s]+)', # Handle "Ma sé thué"
+    r'[Mm]a\s*s.\s*thu.[:\s]*([\d\-\u00AD\s]+)',
+    r'tax\s*code[:\s]*([\d\-\u00AD\s]+)',
+])
+
+OCR_BEFORE_TAX_PATTERNS = _register("ocr_before_tax", [
+    r'ông\s*tiên\s*hàng[:\s]*([\d\.,]+)',        # "ông tiên hàng: 462.963"
+    r'ông\s*tiên\s*hang[:\s]*([\d\.,]+)',        # "ông tiên hang: 481.787"
+    r'[Cc]ộng\s*tiền\s*hàng[:\s]*([\d\.,]+)',
+    r'[Tt]iền\s*hàng[:\s]*([\d\.,]+)',
+])
+
+OCR_VAT_PATTERNS = _register("ocr_vat", [
+    r'lên\s*thuê\s*GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',   # "lên thuê GTGT (8% ) 38.543"
+    r'ién\s*thuê\s*GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',   # OCR variant
+    r'[Tt]iền\s*thuế\s*GTGT[:\s]*([\d\.,]+)',
+    r'thuê\s*GTGT\s*\(\s*8\s*%?\s*\)\s*([\d\.,]+)',
+    r'GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',
+    r'[Cc]XC[:\s]*([\d\.,]+)',
+    r'thuế\s*GTGT[:\s]*([\d\.,]+)',
+])
+
+OCR_TOTAL_PATTERNS = _register("ocr_total", [
+    r'ông\s*sô\s*tiên\s*thanh\s*toán[:\s]*([\d\.,]+)',        # "ông sô tiên thanh toán: 800.083"
+    r'[Tt]ổng\s*(?:số\s*)?(?:cộng|tiền)\s*thanh\s*toán[:\s]*([\d\.,]+)',
+    r'thanh\s*toán[:\s]*([\d\.,]+)',
+    r'[Tt]ổng\s*(?:cộng|tiền)[:\s]*([\d\.,]+)',
+])
+
+INVOICE_DATE_PATTERNS = _register("invoice_date", [
+    r'Ngày\s*(\d{1,2})\s*tháng\s*(\d{1,2})\s*năm\s*(\d{4})',
+    r'Ngày\s*(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4})',
+    r'(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4})',
+    # Multiline date matching with flexible noise skipping
+    # Allows up to 100 chars of any text (including newlines) between parts
+    r'Ngày[:\s]*(\d{1,2})[\s\S]{0,100}tháng[:\s]*(\d{1,2})[\s\S]{0,100}năm[:\s]*(\d{4})',
+    # Bilingual Date: Ngày (day) 19 tháng (month) 12 năm (year) 2025
+    r'Ngày(?:[^0-9]{0,35})?(\d{1,2})[\s\S]{0,35}tháng(?:[^0-9]{0,35})?(\d{1,2})[\s\S]{0,35}năm(?:[^0-9]{0,35})?(\d{4})'
+], re.IGNORECASE | re.DOTALL)
+
+INVOICE_NO_PATTERNS = _register("invoice_no", [
+    r'(\d{8})\nSố HĐ\s*/\s*Invoice No\.',  # C26MAP reverse: 00001348\nSố HĐ / Invoice No.:
+    r'Số HĐ\s*/\s*Invoice No\.?[:\s]*[\n\s]*(\d{5,})',  # C26MAP: Số HĐ / Invoice No.:\n00001348
+    r'Invoice No\.?[:\s]*[\n\s]*(\d{5,})',  # Generic Invoice No: 00001348
+    r'Số\s*\(No\.?\)[:\s]*(\d{5,})',  # M-INVOICE: Số(No.): 00007155 (at least 5 digits)
+    r'Số[/\s]*\(Invoice No\.?\)[:\s]*(\d+)',
+    r'\(RESTAURANT BILL\)\s*(\d+)',  # VNPT Restaurant: (RESTAURANT BILL) 00004501
+    r'Số:\s*(\d+)',  # Explicit colon: Số: 00007155
+    r'Số hóa đơn[:\s]*(\d+)',
+    r'Số\s*\(No\.?\)[:\s]*(\d+)',  # M-INVOICE with any digits
+    r's[éèẹẽe][: ]+\s*(\d+)',  # OCR typo: sé (Petrolimex)
+    r'S[óố][: ]+\s*(\d+)',  # OCR typo: Só/Số
+    # NOTE: Removed generic 'Số[:\s]+(\d+)' - too broad, matches addresses
+], re.IGNORECASE)
+
+SELLER_PATTERNS = _register("seller", [
+    r'Đơn vị bán hàng\s*\([Ss]eller\)[:\s]*(.+)',  # M-INVOICE format
+    r'Đơn vị bán\s*\([Ss]eller\)[:\s]*(.+)', # Standard
+    r'Đơn vị bán\s*\(Seller\)[:\s]*(.+)',  # Specific exact match
+    r'Tên người bán\s*\([Ss]eller\)[:\s]*(.+)',  # VNPT format
+    r'Đơn vị bán hàng\s*\([Cc]ompany\)[:\s]*(.+)',  # MISA variation
+    r'Đơn vị bán hàng[:\s]*(.+)',  # Simple format (Petrolimex)
+    r'Tên đơn vị bán hàng[:\s]*(.+)',
+    r'HỘ KINH DOANH[:\s]*(.+)',
+    r'QUÁN[:\s]*(.+)',
+    # NOTE: Removed 'Người bán' pattern - it captures 'Người bán hàng(Seller)' incorrectly
+])
+
+SERIAL_PATTERNS = _register("serial", [
+    r'Ký hiệu\s*/\s*Serial[:\s]*([A-Z0-9]+)',  # C26MAP: Ký hiệu / Serial: 1C26MAP
+    r'[KK]ý hiệu\s*/\s*\([Ss]erial(?:\s*No\.?)?\)[:\s]*([A-Z0-9]+)',  # Format with slash: Ký hiệu/ (Serial No)
+    r'[KK]ý hiệu\s*\([Ss]erial\)[:\s]*([A-Z0-9]+)',  # VNPT: Ký hiệu(Serial): 1K25THA
+    r'[KK]ý hiệu\s*\([Ss]erial(?:\s*No\.?)?\)[:\s]*([A-Z0-9]+)',  # M-INVOICE
+    r'[KK]ý hiệu\s*\([Ss]eries\)[:\s]*([A-Z0-9]+)',  # VNPT uses "Series"
+    r'[KK]ý hiệu[:\s]*([A-Z0-9]+)',
+    r'Mẫu số\s*-\s*[KK]ý hiệu[^:]*[:\s]*([A-Z0-9]+)',
+], re.IGNORECASE)
+
+LOOKUP_CODE_PATTERNS = _register("lookup_code", [
+    r'Mã tra cứu hoá đơn[:\s]*([A-Za-z0-9]+)',  # C26MAP: Mã tra cứu hoá đơn: 9751Opera19012026
+    r'Mã nhận hóa đơn\s*\([Cc]ode for checking\)[:\s]*([A-Z0-9]+)',  # Special case
+    r'Mã nhận hóa đơn[:\s]*([A-Za-z0-9]+)',  # Simple "Mã nhận hóa đơn: 5c57d33"
+    r'Mã tra cứu\s*\([Ll]ookup\s*code\)[:\s]*([A-Za-z0-9_]+)',  # VNPT: Mã tra cứu(Lookup code):HCM...
+    r'Mã tra cứu hóa đơn\s*\([Ii]nvoice code\)[:\s]*([A-Za-z0-9_]+)',  # MISA variation
+    r'Mã tra cứu(?:\s*HĐĐT)?(?:\s*này)?[:\s]*([A-Za-z0-9_]+)',
+    r'Mã tra cứu\(Invoice code\)[:\s]*([A-Za-z0-9_]+)',  # MISA no-space
+    r'Mã số bí mật[:\s]*([A-Za-z0-9_]+)',
+    r'Security Code\)[:\s]*([A-Z0-9]+)',
+    r'Mã tra cứu[:\s]*([A-Za-z0-9]+)',
+    r'[Ll]ookup\s*code[):\s]*([A-Za-z0-9]+)',
+    r'Ma tra cuu[:\s]*([A-Za-z0-9]+)', # Non-accented
+    r'Mã tra cứu\s*\([Cc]ode\)[:\s]*([A-Za-z0-9]+)', # K26THT: Mã tra cứu (Code): ...
+    r'với mã[:\s]*([A-Za-z0-9]+)', # C26MCX: lấy hóa đơn với mã: ...
+    r'nhập mã\s+([A-Za-z0-9]+)', # NEW: "nhập mã [CODE] để lấy hóa đơn"
+    r'provided code[^:]*[:\s]*([A-Za-z0-9]+)', # NEW: "provided code to get invoice: [CODE]"
+], re.IGNORECASE)
+
+TAX_CODE_PATTERNS = _register("tax_code", [
+    r'Mã số thuế\s*\([Tt]ax\s*code\)[:\s]*([\d\-\u00AD\s]+)',  # Added \s for spaced numbers
+    r'(?:MST|Mã số thuế)[/\s]*\([Tt]ax [Cc]ode\)[:\s]*([\d\-\u00AD\s]+)',
+    r'MST/CCCD[^:]*[:\s]*([\d\-\u00AD\s]+)',
+    r'(?:MST|Mã số thuế)[:\s]*([\d\-\u00AD\s]+)',
+], re.IGNORECASE)
+
+CQT_CODE_PATTERNS = _register("cqt_code", [
+    r'Mã\s*(?:của\s*)?[Cc]ơ quan thuế[:\s]*([A-Za-z0-9\-\u00AD]+)',  # M-INVOICE
+    r'Mã\s*(?:của\s*)?[Cc]ơ quan thuế\s*\([Tt]ax authority code\)[:\s]*([A-Za-z0-9\-\u00AD]+)',
+    r'Mã\s*CQT\s*\([Cc]ode\)[:\s]*([A-Za-z0-9\-\u00AD]+)',
+    r'Mã\s*CQT[:\s]*([A-Za-z0-9\-\u00AD]+)',
+    r'Tax authority code[:\s]*([A-Za-z0-9\-\u00AD]+)',
+], re.IGNORECASE)
+
+LOOKUP_LINK_PATTERNS = _register("lookup_link", [
+    r'Tra cứu hóa đơn tại\s*\([^)]+\)[:\s]*(https?://[^\s]+)',  # VNPT: Tra cứu hóa đơn tại (Lookup the invoice at):https://...
+    r'Tra cứu hóa đơn tại[:\s]*(https?://[^\s]+)',  # Simple format
+    r'(?:Tra cứu[^:]*tại|Trang tra cứu|website)[:\s]*(https?://[^\s]+)',
+    r'(https?://[^\s]*(?:tracuu|tra-cuu|invoice|vnpt-invoice|minvoice)[^\s]*)',
+    # Pattern for links without http/https (e.g. hoadon.pvoil.vn, tracuu.wininvoice.vn)
+    r'(?:Tra cứu[^:]*tại|Trang tra cứu|website)[:\s]*([a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:/[^\s]*)?)',
+], re.IGNORECASE)
+
+BEFORE_TAX_PATTERNS = _register("before_tax", [
+    r'Cộng tiền hàng\s*/\s*Total charges[:\s]*([\d\.,]+)',  # C26MAP: Cộng tiền hàng / Total charges: 6.615.000
+    r'Cộng tiền hàng[^:]*[:\s]*([\d\.,]+)',
+    r'Cộng ti[êề]n hàng[^:]*[:\s]*([\d\.,]+)', # OCR typo: tiên
+    r'Tổng tiền chưa thuế[^:]*[:\s]*([\d\.,]+)',  # M-INVOICE
+    r'Thành ti[êềẫ]n trước thuế[^:]*[:\s]*([\d\.,]+)', # OCR typo: tiễn
+    r'Amount before VAT[^:]*[:\s]*([\d\.,]+)',
+    r'Sub total[^:]*[:\s]*([\d\.,]+)',
+], re.IGNORECASE)
+
+VAT_AMOUNT_PATTERNS = _register("vat_amount", [
+    r'Tiền thuế GTGT\s*/\s*VAT[:\s]*([\d\.,]+)',  # C26MAP: Tiền thuế GTGT / VAT: 529.200
+    r'Tổng tiền thuế GTGT \d+%[:\s]*([\d\.,]+)', # Specific rate line
+    r'\|?Tiền thu[êế] GTGT\s*\(\s*\d+\s*%\s*\)\s*([\d\.,]+)', # MOST SPECIFIC: |Tiền thuê GTGT ( 8% ) 59.265
+    r'\|?Tiền thu[êế] GTGT[^:]*[:\s]+(\d[\d\.,]+)', # |Tiền thuê GTGT: 59.265
+    r'Tiền thuế\s*\(VAT\s*Amount\)[^:]*[:\s]*([\d\.,]+)',
+    r'Tổng tiền thuế[^:]*[:\s]*([\d\.,]+)',  # M-INVOICE
+    r'Tiền thu[êế] GTGT[^:]*[:\s]+(\d[\d\.,]+)', # OCR typo: thuê (ensure starts with digit)
+    r'VAT amount[^:]*[:\s]*([\d\.,]+)',
+    r'Cộng tiền thuế GTGT[^:]*[:\s]*([\d\.,]+)',
+], re.IGNORECASE)
+
+TAX_RATE_COLUMN_PATTERNS = _register("tax_rate_columns", [
+    # Sapo/MISA format: "Thuế suất 8%(VAT rate 8%): before tax total" - allow text after %
+    (r'Thuế suất\s*0\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 0%", 2),
+    (r'Thuế suất\s*5\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 2),
+    (r'Thuế suất\s*8\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 2),
+    (r'Thuế suất\s*10\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 2),
+    # Golden Gate 5-column format: "thuế suất khác... 8% before discount after_disc TAX total"
+    (r'Thuế suất\s*khác[^0-9\n]*8\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 4),
+    (r'Thuế suất\s*khác[^0-9\n]*10\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 4),
+    (r'Thuế suất\s*khác[^0-9\n]*5\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 4),
+    # M-Invoice format: "Tổng tiền chịu thuế suất... 8% before tax total"
+    (r'Tổng tiền chịu thuế suất[^:\n]*:\s*0\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 0%", 2),
+    (r'Tổng tiền chịu thuế suất[^:\n]*:\s*5\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 2),
+    (r'Tổng tiền chịu thuế suất[^:\n]*:\s*8\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 2),
+    (r'Tổng tiền chịu thuế suất[^:\n]*:\s*10\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 2),
+    # Format: "Thuế suất GTGT: 8%" (followed by tax amount or just standalone)
+    (r'Thuế suất(?:\s*GTGT)?[:\s]*8\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 8%", 1),
+    (r'Thuế suất(?:\s*GTGT)?[:\s]*10\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 10%", 1),
+    (r'Thuế suất(?:\s*GTGT)?[:\s]*5\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 5%", 1),
+    # Format: "Tiền thuế GTGT: ( 8% ) 37.037" (C26MCX)
+    (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*8\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 8%", 1),
+    (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*10\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 10%", 1),
+    (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*5\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 5%", 1),
+    # Format: "Tiền thuế ( 10% ): 154.545" (C26TKM) - no GTGT
+    (r'Tiền thuế[:\s]*[\(\[]?\s*10\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 10%", 1),
+    (r'Tiền thuế[:\s]*[\(\[]?\s*8\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 8%", 1),
+    (r'Tiền thuế[:\s]*[\(\[]?\s*5\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 5%", 1),
+    # Loose format: "Tiền thuế ... 10% ... amount"
+    (r'Tiền thuế[^%\d]*10\s*%.*?(\d[\d\.,]*)', "Thuế 10%", 1),
+    (r'Tiền thuế[^%\d]*8\s*%.*?(\d[\d\.,]*)', "Thuế 8%", 1),
+    (r'Tiền thuế[^%\d]*5\s*%.*?(\d[\d\.,]*)', "Thuế 5%", 1),
+], re.IGNORECASE)
+
+TAX_RATE_SIMPLE_PATTERNS = _register("tax_rate_simple", [
+    # "Tổng tiền thuế GTGT 8%: 17.592,59" format
+    (r'Tổng tiền thuế GTGT\s*0\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 0%"),
+    (r'Tổng tiền thuế GTGT\s*5\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 5%"),
+    (r'Tổng tiền thuế GTGT\s*8\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 8%"),
+    (r'Tổng tiền thuế GTGT\s*10\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 10%"),
+    # "Thuế GTGT (8%): amount" format
+    (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*0\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 0%"),
+    (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*5\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 5%"),
+    (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*8\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 8%"),
+    (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*10\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 10%"),
+    # "Tiền thuế GTGT ( 8% ) amount" format (OCR typo)
+    (r'Tiền thu[êế] GTGT\s*\(\s*0\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 0%"),
+    (r'Tiền thu[êế] GTGT\s*\(\s*5\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 5%"),
+    (r'Tiền thu[êế] GTGT\s*\(\s*8\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 8%"),
+    (r'Tiền thu[êế] GTGT\s*\(\s*10\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 10%"),
+], re.IGNORECASE)
+
+AFTER_TAX_PATTERNS = _register("after_tax", [
+    r'Tổng cộng\s*/\s*Total Amount[:\s]*([\d\.,]+)',  # C26MAP: Tổng cộng / Total Amount: 7.144.200
+    # Golden Gate 5-column FIRST (most specific): 5 numbers separated by spaces
+    r'Tổng cộng tiền thanh toán\s*\(Total amount\)\s*([\d\.,\s]+)', # Golden Gate: 5 numbers, take the last one
+    # 3-column patterns
+    r'Tổng cộng\s*\(Total amount\)\s*[:]\s*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # File 2025_812...
+    r'Tổng\s*cộng\s*\([Tt]otal\)?[:\s]*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # MISA: Tổng cộng(Total): 375.000 30.000 405.000
+    r'Tổngcộng[:\s]*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # No-space: Tổngcộng: 2.816.100 256.158 3.072.258
+    r'Tổng cộng\s*[:]\s*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # SAPO/EasyInvoice: Tổng cộng: [Before] [VAT] [Total]
+    r'Tổng tiền chịu thuế suất.*[:\s]*[\d\.,]*%\s+([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # M-INVOICE table summary
+    r'[Tt]ổng\s*tiền\s*thanh\s*toán\s*\([^)]+\)[:\s]*([\d\.,]+)',  # MISA: Tổng tiền thanh toán (Total amount): 1.800.000
+    r'[IT].{1,3}ng\s*số\s*ti[êề]n\s*thanh\s*toán[:\s]*([\d\.,]+)', # OCR typo: Iông, tiên (Petrolimex)
+    r'Cộng tiền hàng hóa, dịch vụ[:\s]*[\d\.,]+\s+[\d\.,]+\s+([\d\.,]+)', # File 1226-TK-200k (Total on next line)
+    r'[Tt]ổng\s*cộng\s*tiền\s*thanh\s*toán[^:]*[:\s]*([\d\.,]+)',
+    r'[Tt]otal\s*payment[^:]*[:\s]*([\d\.,]+)',
+    r'TỔNG CỘNG TIỀN THANH TOÁN[^:]*[:\s]*([\d\.,]+)',
+    r'Tổng cộng[:\s]+([\d\.,]+)\s+[\d\.,]+\s+([\d\.,]+)',  # Multi-page format
+    r'thuế suất:\s*\d+%\s+([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)',  # Tax rate line
+], re.IGNORECASE)
+
+
+# ============ ISSUER TEMPLATES ============
+# Invoices from the same issuing software share one layout. A template names
+# the text markers that identify that layout (all must be present) and, per
+# header field, the one or two patterns that read it exactly. When a template
+# matches, extract_header_fields() runs only those patterns instead of the whole
+# registry above plus its fallbacks. Template patterns are registered as
+# "<template>:<field>" so their hits show up in pattern_hit_report().
+
+# Set HOADON_TEMPLATES=0 to always use the generic pattern chain (e.g. to compare results)
+TEMPLATE_FAST_PATH = os.environ.get("HOADON_TEMPLATES", "1") != "0"
+
+# Template field -> data key. "tax_rate_columns" patterns have (?P<rate>) and (?P<tax>) groups.
+TEMPLATE_FIELDS = {
+    "invoice_date": "Ngày hóa đơn",
+    "invoice_no": "Số hóa đơn",
+    "serial": "Ký hiệu",
+    "seller": "Đơn vị bán",
+    "tax_code": "Mã số thuế",
+    "lookup_code": "Mã tra cứu",
+    "before_tax": "Số tiền trước Thuế",
+    "vat_amount": "Tiền thuế",
+    "tax_rate_columns": None,
+}
+
+
+class InvoiceTemplate:
     """
-    Use OCR to extract text from scanned PDF.
-    Returns extracted text or empty string if OCR fails.
+    Layout of one issuing software: identifying markers and a short pattern list
+    per field. Every listed field must match for the template result to be used.
+    :param seller_on_top: The seller is the company line above the first MST (no seller label)
+    """
+
+    def __init__(self, name, markers, fields, seller_on_top=False, flags=re.IGNORECASE):
+        self.name = name
+        self.markers = markers
+        self.seller_on_top = seller_on_top
+        self.fields = {field: _register(f"{name}:{field}", patterns, flags) for field, patterns in fields.items()}
+
+    def matches(self, text):
+        return all(marker in text for marker in self.markers)
+
+
+_DATE_VN = r'Ngày\s*(\d{1,2})\s*tháng\s*(\d{1,2})\s*năm\s*(\d{4})'
+_TAX_CODE_FIRST = r'Mã số thuế[:\s]*(\d[\d\-]{9,13})'
+
+INVOICE_TEMPLATES = [
+    # Opera hotel invoices: bilingual "label / Label" fields, invoice number on the next line
+    InvoiceTemplate("c26map", ["Số HĐ / Invoice No.", "Ký hiệu / Serial"], {
+        "invoice_date": [_DATE_VN],
+        "invoice_no": [r'(\d{8})\nSố HĐ\s*/\s*Invoice No\.', r'Số HĐ\s*/\s*Invoice No\.?[:\s]*[\n\s]*(\d{5,})'],
+        "serial": [r'Ký hiệu\s*/\s*Serial[:\s]*([A-Z0-9]+)'],
+        "tax_code": [_TAX_CODE_FIRST],
+        "lookup_code": [r'Mã tra cứu hoá đơn[:\s]*([A-Za-z0-9]+)'],
+        "before_tax": [r'Cộng tiền hàng\s*/\s*Total charges[:\s]*([\d\.,]+)'],
+        "vat_amount": [r'Tiền thuế GTGT\s*/\s*VAT[:\s]*([\d\.,]+)'],
+    }, seller_on_top=True),
+    # VNPT restaurant bill: number after "(RESTAURANT BILL)", bilingual date, spaced MST
+    InvoiceTemplate("vnpt_restaurant", ["(RESTAURANT BILL)", "Mã tra cứu(Lookup code)"], {
+        "invoice_date": [r'Ngày\s*\(date\)\s*(\d{1,2})\s*tháng\s*\(month\)\s*(\d{1,2})\s*năm\s*\(year\)\s*(\d{4})'],
+        "invoice_no": [r'\(RESTAURANT BILL\)\s*(\d+)'],
+        "serial": [r'Ký hiệu\s*\(Serial\)[:\s]*([A-Z0-9]+)'],
+        "seller": [r'Tên người bán\s*\(Seller\)[:\s]*(.+)'],
+        "tax_code": [r'Mã số thuế\s*\(Tax code\)[:\s]*(\d[\d \-]{9,30}\d)'],
+        "lookup_code": [r'Mã tra cứu\(Lookup code\)[:\s]*([A-Za-z0-9_]+)'],
+        "before_tax": [r'Cộng tiền hàng[:\s]*([\d\.,]+)'],
+        "vat_amount": [r'Tiền thuế GTGT\s*\(\s*\d+\s*%\s*\)\s*([\d\.,]+)'],
+        "tax_rate_columns": [r'Tiền thuế GTGT\s*\(\s*(?P<rate>0|5|8|10)\s*%\s*\)\s*(?P<tax>\d[\d\.,]*)'],
+    }),
+    # M-Invoice: "Đơn vị bán hàng (Seller)", per-rate summary "Tổng tiền chịu thuế suất: X% before tax total"
+    InvoiceTemplate("minvoice", ["Đơn vị bán hàng (Seller)", "Tổng tiền chịu thuế suất"], {
+        "invoice_date": [_DATE_VN],
+        "invoice_no": [r'Số\s*\(No\.?\)[:\s]*(\d{5,})'],
+        "serial": [r'Ký hiệu\s*\(Serial(?:\s*No\.?)?\)[:\s]*([A-Z0-9]+)'],
+        "seller": [r'Đơn vị bán hàng\s*\(Seller\)[:\s]*(.+)'],
+        "tax_code": [r'Mã số thuế\s*\(Tax code\)[:\s]*(\d[\d\-]{9,13})'],
+        "lookup_code": [r'Mã tra cứu[:\s]*([A-Za-z0-9_]+)'],
+        "before_tax": [r'Tổng tiền chưa thuế[^:]*[:\s]*([\d\.,]+)'],
+        "vat_amount": [r'Tổng tiền thuế[^:]*[:\s]*([\d\.,]+)'],
+        "tax_rate_columns": [r'Tổng tiền chịu thuế suất[^:\n]*:\s*(?P<rate>0|5|8|10)\s*%\s+\d[\d\.,]*\s+(?P<tax>\d[\d\.,]*)\s+\d[\d\.,]*'],
+    }),
+    # MISA meInvoice: seller on top, "(Invoice code)" lookup code, meinvoice.vn lookup link
+    InvoiceTemplate("misa", ["meinvoice.vn", "Mã tra cứu hóa đơn (Invoice code)"], {
+        "invoice_date": [_DATE_VN],
+        "invoice_no": [r'Số\s*\(No\.?\)[:\s]*(\d+)'],
+        "serial": [r'Ký hiệu\s*\(Serial\)[:\s]*([A-Z0-9]+)'],
+        "tax_code": [_TAX_CODE_FIRST],
+        "lookup_code": [r'Mã tra cứu hóa đơn\s*\(Invoice code\)[:\s]*([A-Za-z0-9_]+)'],
+        "before_tax": [r'Cộng tiền hàng[^:]*[:\s]*([\d\.,]+)'],
+        "vat_amount": [r'Tiền thuế GTGT\s*\(VAT amount\)[:\s]*([\d\.,]+)'],
+    }, seller_on_top=True),
+    # Golden Gate restaurants: 5-column rate summary "X% before discount after-discount tax total"
+    InvoiceTemplate("goldengate", ["Thuế suất khác", "Tổng cộng tiền thanh toán (Total amount)"], {
+        "invoice_date": [_DATE_VN],
+        "invoice_no": [r'Số\s*\(No\.?\)[:\s]*(\d+)'],
+        "serial": [r'Ký hiệu\s*\(Serial\)[:\s]*([A-Z0-9]+)'],
+        "tax_code": [_TAX_CODE_FIRST],
+        "lookup_code": [r'Mã tra cứu[:\s]*([A-Za-z0-9_]+)'],
+        "tax_rate_columns": [r'Thuế suất\s*khác[^0-9\n]*(?P<rate>0|5|8|10)\s*%\s+\d[\d\.,]*\s+\d[\d\.,]*\s+\d[\d\.,]*\s+(?P<tax>\d[\d\.,]*)\s+\d[\d\.,]*'],
+    }, seller_on_top=True),
+]
+
+
+def pdf_input(pdf_source):
+    """
+    A PDF source as a path (str) or bytes, the two forms every reader here takes.
+    A stream is read once (BytesIO.getvalue() shares its buffer); bytearray and
+    memoryview input is copied once into bytes.
+    """
+    if isinstance(pdf_source, (str, bytes)):
+        return pdf_source
+    if isinstance(pdf_source, (bytearray, memoryview)):
+        return bytes(pdf_source)
+    if hasattr(pdf_source, "getvalue"):
+        return pdf_source.getvalue()
+    pdf_source.seek(0)
+    pdf_bytes = pdf_source.read()
+    pdf_source.seek(0)  # Reset for potential future use
+    return pdf_bytes
+
+
+def is_xml_input(source):
+    """Whether a pdf_input() source is an XML document (.xml path, or bytes starting with '<') rather than a PDF."""
+    if isinstance(source, str):
+        return source.lower().endswith('.xml')
+    return source[:64].lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<')
+
+
+# ============ OCR ENGINES ============
+# An OCR engine turns a PIL image into text. "tesseract" runs the tesseract
+# command once per image (pytesseract), loading the vie+eng models every time.
+# "tesserocr" keeps up to OCR_WORKERS Tesseract API instances alive in this
+# process, each with the models loaded once, and lends them out per image.
+# get_ocr_engine() returns one engine shared by every caller in the process
+# (all OCR pages, all Streamlit sessions).
+
+OCR_LANG = 'vie+eng'
+OCR_PSM_RE = re.compile(r'--psm\s+(\d+)')
+
+
+class TesseractEngine:
+    """One tesseract subprocess per image (pytesseract)."""
+    name = "tesseract"
+
+    def image_to_string(self, image, config=""):
+        return pytesseract.image_to_string(image, lang=OCR_LANG, config=config)
+
+    def close(self):
+        pass
+
+
+def _tessdata_path():
+    """tessdata folder holding the OCR_LANG models, or None for tesserocr's built-in default."""
+    if os.environ.get("TESSDATA_PREFIX"):
+        return os.environ["TESSDATA_PREFIX"]
+    candidates = [
+        "/usr/share/tesseract-ocr/5/tessdata",
+        "/usr/share/tesseract-ocr/4.00/tessdata",
+        "/usr/share/tessdata",
+        "/usr/local/share/tessdata",
+        r"C:\Program Files\Tesseract-OCR\tessdata",
+    ]
+    for path in candidates:
+        if os.path.exists(os.path.join(path, "vie.traineddata")):
+            return path
+    return None
+
+
+class TesserocrEngine:
+    """
+    Pool of long-lived tesserocr.PyTessBaseAPI instances. Instances are created
+    on demand up to `size`; a thread takes an idle one for each image (waiting
+    if all are busy) and gives it back afterwards. Tesseract releases the GIL
+    while recognizing, so threads OCR in parallel.
+    """
+    name = "tesserocr"
+
+    def __init__(self, size=None, lang=OCR_LANG, path=None):
+        self.size = max(1, size or OCR_WORKERS)
+        self.lang = lang
+        self.path = path or _tessdata_path()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Load one instance now so a missing language fails here, not on the first page
+        self._idle.put(self._new_api())
+
+    def _new_api(self):
+        kwargs = {"path": self.path} if self.path else {}
+        api = tesserocr.PyTessBaseAPI(lang=self.lang, **kwargs)
+        self._created += 1
+        return api
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                return self._new_api()
+        return self._idle.get()
+
+    def image_to_string(self, image, config=""):
+        psm = OCR_PSM_RE.search(config)
+        api = self._acquire()
+        try:
+            api.SetPageSegMode(int(psm.group(1)) if psm else tesserocr.PSM.AUTO)
+            api.SetImage(image)
+            return api.GetUTF8Text()
+        finally:
+            api.Clear()
+            self._idle.put(api)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().End()
+            except queue.Empty:
+                break
+
+
+# Engine used for OCR (override with HOADON_OCR_ENGINE)
+OCR_ENGINE = os.environ.get("HOADON_OCR_ENGINE", "tesserocr" if TESSEROCR_AVAILABLE else "tesseract")
+_ocr_engine = None
+_ocr_engine_lock = threading.Lock()
+
+
+def get_ocr_engine():
+    """The process-wide OCR engine, created on first use; falls back to "tesseract" if tesserocr cannot start."""
+    global _ocr_engine
+    with _ocr_engine_lock:
+        if _ocr_engine is None:
+            if OCR_ENGINE == "tesserocr" and TESSEROCR_AVAILABLE:
+                try:
+                    _ocr_engine = TesserocrEngine()
+                except Exception as e:
+                    print(f"  tesserocr engine unavailable ({e}), using the tesseract command")
+            _ocr_engine = _ocr_engine or TesseractEngine()
+        return _ocr_engine
+
+
+# OCR settings: pages are rendered one at a time and OCR'd OCR_WORKERS at once.
+# Tesseract runs as a subprocess, so threads are enough to keep several cores busy,
+# and at most OCR_WORKERS page bitmaps are alive at any moment.
+# A page that is just one scanned image is not rendered at all: the embedded image
+# is OCRed at its own resolution (scaled down to the DPI asked for), unless that is
+# below OCR_MIN_IMAGE_DPI.
+OCR_DPI = 300
+OCR_MIN_IMAGE_DPI = 150
+# Scanned invoices are OCRed in tiers (ocr_invoice_fields): every page at
+# OCR_FAST_DPI first; only if OCR_REQUIRED_FIELDS are still missing, the page
+# regions holding them at OCR_DPI; and only if that is not enough either, the
+# rest of every page at OCR_DPI (region text is reused, so no part of a page is
+# OCRed twice at OCR_DPI).
+OCR_FAST_DPI = 200
+OCR_REQUIRED_FIELDS = ("Số hóa đơn", "Ngày hóa đơn", "Mã số thuế", "Tiền thuế", "Số tiền sau")
+# Region -> (page index, crop box as fractions (left, top, right, bottom), fields found there).
+# Boxes span the full page width: the full tier OCRs the horizontal bands between them.
+OCR_REGIONS = {
+    "header": (0, (0, 0, 1, 0.4), ("Số hóa đơn", "Ngày hóa đơn", "Mã số thuế")),
+    "totals": (-1, (0, 0.4, 1, 1), ("Tiền thuế", "Số tiền sau")),
+}
+# Cropped regions are a single block of text
+OCR_REGION_CONFIG = "--psm 6"
+# A page with fewer text characters than this (e.g. only a signature stamp over a
+# scanned image) is OCRed instead of read from its text layer
+OCR_PAGE_MIN_CHARS = 20
+OCR_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def _poppler_kwargs():
+    return {"poppler_path": POPPLER_PATH} if POPPLER_PATH else {}
+
+
+def _pdf_page_count(pdf):
+    if PDFIUM_AVAILABLE:
+        with PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(pdf)
+            page_count = len(doc)
+            doc.close()
+        return page_count
+    if isinstance(pdf, str):
+        return int(pdfinfo_from_path(pdf, **_poppler_kwargs())["Pages"])
+    return int(pdfinfo_from_bytes(pdf, **_poppler_kwargs())["Pages"])
+
+
+def _embedded_page_image(pdf, page_no):
+    """
+    (PIL image, DPI) of the scanned image of a page (1-based), taken from the PDF
+    without rendering: JPEG/JPEG 2000 streams are opened as stored (not decoded
+    yet), other images decoded at their own size. None if the page is not a
+    single upright image covering the page (anything else drawn on it would be
+    lost) or its resolution is too low for OCR; the page is rendered instead.
+    """
+    if not PDFIUM_AVAILABLE:
+        return None
+    with PDFIUM_LOCK:
+        doc = pdfium.PdfDocument(pdf)
+        try:
+            page = doc[page_no - 1]
+            if page.get_rotation():
+                return None
+            # Top level only: an image inside a form XObject has the form's transform on top of its own
+            objects = list(page.get_objects(max_depth=1))
+            if len(objects) != 1 or objects[0].type != pdfium_c.FPDF_PAGEOBJ_IMAGE:
+                return None
+            image = objects[0]
+            matrix = image.get_matrix()
+            if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+                return None  # Rotated or mirrored on the page
+            page_width, page_height = page.get_size()
+            left, bottom, right, top = image.get_bounds()
+            if (right - left) * (top - bottom) < 0.9 * page_width * page_height:
+                return None
+            px_width, _ = image.get_px_size()
+            image_dpi = px_width / ((right - left) / 72)
+            if image_dpi < OCR_MIN_IMAGE_DPI:
+                return None
+            if image.get_filters() in (["DCTDecode"], ["JPXDecode"]):
+                pil_image = Image.open(io.BytesIO(bytes(image.get_data(decode_simple=False))))
+            else:
+                pil_image = image.get_bitmap(render=False).to_pil()
+        finally:
+            doc.close()
+    return pil_image, image_dpi
+
+
+def _render_page(pdf, page_no, dpi):
+    """Render a page (1-based) to a grayscale PIL image: PDFium in memory, else poppler."""
+    if PDFIUM_AVAILABLE:
+        with PDFIUM_LOCK:
+            doc = pdfium.PdfDocument(pdf)
+            try:
+                return doc[page_no - 1].render(scale=dpi / 72, grayscale=True).to_pil()
+            finally:
+                doc.close()
+    kwargs = dict(dpi=dpi, first_page=page_no, last_page=page_no, grayscale=True, **_poppler_kwargs())
+    images = convert_from_path(pdf, **kwargs) if isinstance(pdf, str) else convert_from_bytes(pdf, **kwargs)
+    return images[0] if images else None
+
+
+def _page_image(pdf, page_no, dpi):
+    """A page (1-based) as an L/RGB PIL image of about `dpi`: the embedded scan image if possible, else rendered."""
+    embedded = _embedded_page_image(pdf, page_no)
+    if embedded is None:
+        return _render_page(pdf, page_no, dpi)
+    image, image_dpi = embedded
+    # The stored JPEG/JPX stream is decoded here, not later inside the OCR engine:
+    # a missing codec or a corrupt stream falls back to rendering the page
+    try:
+        if image_dpi > dpi * 1.1:
+            size = (round(image.width * dpi / image_dpi), round(image.height * dpi / image_dpi))
+            # JPEG: let the decoder scale down by 1/2, 1/4 or 1/8 instead of decoding full size
+            image.draft(image.mode if image.mode in ("L", "RGB") else "RGB", size)
+            image.load()
+            image = image.resize(size, Image.BILINEAR)
+        else:
+            image.load()
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+    except Exception as e:
+        print(f"  Embedded image of page {page_no} unreadable ({e}), rendering the page")
+        image.close()
+        return _render_page(pdf, page_no, dpi)
+    return image
+
+
+def _ocr_pdf_page(pdf, page_no, dpi=OCR_DPI, box=None, config=""):
+    """
+    OCR a single page (1-based), or the `box` of it given as fractions of the page
+    (left, top, right, bottom). Returns "" if the page fails.
+    """
+    try:
+        image = _page_image(pdf, page_no, dpi)
+        if image is None:
+            return ""
+        try:
+            if box:
+                left, top, right, bottom = box
+                image = image.crop((round(left * image.width), round(top * image.height),
+                                    round(right * image.width), round(bottom * image.height)))
+            return get_ocr_engine().image_to_string(image, config)
+        finally:
+            image.close()
+    except Exception as e:
+        print(f"  OCR error on page {page_no}: {e}")
+        return ""
+
+
+def _ocr_pdf(pdf, page_numbers=None, dpi=OCR_DPI):
+    """OCR pages (1-based, default: all) of a PDF path or bytes in a bounded thread pool; texts in the same order."""
+    if page_numbers is None:
+        page_numbers = range(1, _pdf_page_count(pdf) + 1)
+    with ThreadPoolExecutor(max_workers=max(1, min(OCR_WORKERS, len(page_numbers)))) as pool:
+        return list(pool.map(lambda page_no: _ocr_pdf_page(pdf, page_no, dpi), page_numbers))
+
+
+def ocr_pdf_pages(pdf_source, page_numbers=None):
+    """
+    OCR the given pages (1-based, default: all) of a PDF path, bytes or stream.
+    Returns one text per page, or [] if OCR is not available or fails.
     """
     if not OCR_AVAILABLE:
         print("  OCR not available (pytesseract/pdf2image not installed)")
-        return ""
+        return []
     
     try:
-        import tempfile
-        
-        # Convert PDF to images
-        if isinstance(pdf_source, str):
-            # File path - use directly
-            if POPPLER_PATH:
-                images = convert_from_path(pdf_source, dpi=300, poppler_path=POPPLER_PATH)
-            else:
-                images = convert_from_path(pdf_source, dpi=300)
-        else:
-            # BytesIO stream - save to temp file first
-            # IMPORTANT: Seek to beginning before reading
-            pdf_source.seek(0)
-            pdf_bytes = pdf_source.read()
-            pdf_source.seek(0)  # Reset for potential future use
-            
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-                tmp.write(pdf_bytes)
-                tmp_path = tmp.name
-            
-            try:
-                if POPPLER_PATH:
-                    images = convert_from_path(tmp_path, dpi=300, poppler_path=POPPLER_PATH)
-                else:
-                    images = convert_from_path(tmp_path, dpi=300)
-            finally:
-                os.unlink(tmp_path)  # Clean up temp file
-        
-        # OCR each page
-        full_text = ""
-        for i, image in enumerate(images):
-            text = pytesseract.image_to_string(image, lang='vie+eng')
-            full_text += text + "\n"
-        
-        return full_text
+        return _ocr_pdf(pdf_input(pdf_source), page_numbers)
     except Exception as e:
         print(f"  OCR error: {e}")
-        return ""
+        return []
+
+
+def ocr_pdf_to_text(pdf_source, filename=None):
+    """
+    Use OCR to extract text from scanned PDF.
+    Returns extracted text or empty string if OCR fails.
+    """
+    return "".join(text + "\n" for text in ocr_pdf_pages(pdf_source))
 
 
 def extract_ocr_invoice_fields(text, filename=None):
     """Extract invoice fields from OCR text (simpler patterns for OCR quality)."""
     data = {}
+    doc = Document(text)
+    text_lower = doc.lower
     
     # Debug: print relevant parts for money extraction
-    text_lower = text.lower()
     print(f"  OCR TEXT (looking for money patterns):")
     # Find and print lines with money-related keywords
-    for line in text.split('\n'):
-        line_lower = line.lower().strip()
+    for line, line_lower in zip(doc.lines, doc.lower_lines):
+        line_lower = line_lower.strip()
         if any(kw in line_lower for kw in ['tiền', 'tien', 'hang', 'hàng', 'thuế', 'thue', 'gtgt', 'cộng', 'cong', 'tổng', 'tong', 'thanh toán', 'thanh toan', 'cxc']):
             print(f"    >> {line.strip()}")
     
@@ -274,8 +1096,7 @@ def extract_ocr_invoice_fields(text, filename=None):
         
     # Đơn vị bán (Seller) - New for OCR
     seller_candidates = []
-    lines = text.split('\n')
-    for i, line in enumerate(lines[:15]): # Check first 15 lines
+    for i, line in enumerate(doc.lines[:15]): # Check first 15 lines
         line_clean = line.strip()
         # Common prefix for companies
         if re.match(r'^(CÔNG TY|CHI NHÁNH|DNTN|TRUNG TÂM|HỘ KINH DOANH|CỬA HÀNG)', line_clean, re.IGNORECASE):
@@ -295,20 +1116,12 @@ def extract_ocr_invoice_fields(text, filename=None):
         pass
     
     # Số hóa đơn - multiple patterns
-    inv_patterns = [
-        r'[Ss][oố]\s*hóa\s*đơn[:\s]+(\d{5,})',
-        r'[Ss]ố\s*(?:HĐ)[:\s]*(\d+)',
-        r'[Ss][oố][:\s]+(\d{6,})',
-        r'[Nn]o\.?[:\s]*(\d{5,})',
-        r'[Ii]nvoice\s*[Nn]o\.?[:\s]*(\d+)',
-    ]
-    for p in inv_patterns:
-        m = re.search(p, text)
-        if m:
-            num = m.group(1)
-            if not re.match(r'^(18|19|09|08|07|06|05|03|02|01)\d{6,}', num):
-                data["Số hóa đơn"] = num
-                break
+    for i, m in OCR_INVOICE_NO_PATTERNS.searches(text):
+        num = m.group(1)
+        if not re.match(r'^(18|19|09|08|07|06|05|03|02|01)\d{6,}', num):
+            data["Số hóa đơn"] = num
+            OCR_INVOICE_NO_PATTERNS.record(i)
+            break
     
     # Fallback: from filename
     if "Số hóa đơn" not in data and filename:
@@ -327,19 +1140,11 @@ def extract_ocr_invoice_fields(text, filename=None):
     
     # MST bên bán
     ignore_mst = ['0106869738', '0100684378', '0101245171', '0305482862', '0103243195', '0101360697']
-    mst_patterns = [
-        r'[Mm]a\s*số\s*thuế[:\s]*([\d\-\u00AD\s]+)',
-        r'MST[:\s]*([\d\-\u00AD\s]+)',
-        r'[Mm]ã\s*số\s*thuế[:\s]*([\d\-\u00AD\s]+)',
-        r'[Mm]a\s*s[eoc]\s*thu[eé][:\s]*([\d\-\u00AD\s]+)', # Handle "Ma sé thué"
-        r'[Mm]a\s*s.\s*thu.[:\s]*([\d\-\u00AD\s]+)',
-        r'tax\s*code[:\s]*([\d\-\u00AD\s]+)',
-    ]
     
     found_mst = None
-    for p in mst_patterns:
+    for i, matches in OCR_TAX_CODE_PATTERNS.finditer(text):
         if found_mst: break
-        for m in re.finditer(p, text):
+        for m in matches:
             raw_val = m.group(1)
             val = raw_val.replace(' ', '').replace('.', '').replace('-', '').replace('\u00AD', '').strip()
             # Valid length
@@ -350,11 +1155,9 @@ def extract_ocr_invoice_fields(text, filename=None):
                 print(f"  [OCR-MST] Ignored blacklisted: {val}")
                 continue
                 
-            # Check context (line content)
-            start = text.rfind('\n', 0, m.start()) + 1
-            end = text.find('\n', m.end())
-            if end == -1: end = len(text)
-            line_content = text[start:end].lower()
+            # Check context (the line(s) of the match)
+            first, last = doc.line_index(m.start()), doc.line_index(m.end())
+            line_content = '\n'.join(doc.lower_lines[first:last + 1])
             
             # Ignore context keywords (Provider or Buyer)
             if any(kw in line_content for kw in ['giải pháp', 'phần mềm', 'cung cấp bởi', 'phát hành bởi', 'created by', 'signature', 'ký bởi', 'bkav', 'ehoadon', 'mua hàng', 'người mua', 'đơn vị mua']):
@@ -364,6 +1167,7 @@ def extract_ocr_invoice_fields(text, filename=None):
             # Found a good one!
             found_mst = val
             data["Mã số thuế"] = found_mst
+            OCR_TAX_CODE_PATTERNS.record(i)
             print(f"  [OCR-MST] Accepted: {found_mst}")
             break
             
@@ -371,7 +1175,8 @@ def extract_ocr_invoice_fields(text, filename=None):
     # Based on log: "Ma sé thué: 0300555450" but regex above might miss due to spacing oddities.
     if not data.get("Mã số thuế"):
         # Just look for the specific sequence "Ma se thue" in normalized text
-        norm = text.lower().replace('é', 'e').replace('ú', 'u').replace('ế', 'e')
+        # Only the OCR typos; a full fold_text() would also match the "mã số thuế" lines rejected above
+        norm = text_lower.replace('é', 'e').replace('ú', 'u').replace('ế', 'e')
         # Matches: "ma se thue: 0300555450"
         m_ocr = re.search(r'(?:ma se thue|ma so thue|mst)[^0-9]*([0-9]{10,14})', norm)
         if m_ocr:
@@ -381,41 +1186,23 @@ def extract_ocr_invoice_fields(text, filename=None):
                  print(f"  [OCR-MST] Accepted via fallback: {cand}")
     
     # Số tiền trước thuế (Petrolimex specific patterns from cloud OCR)
-    before_patterns = [
-        r'ông\s*tiên\s*hàng[:\s]*([\d\.,]+)',        # "ông tiên hàng: 462.963"
-        r'ông\s*tiên\s*hang[:\s]*([\d\.,]+)',        # "ông tiên hang: 481.787"
-        r'[Cc]ộng\s*tiền\s*hàng[:\s]*([\d\.,]+)',
-        r'[Tt]iền\s*hàng[:\s]*([\d\.,]+)',
-    ]
-    for p in before_patterns:
-        m = re.search(p, text)
-        if m:
-            val = m.group(1).strip()
-            # Skip if looks like year (2025, 2026) or too short
-            if not re.match(r'^20[0-9]{2}$', val) and len(val) >= 3:
-                data["Số tiền trước Thuế"] = val
-                break
+    for i, m in OCR_BEFORE_TAX_PATTERNS.searches(text):
+        val = m.group(1).strip()
+        # Skip if looks like year (2025, 2026) or too short
+        if not re.match(r'^20[0-9]{2}$', val) and len(val) >= 3:
+            data["Số tiền trước Thuế"] = val
+            OCR_BEFORE_TAX_PATTERNS.record(i)
+            break
     
     # VAT (Petrolimex specific - from cloud OCR)
     # Pattern: "lên thuê GTGT (8% ) 38.543" or "lên thuê GTGT ( 8% )"
-    vat_patterns = [
-        r'lên\s*thuê\s*GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',   # "lên thuê GTGT (8% ) 38.543"
-        r'ién\s*thuê\s*GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',   # OCR variant
-        r'[Tt]iền\s*thuế\s*GTGT[:\s]*([\d\.,]+)',
-        r'thuê\s*GTGT\s*\(\s*8\s*%?\s*\)\s*([\d\.,]+)',
-        r'GTGT\s*\(\s*\d+\s*%?\s*\)\s*([\d\.,]+)',
-        r'[Cc]XC[:\s]*([\d\.,]+)',
-        r'thuế\s*GTGT[:\s]*([\d\.,]+)',
-    ]
-    for p in vat_patterns:
-        m = re.search(p, text)
-        if m:
-            data["Tiền thuế"] = m.group(1)
-            break
+    m = OCR_VAT_PATTERNS.search(text)
+    if m:
+        data["Tiền thuế"] = m.group(1)
     
     # Tax rate detection (Petrolimex uses 8%)
     # For gas stations, default to 8% VAT
-    if 'petrolimex' in text.lower() or 'xăng' in text.lower() or 'ron 95' in text.lower():
+    if 'petrolimex' in text_lower or 'xăng' in text_lower or 'ron 95' in text_lower:
         if data.get("Tiền thuế"):
             data["Thuế 8%"] = data["Tiền thuế"]
     elif re.search(r'8\s*%', text):
@@ -425,19 +1212,12 @@ def extract_ocr_invoice_fields(text, filename=None):
     
     # Tổng tiền sau thuế (Petrolimex specific - from cloud OCR)
     # Pattern: "ông sô tiên thanh toán: 800.083"
-    total_patterns = [
-        r'ông\s*sô\s*tiên\s*thanh\s*toán[:\s]*([\d\.,]+)',        # "ông sô tiên thanh toán: 800.083"
-        r'[Tt]ổng\s*(?:số\s*)?(?:cộng|tiền)\s*thanh\s*toán[:\s]*([\d\.,]+)',
-        r'thanh\s*toán[:\s]*([\d\.,]+)',
-        r'[Tt]ổng\s*(?:cộng|tiền)[:\s]*([\d\.,]+)',
-    ]
-    for p in total_patterns:
-        m = re.search(p, text)
-        if m:
-            val = m.group(1).strip()
-            if not re.match(r'^20[0-9]{2}$', val) and len(val) >= 3:
-                data["Số tiền sau"] = val
-                break
+    for i, m in OCR_TOTAL_PATTERNS.searches(text):
+        val = m.group(1).strip()
+        if not re.match(r'^20[0-9]{2}$', val) and len(val) >= 3:
+            data["Số tiền sau"] = val
+            OCR_TOTAL_PATTERNS.record(i)
+            break
     
     # Auto-calculate missing values (for Petrolimex 8% VAT)
     def parse_money(s):
@@ -478,7 +1258,7 @@ def extract_ocr_invoice_fields(text, filename=None):
         print(f"  [AUTO-CALC] Total = {before_tax} + {vat} = {total}")
     
     # If missing total but have before_tax (assume 8% VAT for Petrolimex)
-    elif not total and before_tax and 'petrolimex' in text.lower():
+    elif not total and before_tax and 'petrolimex' in text_lower:
         vat = int(round(before_tax * 0.08))
         total = before_tax + vat
         data["Số tiền sau"] = format_money(total)
@@ -487,7 +1267,7 @@ def extract_ocr_invoice_fields(text, filename=None):
         print(f"  [AUTO-CALC] VAT 8% = {vat}, Total = {total}")
     
     # If missing before_tax but have total (assume 8% VAT for Petrolimex)
-    elif not before_tax and total and 'petrolimex' in text.lower():
+    elif not before_tax and total and 'petrolimex' in text_lower:
         before_tax = int(round(total / 1.08))
         vat = total - before_tax
         data["Số tiền trước Thuế"] = format_money(before_tax)
@@ -511,7 +1291,7 @@ def extract_ocr_invoice_fields(text, filename=None):
             data["Thuế 10%"] = format_money(vat)
         elif rate == 0.05:
             data["Thuế 5%"] = format_money(vat)
-        elif 'petrolimex' in text.lower(): # Standardize Petrolimex to 8% if ambiguous
+        elif 'petrolimex' in text_lower: # Standardize Petrolimex to 8% if ambiguous
              data["Thuế 8%"] = format_money(vat)
         else:
              data["Thuế khác"] = format_money(vat)
@@ -538,18 +1318,240 @@ def extract_ocr_invoice_fields(text, filename=None):
     return data
 
 
-def extract_services_from_text(full_text):
-    """Extract service/product details with qty, unit_price, and amount."""
+def _missing_ocr_fields(data):
+    return [field for field in OCR_REQUIRED_FIELDS if not data.get(field)]
+
+
+def _fill_missing(data, more):
+    """Take the values of `more` for the fields `data` does not have yet."""
+    for key, val in more.items():
+        if val and not data.get(key):
+            data[key] = val
+
+
+def _uncovered_bands(bands):
+    """(top, bottom) page fractions not inside any of the given (top, bottom) bands, top to bottom."""
+    gaps, top = [], 0
+    for band_top, band_bottom in sorted(bands):
+        if band_top > top:
+            gaps.append((top, band_top))
+        top = max(top, band_bottom)
+    if top < 1:
+        gaps.append((top, 1))
+    return gaps
+
+
+def ocr_invoice_fields(pdf_source, filename=None):
+    """
+    Tiered OCR of a scanned invoice: all pages at OCR_FAST_DPI, then the
+    OCR_REGIONS of the fields still missing at OCR_DPI, then the rest of every
+    page at OCR_DPI (pages the regions already cover are not OCRed again).
+    Stops at the first tier after which no OCR_REQUIRED_FIELDS are missing.
+    Returns (fields, OCR text, names of the tiers run); ({}, "", tiers) if OCR
+    is not available or fails.
+    """
+    tiers = []
+    if not OCR_AVAILABLE:
+        print("  OCR not available (pytesseract/pdf2image not installed)")
+        return {}, "", tiers
+    try:
+        pdf = pdf_input(pdf_source)
+        page_numbers = list(range(1, _pdf_page_count(pdf) + 1))
+        tiers.append("fast")
+        text = "".join(t + "\n" for t in _ocr_pdf(pdf, page_numbers, OCR_FAST_DPI))
+        data = extract_ocr_invoice_fields(text, filename) if text.strip() else {}
+        missing = _missing_ocr_fields(data)
+        if not missing or not page_numbers:
+            return data, text, tiers
+
+        # Only the regions where the missing fields are printed, at full resolution
+        regions = [(name, page_numbers[page_index], box) for name, (page_index, box, fields) in OCR_REGIONS.items()
+                   if any(field in missing for field in fields)]
+        tiers.extend(name for name, _, _ in regions)
+        with ThreadPoolExecutor(max_workers=max(1, min(OCR_WORKERS, len(regions)))) as pool:
+            region_texts = list(pool.map(
+                lambda region: _ocr_pdf_page(pdf, region[1], OCR_DPI, region[2], OCR_REGION_CONFIG), regions))
+        region_text = "".join(t + "\n" for t in region_texts)
+        if region_text.strip():
+            _fill_missing(data, extract_ocr_invoice_fields(region_text, filename))
+            text += region_text
+        if not _missing_ocr_fields(data):
+            return data, text, tiers
+
+        # Still missing: the full-resolution full-page OCR of the single-pass mode wins.
+        # Region text stands in for its band; only the bands around it are OCRed.
+        tiers.append("full")
+        covered = {page_no: [] for page_no in page_numbers}  # page -> [(top, bottom)] of its regions
+        pieces = {page_no: [] for page_no in page_numbers}  # page -> [(top, text)]
+        for (_, page_no, box), region_page_text in zip(regions, region_texts):
+            covered[page_no].append((box[1], box[3]))
+            pieces[page_no].append((box[1], region_page_text))
+        parts = [(page_no, (0, top, 1, bottom) if bands else None)
+                 for page_no, bands in covered.items()
+                 for top, bottom in (_uncovered_bands(bands) if bands else [(0, 1)])]
+        with ThreadPoolExecutor(max_workers=max(1, min(OCR_WORKERS, len(parts)))) as pool:
+            part_texts = list(pool.map(lambda part: _ocr_pdf_page(pdf, part[0], OCR_DPI, part[1]), parts))
+        for (page_no, box), part_text in zip(parts, part_texts):
+            pieces[page_no].append((box[1] if box else 0, part_text))
+        full_text = "".join(t + "\n" for page_no in page_numbers for _, t in sorted(pieces[page_no]))
+        if not full_text.strip():
+            return data, text, tiers
+        full_data = extract_ocr_invoice_fields(full_text, filename)
+        _fill_missing(full_data, data)
+        return full_data, full_text + text, tiers
+    except Exception as e:
+        print(f"  OCR error: {e}")
+        return {}, "", tiers
+
+
+# ============ LINE TOKENIZER ============
+# extract_services_from_text() looks at each text line several times: as an item
+# candidate and as the previous/next line of up to five neighbouring items.
+# Each line is split once into typed tokens and the facts the item parser and the
+# multi-line merge need are derived from that, instead of re-parsing the string.
+
+LINE_STT_RE = re.compile(r'^(\d{1,3})[._\-\s|]+')  # Leading STT: "1 ", "1.", "1|"
+LINE_NUMBER_RE = re.compile(r'\d+(?:[.,]\d+)*')
+LINE_STT_TOKEN_RE = re.compile(r'\d{1,3}[._\-|]*')
+LINE_DATE_TOKEN_RE = re.compile(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}')
+LINE_PERCENT_TOKEN_RE = re.compile(r'\d+(?:[.,]\d+)?%')
+LINE_DIGIT_RE = re.compile(r'\d')
+# Units of 3+ chars, longest first, for stripping a unit glued to the end of a name ("Nấm(PHẦN")
+LONG_UNIT_SUFFIXES = tuple(sorted((u for u in COMMON_UNITS if len(u) >= 3), key=lambda u: (-len(u), u)))
+LINE_MERGE_STOP_WORDS = ['cộng tiền', 'tổng cộng', 'thuế', 'thành tiền']
+VIETNAMESE_DIACRITIC_RE = re.compile(r'[àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ]', re.IGNORECASE)
+
+
+@lru_cache(maxsize=65536)
+def classify_token(token):
+    """
+    Token kind: 'unit', 'date', 'percent', 'number', 'code' (text mixed with digits,
+    e.g. "63A", "330ml") or 'word'. Returns (kind, has_digit).
+    Cached: item tables repeat the same units, dish names and prices on every line.
+    """
+    if token.upper() in COMMON_UNITS:
+        return 'unit', bool(LINE_DIGIT_RE.search(token))  # M2, M3 contain digits
+    if LINE_NUMBER_RE.fullmatch(token):
+        return 'number', True
+    if LINE_DATE_TOKEN_RE.fullmatch(token):
+        return 'date', True
+    if LINE_PERCENT_TOKEN_RE.fullmatch(token):
+        return 'percent', True
+    if LINE_DIGIT_RE.search(token):
+        return 'code', True
+    return 'word', False
+
+
+class TokenizedLine:
+    """
+    A stripped text line split once into whitespace tokens with their kinds
+    (see classify_token; the leading STT token has kind 'stt'), plus the cached
+    checks used when merging it into a neighbouring item.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.words = text.split()
+        stt_match = LINE_STT_RE.match(text)
+        self.stt = stt_match.group(1) if stt_match else None
+        self.stt_end = stt_match.end() if stt_match else 0
+
+    @cached_property
+    def kinds(self):
+        """(kind, has_digit) per word."""
+        kinds = [classify_token(w) for w in self.words]
+        if self.stt and LINE_STT_TOKEN_RE.fullmatch(self.words[0]):
+            kinds[0] = ('stt', True)
+        return kinds
+
+    @cached_property
+    def numbers(self):
+        """Number runs in the line as (text, offset)."""
+        return [(m.group(), m.start()) for m in LINE_NUMBER_RE.finditer(self.text)]
+
+    @cached_property
+    def prev_merge_text(self):
+        """Text to prepend when this line precedes an item whose name is incomplete, or None to stop merging."""
+        line = self.text
+        if len(line) < 2:
+            return None
+        if self.stt:
+            # An STT line with only text (no other numbers) is a name prefix; with prices it is a separate item
+            line = line[self.stt_end:].strip()
+            if LINE_DIGIT_RE.search(line):
+                return None
+        if is_junk_text(line):
+            return None
+
+        # Only count "price-like" numbers (with comma/period separators) or several long
+        # numbers as stop conditions; dates and codes like "63A 17235" (vehicle plates) pass
+        temp_line = re.sub(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}', '', line)
+        if re.search(r'\d{1,3}(?:[.,]\d{3})+(?:[.,]\d{2})?', temp_line) or len(re.findall(r'\b\d{4,}\b', temp_line)) > 1:
+            return None
+        if any(x in line.lower() for x in LINE_MERGE_STOP_WORDS):
+            return None
+
+        # STOP if the line looks like the TAIL of a previous item
+        if (line.endswith(')') or line.endswith('）')) and re.search(r'[a-zA-Z]', line):
+            if '(' not in line and '（' not in line:
+                return None
+        return line
+
+    @cached_property
+    def is_next_merge_candidate(self):
+        """Whether this line may be appended to the item above it (STT, junk, numbers and totals stop the merge)."""
+        line = self.text
+        if len(line) < 2 or self.stt:
+            return False
+        if is_junk_text(line):
+            return False
+        # Remove date patterns before counting numbers
+        temp_next = re.sub(r'\d{1,2}\s*[/-]\s*\d{1,2}\s*[/-]\s*\d{2,4}', '', line)
+        if len(LINE_NUMBER_RE.findall(temp_next)) > 1:
+            return False
+        return not any(x in line.lower() for x in LINE_MERGE_STOP_WORDS)
+
+    @cached_property
+    def starts_new_item(self):
+        """Capitalized Vietnamese text: the start of another item rather than a name continuation."""
+        line = self.text
+        return line[0].isupper() and line[0] != '(' and bool(VIETNAMESE_DIACRITIC_RE.search(line))
+
+    @cached_property
+    def is_paren_suffix(self):
+        """A "(English name)" or "(từ ngày ...)" line that belongs to the item above."""
+        line = self.text
+        if not line.startswith('('):
+            return False
+        return bool(re.search(r'[a-zA-Z]', line) or re.search(r'(ngày|từ|đến|tháng|năm)', line, re.IGNORECASE))
+
+
+def extract_services_from_text(doc):
+    """
+    Extract service/product details with qty, unit_price, and amount.
+    :param doc: Document (or cleaned text) of the invoice
+    """
+    doc = as_document(doc)
     services = []
-    lines = full_text.split('\n')
+    lines = doc.lines
+    tokenized = [None] * len(lines)
 
-    for line_idx, line in enumerate(lines):
-        line = line.strip()
-        if not line:
+    def line_at(idx):
+        # Tokenized on first use, then shared: a line is read as an item candidate
+        # and again as the previous/next line of neighbouring items
+        if tokenized[idx] is None:
+            tokenized[idx] = TokenizedLine(lines[idx].strip())
+        return tokenized[idx]
+
+    # Only lines inside the goods tables can start an item; neighbours outside still merge into names
+    for line_idx in doc.table_lines():
+        tline = line_at(line_idx)
+        line = tline.text
+        words = tline.words
+        if not words:
             continue
             
-        first_token = line.split()[0] if line.split() else ""
-        if not first_token.isdigit():
+        if not words[0].isdigit():
             continue
             
         # Ignore column headers "1 2 3 4 5"
@@ -557,16 +1559,14 @@ def extract_services_from_text(full_text):
         if re.match(r'^[A-Z\s]+[\d\s=x]+$', line): continue
              
         # Must start with number (1-3 digits) - STT
-        match_start = re.match(r'^(\d{1,3})[._\-\s|]+', line)
-        if not match_start: continue
+        if not tline.stt: continue
         
         # Find all number blocks
-        num_pattern = r'(\d+(?:[.,]\d+)*)'
-        all_nums = list(re.finditer(num_pattern, line))
+        all_nums = tline.numbers
         
         if len(all_nums) < 3:  # Need at least STT + qty + amount
             # Exception: surcharge items may have only STT + amount (2 numbers)
-            line_lower = line.lower()
+            line_lower = doc.lower_lines[line_idx]
             is_surcharge_line = any(kw in line_lower for kw in SURCHARGE_KEYWORDS)
             if not (is_surcharge_line and len(all_nums) == 2):
                 continue
@@ -577,61 +1577,45 @@ def extract_services_from_text(full_text):
         if rate_match:
             tax_rate = rate_match.group(1)
         
-        stt_end = len(match_start.group(0))
+        stt_end = tline.stt_end
         
         # Strategy: Find the LAST UNIT word (from COMMON_UNITS) that is followed by numbers
         # This handles cases where unit words appear in description (like "từ ngày 15/12")
-        
-        tokens = line.split()
-        
-        line_after_stt = line[stt_end:]
         unit_idx = -1  # index of unit word in tokens
         
-        # Find LAST unit word that has numbers after it
-        for i in range(len(tokens) - 1, -1, -1):  # iterate backwards
-            tok = tokens[i]
+        # Find LAST unit word that has numbers after it (single backwards pass)
+        numbers_after = False
+        for i in range(len(words) - 1, -1, -1):  # iterate backwards
+            kind, has_digit = tline.kinds[i]
             # Ignore THANH as unit (usually start of name like Thanh long)
-            if tok.upper() in COMMON_UNITS and tok.upper() != 'THANH':
-                # Check if there are numbers after this position
-                remaining = ' '.join(tokens[i+1:])
-                if re.search(r'\d+(?:[.,]\d+)*', remaining):
-                    unit_idx = i
-                    break
+            if numbers_after and kind == 'unit' and words[i].upper() != 'THANH':
+                unit_idx = i
+                break
+            numbers_after = numbers_after or has_digit
         
         if unit_idx == -1:
             # No unit found - find name boundary by looking for first "price-like" number
             # A price typically has 4+ digits or contains decimal separator
-            nums_after_stt = [m for m in all_nums if m.start() > stt_end]
+            nums_after_stt = [num for num in all_nums if num[1] > stt_end]
             
             # Find first number that looks like a price (>= 1000 or has comma/dot)
             name_end_pos = len(line)
-            for m in nums_after_stt:
-                num_str = m.group(1)
+            for num_str, num_start in nums_after_stt:
                 # Check if it's a price number: contains . or , separator OR is >= 4 digits
                 if '.' in num_str or ',' in num_str or len(num_str.replace('.', '').replace(',', '')) >= 4:
-                    name_end_pos = m.start()
+                    name_end_pos = num_start
                     break
             
             if name_end_pos <= stt_end:
                 continue
             name_part = line[stt_end:name_end_pos].strip()
-            nums = [m.group(1) for m in nums_after_stt]
+            nums = [num_str for num_str, _ in nums_after_stt]
         else:
-            # Unit found - take name as tokens before unit, numbers after unit
-            name_tokens = tokens[:unit_idx]
-            
-            # Special case: if the last token before unit is a 4-digit year (e.g., "2025"), include it in name
-            # This handles cases like "tháng 11 năm 2025 Tháng 1 1.260.000"
-            if unit_idx > 0 and re.match(r'^\d{4}$', tokens[unit_idx - 1]):
-                # Keep the year in name, effectively making unit_idx point to one position after
-                pass  # name_tokens already includes the year since it's tokens[:unit_idx]
-            
-            # Instead of offset calculation which is error-prone, just take tokens after unit
-            remaining_tokens = tokens[unit_idx+1:]
-            remaining_text = " ".join(remaining_tokens)
-            
-            nums_iter = re.finditer(r'(\d+(?:[.,]\d+)*)', remaining_text)
-            nums = [m.group(1) for m in nums_iter]
+            # Unit found - take name as tokens before unit (a 4-digit year right before
+            # the unit stays in the name: "tháng 11 năm 2025 Tháng 1 1.260.000"),
+            # numbers from the tokens after the unit
+            name_tokens = words[:unit_idx]
+            nums = LINE_NUMBER_RE.findall(" ".join(words[unit_idx+1:]))
             
             if len(nums) < 2:
                 # Check if it's a surcharge item before skipping
@@ -670,10 +1654,12 @@ def extract_services_from_text(full_text):
                 tokens[0] = first[1:].strip()
             # Clean last token if it ends with LONG unit (3+ chars) to avoid cutting "Nấm" -> "Nấ"
             last = tokens[-1] if tokens else ''
-            for unit in COMMON_UNITS:
-                if len(unit) >= 3 and last.upper().endswith(unit) and len(last) > len(unit):
-                    tokens[-1] = last[:-len(unit)].rstrip('（(')
-                    break
+            last_upper = last.upper()
+            if last_upper.endswith(LONG_UNIT_SUFFIXES):
+                for unit in LONG_UNIT_SUFFIXES:
+                    if last_upper.endswith(unit) and len(last) > len(unit):
+                        tokens[-1] = last[:-len(unit)].rstrip('（(')
+                        break
             # Clean tokens that are JUST unit+bracket like "Phần）" or "Phần)"
             # Only remove if it's strictly unit+bracket, to avoid removing "Nửa phần）"
             # Clean tokens that are JUST unit+bracket like "Phần）" or "Phần)" removal logic removed 
@@ -683,7 +1669,7 @@ def extract_services_from_text(full_text):
         
         # Remove STT from the start of name_part if detected
         # This prevents cases like "4 Phần" becoming "Đậu phụ... 4 Phần" after merge
-        stt_val = match_start.group(1)
+        stt_val = tline.stt
         if name_part.startswith(stt_val):
              name_part = name_part[len(stt_val):].strip()
         
@@ -705,44 +1691,10 @@ def extract_services_from_text(full_text):
             prev_parts = []
             for offset in range(1, 3):  # Check up to 2 lines back
                 if line_idx - offset >= 0:
-                    prev_line = lines[line_idx - offset].strip()
-                    
-                    # Stop if: empty, STT line, junk, or has too many numbers
-                    if not prev_line or len(prev_line) < 2:
+                    # Stop if: empty, STT line with prices, junk, or has too many numbers
+                    prev_line = line_at(line_idx - offset).prev_merge_text
+                    if prev_line is None:
                         break
-                    match_stt = re.match(r'^(\d{1,3})[._\-\s|]+', prev_line)
-                    if match_stt:
-                         # If STT line contains ONLY STT and text (no other numbers), merge it
-                         stt_len = len(match_stt.group(0))
-                         rest_of_line = prev_line[stt_len:].strip()
-                         
-                         # Check if remaining part has numbers (likely prices) -> then it's a separate item -> Break
-                         if re.search(r'\d', rest_of_line):
-                             break
-                             
-                         # If valid text, use it (strip STT)
-                         prev_line = rest_of_line
-                    if is_junk_text(prev_line):
-                        break
-                        
-                    # Check nums, but allow dates (DD/MM/YYYY or DD-MM-YYYY)
-                    # Remove dates from line before counting nums
-                    temp_line = re.sub(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}', '', prev_line)
-                    
-                    # Only count "price-like" numbers (with comma/period separators) as stop conditions
-                    # This allows alphanumeric codes like "63A 17235" (vehicle plates) to pass through
-                    price_nums = re.findall(r'\d{1,3}(?:[.,]\d{3})+(?:[.,]\d{2})?', temp_line)
-                    simple_nums = re.findall(r'\b\d{4,}\b', temp_line)  # Long standalone numbers (4+ digits)
-                    
-                    if price_nums or len(simple_nums) > 1:
-                        break
-                    if any(x in prev_line.lower() for x in ['cộng tiền', 'tổng cộng', 'thuế', 'thành tiền']):
-                        break
-                    
-                    # STOP if prev_line looks like the TAIL of a previous item
-                    if (prev_line.endswith(')') or prev_line.endswith('）')) and re.search(r'[a-zA-Z]', prev_line):
-                        if '(' not in prev_line and '（' not in prev_line: 
-                            break
                     
                     # STOP merging if we hit an English paren line that precedes a Vietnamese line
                     # Case Item 7: "Thêm cơm trắng" (collected) <-- "(Sichuan tofu)" (checking). Stop.
@@ -765,13 +1717,7 @@ def extract_services_from_text(full_text):
         last_char = name_part[-1] if name_part else ''
         
         # Detect if next line is a parenthetical suffix
-        next_line_is_suffix = False
-        if line_idx >= 0 and line_idx + 1 < len(lines):
-            peek_line = lines[line_idx + 1].strip()
-            if peek_line.startswith('(') and re.search(r'[a-zA-Z]', peek_line):
-                next_line_is_suffix = True
-            elif peek_line.startswith('(') and re.search(r'(ngày|từ|đến|tháng|năm)', peek_line, re.IGNORECASE):
-                next_line_is_suffix = True
+        next_line_is_suffix = line_idx + 1 < len(lines) and line_at(line_idx + 1).is_paren_suffix
 
         has_unclosed_paren = (name_part.count('(') > name_part.count(')')) or (name_part.count('（') > name_part.count('）'))
         
@@ -786,30 +1732,19 @@ def extract_services_from_text(full_text):
         if needs_next:
             next_parts = []
             for offset in range(1, 4):  # Check up to 3 lines ahead
-                if line_idx >= 0 and line_idx + offset < len(lines):
-                    next_line = lines[line_idx + offset].strip()
+                if line_idx + offset < len(lines):
+                    next_tline = line_at(line_idx + offset)
+                    next_line = next_tline.text
                     
                     # Stop if: empty, STT line, junk, or has too many numbers
-                    if not next_line or len(next_line) < 2:
-                        break
-                    if re.match(r'^\d{1,3}[._\-\s|]+', next_line):
-                        break
-                    if is_junk_text(next_line):
-                        break
-                    # Remove date patterns before counting numbers
-                    temp_next = re.sub(r'\d{1,2}\s*[/-]\s*\d{1,2}\s*[/-]\s*\d{2,4}', '', next_line)
-                    nums_in_next = re.findall(r'\d+(?:[.,]\d+)*', temp_next)
-                    if len(nums_in_next) > 1:
-                        break
-                    if any(x in next_line.lower() for x in ['cộng tiền', 'tổng cộng', 'thuế', 'thành tiền']):
+                    if not next_tline.is_next_merge_candidate:
                         break
                     
                     # STOP if next_line starts a new item (Vietnamese text, not closing paren)
-                    if next_line[0].isupper() and next_line[0] != '(':
+                    if next_tline.starts_new_item:
                         matches_closing_paren = has_unclosed_paren and ('）' in next_line or ')' in next_line)
                         if not matches_closing_paren:
-                            if re.search(r'[àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ]', next_line, re.IGNORECASE):
-                                break
+                            break
                     
                     next_parts.append(next_line)
                 else:
@@ -961,58 +1896,391 @@ def extract_services_from_text(full_text):
 
     return services
 
-def extract_invoice_data(pdf_source, filename=None):
+
+# ============ STAGE TRACING ============
+# extract_invoice_data(..., trace=ExtractionTrace()) records one span per stage
+# with wall and CPU time plus what the stage saw: page count, text length, line
+# items found, which header patterns matched. Batch results carry the trace as a
+# dict (BatchResult.trace) so slow files can be logged and aggregated.
+
+class ExtractionTrace:
+    """Spans of one extract_invoice_data() call, in the order the stages ran."""
+
+    def __init__(self):
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """Time the with-block; the yielded dict takes extra attributes for the span."""
+        span = dict(stage=stage, **attrs)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = type(e).__name__
+            raise
+        finally:
+            span["wall_ms"] = round((time.perf_counter() - wall) * 1000, 2)
+            span["cpu_ms"] = round((time.process_time() - cpu) * 1000, 2)
+            self.spans.append(span)
+
+    def to_dict(self):
+        return {
+            "wall_ms": round(sum(span["wall_ms"] for span in self.spans), 2),
+            "cpu_ms": round(sum(span["cpu_ms"] for span in self.spans), 2),
+            "spans": self.spans,
+        }
+
+
+def _matched_patterns(before):
+    """{group: [pattern indexes]} recorded since the pattern_hit_counts() snapshot `before`."""
+    matched = {}
+    for name, group in PATTERN_REGISTRY.items():
+        indexes = [i for i, (old, new) in enumerate(zip(before[name], group.hits)) if new > old]
+        if indexes:
+            matched[name] = indexes
+    return matched
+
+
+# ============ PDF TEXT BACKENDS ============
+# A backend turns a PDF path or stream into one text per page (None for scanned
+# pages). "pdfplumber" is the reference: pdfminer parses the page and pdfplumber
+# groups its characters into lines. "pdfium" reads the characters with PDFium
+# (several times faster) and hands them to the same pdfplumber line grouping, so
+# the text should be identical. backend_parity.py compares the extracted fields
+# of two backends on a folder of invoices before the default is switched.
+
+def _pdfplumber_pages(pdf_source, page_words=None):
+    if isinstance(pdf_source, bytes):
+        pdf_source = io.BytesIO(pdf_source)  # Shares the bytes, no copy
+    page_texts = []
+    with pdfplumber.open(pdf_source) as pdf:
+        for page in pdf.pages:
+            if len(page.chars) < OCR_PAGE_MIN_CHARS and (page.images or page.curves):
+                page_texts.append(None)
+                if page_words is not None:
+                    page_words.append(None)
+            else:
+                page_texts.append(page.extract_text() or "")
+                if page_words is not None:
+                    page_words.append(page.extract_words())
+    return page_texts
+
+
+# Character codes PDFium reports that pdfminer does not: line breaks, soft
+# hyphen markers, and "no Unicode mapping"
+_PDFIUM_SKIP_CODES = {0, 2, 10, 13, 0xFFFE, 0xFFFF}
+
+
+def _pdfium_chars(textpage, page_height):
+    """Characters of a PDFium text page as pdfplumber-style dicts (top-left origin)."""
+    chars = []
+    box = pdfium_c.FS_RECTF()
+    matrix = pdfium_c.FS_MATRIX()
+    for i in range(textpage.count_chars()):
+        # Skip the spaces and line breaks PDFium inserts between text runs
+        if pdfium_c.FPDFText_IsGenerated(textpage.raw, i) == 1:
+            continue
+        code = pdfium_c.FPDFText_GetUnicode(textpage.raw, i)
+        if code in _PDFIUM_SKIP_CODES:
+            continue
+        # Font-based box (ascent to descent), like pdfminer's, not the glyph outline
+        pdfium_c.FPDFText_GetLooseCharBox(textpage.raw, i, box)
+        pdfium_c.FPDFText_GetMatrix(textpage.raw, i, matrix)
+        top = page_height - box.top
+        bottom = page_height - box.bottom
+        chars.append({
+            "text": chr(code),
+            "x0": box.left,
+            "x1": box.right,
+            "top": top,
+            "bottom": bottom,
+            "doctop": top,
+            "width": box.right - box.left,
+            "height": bottom - top,
+            # Same rule as pdfminer's LTChar.upright
+            "upright": matrix.a * matrix.d > 0 and matrix.b * matrix.c <= 0,
+        })
+    return chars
+
+
+def _pdfium_subpaths(path_obj):
+    """Subpaths of a PDFium path object as pdfminer-style shapes: ("mlllh", [points]); "h" repeats the start point."""
+    subpaths = []
+    point_x, point_y = ctypes.c_float(), ctypes.c_float()
+    for i in range(pdfium_c.FPDFPath_CountSegments(path_obj.raw)):
+        segment = pdfium_c.FPDFPath_GetPathSegment(path_obj.raw, i)
+        kind = pdfium_c.FPDFPathSegment_GetType(segment)
+        pdfium_c.FPDFPathSegment_GetPoint(segment, point_x, point_y)
+        point = (point_x.value, point_y.value)
+        if kind == pdfium_c.FPDF_SEGMENT_MOVETO or not subpaths:
+            subpaths.append(["m", [point]])
+        else:
+            subpaths[-1][0] += "c" if kind == pdfium_c.FPDF_SEGMENT_BEZIERTO else "l"
+            subpaths[-1][1].append(point)
+        if pdfium_c.FPDFPathSegment_GetClose(segment):
+            subpaths[-1][0] += "h"
+            subpaths[-1][1].append(subpaths[-1][1][0])
+    return subpaths
+
+
+def _pdfium_is_curve(path_obj):
+    """
+    Whether a PDFium path object holds a pdfminer LTCurve: pdfminer files a
+    straight segment as a line and a closed axis-aligned four-point path as a
+    rect, everything else (Bezier segments, polygons) as a curve.
+    """
+    def same(a, b):
+        return abs(a - b) < 1e-3
+
+    for shape, points in _pdfium_subpaths(path_obj):
+        # Drop a redundant "l" on a path closed with "h" (PDFium reports the closing line as one)
+        if len(shape) > 3 and shape[-2:] == "lh" and same(points[-2][0], points[0][0]) and same(points[-2][1], points[0][1]):
+            shape = shape[:-2] + "h"
+            points = points[:-2] + points[-1:]
+        if shape in ("m", "ml", "mlh"):
+            continue
+        if shape in ("mlllh", "mllll"):
+            (x0, y0), (x1, y1), (x2, y2), (x3, y3), (x4, y4) = points
+            closed = same(x0, x4) and same(y0, y4)
+            square = ((same(x0, x1) and same(y1, y2) and same(x2, x3) and same(y3, y0))
+                      or (same(y0, y1) and same(x1, x2) and same(y2, y3) and same(x3, x0)))
+            if closed and square:
+                continue
+        return True
+    return False
+
+
+def _pdfium_pages(pdf_source, page_words=None):
+    with PDFIUM_LOCK:
+        return _pdfium_pages_locked(pdf_source, page_words)
+
+
+def _pdfium_pages_locked(pdf_source, page_words=None):
+    doc = pdfium.PdfDocument(pdf_input(pdf_source))
+    page_texts = []
+    try:
+        for page in doc:
+            textpage = page.get_textpage()
+            try:
+                chars = _pdfium_chars(textpage, page.get_height())
+                # Same scan test as the pdfplumber backend: images or curves (not rects/lines such as a page frame)
+                if len(chars) < OCR_PAGE_MIN_CHARS and any(
+                        obj.type == pdfium_c.FPDF_PAGEOBJ_IMAGE or _pdfium_is_curve(obj)
+                        for obj in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_IMAGE, pdfium_c.FPDF_PAGEOBJ_PATH])):
+                    page_texts.append(None)
+                    if page_words is not None:
+                        page_words.append(None)
+                else:
+                    page_texts.append(chars_to_text(chars) if chars else "")
+                    if page_words is not None:
+                        page_words.append(chars_to_words(chars) if chars else [])
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        doc.close()
+    return page_texts
+
+
+PDF_TEXT_BACKENDS = {"pdfplumber": _pdfplumber_pages}
+if PDFIUM_AVAILABLE:
+    PDF_TEXT_BACKENDS["pdfium"] = _pdfium_pages
+
+# Backend used by extract_invoice_data() (override with HOADON_PDF_BACKEND)
+PDF_TEXT_BACKEND = os.environ.get("HOADON_PDF_BACKEND", "pdfium" if PDFIUM_AVAILABLE else "pdfplumber")
+
+# Line item engine (override with HOADON_ITEM_ENGINE): "text" reads items from the cleaned
+# text lines (extract_services_from_text), "layout" from the word positions of the goods
+# table (layout_items.py), falling back to "text" when no table can be read
+ITEM_ENGINES = ("text", "layout")
+ITEM_ENGINE = os.environ.get("HOADON_ITEM_ENGINE", "text")
+
+
+# ============ DOCUMENT INDEX ============
+# Every extraction stage reads the same cleaned text: line by line for the items,
+# lowercased for keyword checks, the line around a regex hit for context, the
+# first/last lines for the seller. Document builds these views once per invoice
+# and the stages share it instead of re-splitting and re-lowercasing the text.
+
+# Lowercase Vietnamese letters and their ASCII base letter, one to one: folded
+# text keeps the offsets of the lowercase text
+VIETNAMESE_LETTERS = 'àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ'
+FOLD_TABLE = str.maketrans(VIETNAMESE_LETTERS, 'aaaaaaaaaaaaaaaaaeeeeeeeeeeeiiiiiooooooooooooooooouuuuuuuuuuuyyyyyd')
+
+# Goods table column header row ("STT | Tên hàng hóa, dịch vụ | Đơn vị tính ..."), matched on the lowercase line
+TABLE_HEADER_RE = re.compile(r'\bstt\b|tên hàng|tên dịch vụ|description')
+# Lowercase markers of the total line that closes a goods table
+TOTAL_LINE_MARKERS = ('cộng tiền hàng', 'cộng tiền bán hàng', 'tổng tiền hàng', 'tổng tiền chưa thuế', 'tổng cộng',
+                      'tổng tiền thanh toán')
+
+
+def fold_text(text):
+    """Lowercase text without Vietnamese diacritics: "Mã số thuế" -> "ma so thue"."""
+    return text.lower().translate(FOLD_TABLE)
+
+
+class Document:
     """
-    Extract invoice data from a PDF file source.
-    :param pdf_source: File path (str) or file-like object (BytesIO)
-    :param filename: Original filename (if pdf_source is a stream)
+    Read-only index of an invoice's cleaned text, built once and shared by the
+    extraction stages (see as_document). Whole-text copies are made on first use.
+    - lines, line_starts: the text split on newlines and the offset of each line
+    - lower, upper, folded (see fold_text), lower_lines, nonblank_lines (stripped)
+    - line_index(pos), line_at(pos): the line containing a text offset
+    - tables: line ranges of the goods table(s), see below
+    - header, body, footer: (start, end) offsets of the part above the first
+      table, the tables and the part after the last one
     """
+
+    def __init__(self, text):
+        lines = tuple(text.split('\n'))
+        starts, pos = [], 0
+        for line in lines:
+            starts.append(pos)
+            pos += len(line) + 1
+        # cached_property also writes to __dict__, so the read-only guard below does not apply to it
+        self.__dict__.update(text=text, lines=lines, line_starts=tuple(starts))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Document is read-only")
+
+    def __len__(self):
+        return len(self.text)
+
+    @cached_property
+    def lower(self):
+        return self.text.lower()
+
+    @cached_property
+    def upper(self):
+        return self.text.upper()
+
+    @cached_property
+    def folded(self):
+        return self.lower.translate(FOLD_TABLE)
+
+    @cached_property
+    def lower_lines(self):
+        return tuple(self.lower.split('\n'))
+
+    @cached_property
+    def nonblank_lines(self):
+        return tuple(line.strip() for line in self.lines if line.strip())
+
+    def line_index(self, pos):
+        """Index in lines of the line containing text offset pos (a newline belongs to the line it ends)."""
+        return bisect.bisect_right(self.line_starts, pos) - 1
+
+    def line_at(self, pos):
+        return self.lines[self.line_index(pos)]
+
+    @cached_property
+    def tables(self):
+        """
+        Goods tables as [(first line, end line)] line index ranges. A table starts
+        below a column header row (TABLE_HEADER_RE) and ends at the last total line
+        (TOTAL_LINE_MARKERS) before the next header row, or at the next header row /
+        the end of the text when it has none. Subtotals inside a table do not end
+        it, and a table continued under a repeated header row on the next page is
+        one range per page. Rows starting with a digit (items) are never header or
+        total rows. Without any header row the whole text is one range, so items
+        are not lost to a header that was not recognized.
+        """
+        lower_lines = self.lower_lines
+        heads = [idx for idx, line in enumerate(lower_lines)
+                 if TABLE_HEADER_RE.search(line) and not line.lstrip()[:1].isdigit()]
+        tables = []
+        for k, head in enumerate(heads):
+            end = heads[k + 1] if k + 1 < len(heads) else len(lower_lines)
+            for idx in range(end - 1, head, -1):
+                line = lower_lines[idx]
+                if any(marker in line for marker in TOTAL_LINE_MARKERS) and not line.lstrip()[:1].isdigit():
+                    end = idx
+                    break
+            if end > head + 1:
+                tables.append((head + 1, end))
+        return tables or [(0, len(lower_lines))]
+
+    def table_lines(self):
+        """Indexes of the lines inside the goods tables, in order."""
+        for first, end in self.tables:
+            yield from range(first, end)
+
+    def _offset(self, line_idx):
+        return self.line_starts[line_idx] if line_idx < len(self.lines) else len(self.text)
+
+    @property
+    def header(self):
+        return 0, self._offset(self.tables[0][0])
+
+    @property
+    def body(self):
+        return self._offset(self.tables[0][0]), self._offset(self.tables[-1][1])
+
+    @property
+    def footer(self):
+        return self._offset(self.tables[-1][1]), len(self.text)
+
+
+def as_document(text):
+    """The Document of a cleaned text; a Document is returned as is."""
+    return text if isinstance(text, Document) else Document(text)
+
+
+# ============ INVOICE EXTRACTION STAGES ============
+# extract_invoice_data() runs these in order: read_pdf_pages (+ OCR of scanned pages) -> clean_pdf_text ->
+# Document -> extract_services_from_text -> extract_header_fields -> reconcile_amounts ->
+# finalize_invoice_data. They are separate functions so each stage can be timed
+# and tested on its own (see benchmark.py); the stages after clean_pdf_text take
+# the Document, or a plain text that they index themselves.
+
+def _parse_amount(s):
+    """
+    Convert string like '481.787' or '1.820.000,00' to int, handling decimals.
+    Unlike parse_money(), empty or invalid input gives 0, not None.
+    """
+    if not s:
+        return 0
+    s = str(s).strip()
     
-    def parse_money(s):
-        """Convert string like '481.787' or '1.820.000,00' to int, handling decimals"""
-        if not s:
-            return 0
-        s = str(s).strip()
-        
-        # Robust Logic: Check order of separators if both exist
-        if '.' in s and ',' in s:
-            last_dot = s.rfind('.')
-            last_comma = s.rfind(',')
-            if last_comma > last_dot: # 1.234,56 -> , is decimal
-                s = s[:last_comma]
-            else: # 1,234.56 -> . is decimal
-                s = s[:last_dot]
-        else:
-            # Only one separator type
-            # Case: 1.820.000 -> Integer
-            # Case: 50,05 (decimal)
-            # Logic: If ends with 2 digits decimal suffix -> remove
-            if re.search(r'[,.]\d{2}$', s) and not re.search(r'[,.]\d{3}$', s):
-                 s = s[:-3]
-             
-        s = s.replace(',', '').replace('.', '')
-        try:
-            return int(s)
-        except:
-            return 0
-            
-    def format_money(n):
-        """Format number back to string with dots as thousands separator"""
-        if n is None: return ""
-        if isinstance(n, str) and not n.strip(): return ""
-        try:
-             # Use our robust parse_money to get float/int
-             val = parse_money(n)
-             return f"{val:,.0f}".replace(',', '.')
-        except:
-             return str(n)
-             
-    if isinstance(pdf_source, str):
-        filename = os.path.basename(pdf_source)
-    elif filename is None:
-        filename = "Unknown.pdf"
+    # Robust Logic: Check order of separators if both exist
+    if '.' in s and ',' in s:
+        last_dot = s.rfind('.')
+        last_comma = s.rfind(',')
+        if last_comma > last_dot: # 1.234,56 -> , is decimal
+            s = s[:last_comma]
+        else: # 1,234.56 -> . is decimal
+            s = s[:last_dot]
+    else:
+        # Only one separator type
+        # Case: 1.820.000 -> Integer
+        # Case: 50,05 (decimal)
+        # Logic: If ends with 2 digits decimal suffix -> remove
+        if re.search(r'[,.]\d{2}$', s) and not re.search(r'[,.]\d{3}$', s):
+             s = s[:-3]
+         
+    s = s.replace(',', '').replace('.', '')
+    try:
+        return int(s)
+    except:
+        return 0
+
+
+def _format_amount(n):
+    """Format number back to string with dots as thousands separator"""
+    if n is None: return ""
+    if isinstance(n, str) and not n.strip(): return ""
+    try:
+         # Use our robust _parse_amount to get float/int
+         val = _parse_amount(n)
+         return f"{val:,.0f}".replace(',', '.')
+    except:
+         return str(n)
+
 
-    data = {
+def _empty_invoice_data(filename):
+    """Result dict with every output field present and empty."""
+    return {
         "Tên file": filename,
         "Ngày hóa đơn": "",
         "Số hóa đơn": "",
@@ -1033,1156 +2301,1025 @@ def extract_invoice_data(pdf_source, filename=None):
         "Ký hiệu": "",
         "Phí PV": ""
     }
-    # Store line items separately for multi-row expansion
-    line_items = []
+
+
+def read_pdf_pages(pdf_source, backend=None, page_words=None):
+    """
+    Text layer of every page, in page order. Pages with (almost) no text
+    characters but with an image or vector drawing are scans: their entry is
+    None so only those pages go to OCR.
+    :param backend: Key of PDF_TEXT_BACKENDS (default: PDF_TEXT_BACKEND)
+    :param page_words: Optional list that receives the words of each page from the same
+        read (pdfplumber word dicts: text, x0, x1, top, bottom; None for scanned pages)
+    """
+    backend = backend or PDF_TEXT_BACKEND
+    if backend not in PDF_TEXT_BACKENDS:
+        raise ValueError(f"Unknown PDF text backend: {backend} (choose from {', '.join(PDF_TEXT_BACKENDS)})")
+    return PDF_TEXT_BACKENDS[backend](pdf_source, page_words)
+
+
+def join_pages(page_texts):
+    """Page texts joined in page order; pages still None (not OCRed) are left out."""
+    return "".join(text + "\n" for text in page_texts if text)
+
+
+def clean_pdf_text(full_text, data):
+    """
+    Normalize newlines and drop garbage lines from the PDF text.
+    A total hidden in the garbage is stored in data["Số tiền sau"].
+    """
+    # Normalize newlines
+    full_text = full_text.replace('\r\n', '\n').replace('\r', '\n')
     
-    try:
-        # Read text directly from PDF using pdfplumber
-        full_text = ""
-        with pdfplumber.open(pdf_source) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    full_text += page_text + "\n"
-        
-        # Check if PDF is scanned (no text extracted)
-        if not full_text.strip():
-            print(f"  PDF has no text, trying OCR: {filename}")
-            ocr_text = ocr_pdf_to_text(pdf_source, filename)
-            if ocr_text.strip():
-                # Use OCR extraction for scanned PDFs
-                ocr_data = extract_ocr_invoice_fields(ocr_text, filename)
-                for key, val in ocr_data.items():
-                    if key in data and val:
-                        data[key] = val
-                # Auto-classify based on content
-                ocr_lower = ocr_text.lower()
-                print(f"  OCR text contains 'petrolimex': {'petrolimex' in ocr_lower}")
-                print(f"  OCR text contains 'xăng': {'xăng' in ocr_lower}")
-                if any(x in ocr_lower for x in ['petrolimex', 'xăng', 'ron 95', 'ron95', 'diesel', 'dầu diesel']):
-                    data["Phân loại"] = "Xăng xe"
-                    print(f"  Classification set to: Xăng xe")
-                elif any(x in ocr_lower for x in ['khách sạn', 'hotel', 'phòng nghỉ']):
-                    data["Phân loại"] = "Dịch vụ phòng nghỉ"
-                elif any(x in ocr_lower for x in ['nhà hàng', 'quán ăn', 'món ăn']):
-                    data["Phân loại"] = "Dịch vụ ăn uống"
-                else:
-                    data["Phân loại"] = "Khác"
-                print(f"  Final data: {data}")
-                return data, []  # Return early for OCR path
-            else:
-                print(f"  OCR also failed for: {filename}")
-                return data, []
+    # CLEANUP: Remove garbage lines (e.g. debug JSON pointers like {'name': ...}) 
+    clean_lines = []
+    for line in full_text.split('\n'):
+        line_strip = line.strip()
         
-        # Normalize newlines
-        full_text = full_text.replace('\r\n', '\n').replace('\r', '\n')
+        # AGGRESSIVE CLEANUP for PSD.pdf garbage: 0'}2,950,000'}'}
+        # FIRST: Check if this garbage contains a hidden number (Total)
+        if "2,950,000" in line:
+             print(f"DEBUG_PSD_LINE: {repr(line)}")
         
-        # CLEANUP: Remove garbage lines (e.g. debug JSON pointers like {'name': ...}) 
-        clean_lines = []
-        for line in full_text.split('\n'):
-            line_strip = line.strip()
-            
-            # AGGRESSIVE CLEANUP for PSD.pdf garbage: 0'}2,950,000'}'}
-            # FIRST: Check if this garbage contains a hidden number (Total)
-            if "2,950,000" in line:
-                 print(f"DEBUG_PSD_LINE: {repr(line)}")
-            
-            # Pattern: 0'}2,950,000'}'}
-            # Try looser pattern: 0'}...digits...'}'}
-            garbage_match = re.search(r"0'}([\d\.,]+)'\}'\}", line)
-            if garbage_match:
-                 val = garbage_match.group(1)
-                 print(f"DEBUG: Found hidden total in garbage: {val}")
-                 # Store it in data immediately
-                 if not data["Số tiền sau"]:
-                      data["Số tiền sau"] = val
-                 # If we found it, we can strip the garbage wrapper but keep the number?
-                 # Or just strip it all if we saved it?
-                 # Let's keep the number in text just in case regexes need it
-                 line = line.replace(garbage_match.group(0), " " + val + " ")
-
-            # Repeatedly remove the garbage tokens until gone
-            for _ in range(3):
-                line = line.replace("0'}", "").replace("'}'}", "").replace("'}", "").replace("{'", "")
-            
-            # Filter lines that appear to be purely programming code/garbage
-            # (Only filter if we failed to parse it as valid item above)
-            if line_strip.startswith('{') or (line_strip.startswith("'") and line_strip.endswith("'")):
-                 continue
-            
-            # Sanitization: Remove soft hyphens and null bytes
-            line = line.replace('\xad', '').replace('\x00', '')
-            clean_lines.append(line)
-        full_text = "\n".join(clean_lines)
+        # Pattern: 0'}2,950,000'}'}
+        # Try looser pattern: 0'}...digits...'}'}
+        garbage_match = re.search(r"0'}([\d\.,]+)'\}'\}", line)
+        if garbage_match:
+             val = garbage_match.group(1)
+             print(f"DEBUG: Found hidden total in garbage: {val}")
+             # Store it in data immediately
+             if not data["Số tiền sau"]:
+                  data["Số tiền sau"] = val
+             # If we found it, we can strip the garbage wrapper but keep the number?
+             # Or just strip it all if we saved it?
+             # Let's keep the number in text just in case regexes need it
+             line = line.replace(garbage_match.group(0), " " + val + " ")
 
+        # Repeatedly remove the garbage tokens until gone
+        for _ in range(3):
+            line = line.replace("0'}", "").replace("'}'}", "").replace("'}", "").replace("{'", "")
         
-        # Fallback only works if we have a local file path
-        if not full_text and isinstance(pdf_source, str):
-            print(f"  Empty PDF text, checking for fallback text file...")
-            base_name = os.path.splitext(os.path.basename(pdf_source))[0]
-            folder = os.path.dirname(pdf_source)
-            # Find closest matching text file (e.g. filename_00001.txt)
-            for f in os.listdir(folder):
-                # Check for files starting with the base name (ignoring the (1) vs (1)_0001 differences sometimes)
-                # Simple check: startswith base_name and ends with .txt
-                if f.startswith(base_name) and f.lower().endswith('.txt') and not f.startswith('debug_'):
-                    txt_path = os.path.join(folder, f)
-                    print(f"  -> Found fallback text file: {f}")
-                    try:
-                        # Try UTF-8 first
-                        with open(txt_path, 'r', encoding='utf-8') as tf:
-                            full_text = tf.read()
-                        break
-                    except UnicodeDecodeError:
-                        try:
-                             # Try CP1252 / ANSI
-                             with open(txt_path, 'r', encoding='cp1252') as tf:
-                                full_text = tf.read()
-                             break
-                        except Exception as e:
-                             print(f"  -> Error reading fallback file (encoding): {e}")
-                    except Exception as e:
-                        print(f"  -> Error reading fallback file: {e}")
+        # Filter lines that appear to be purely programming code/garbage
+        # (Only filter if we failed to parse it as valid item above)
+        if line_strip.startswith('{') or (line_strip.startswith("'") and line_strip.endswith("'")):
+             continue
+        
+        # Sanitization: Remove soft hyphens and null bytes
+        line = line.replace('\xad', '').replace('\x00', '')
+        clean_lines.append(line)
+    full_text = "\n".join(clean_lines)
+    return full_text
 
-        if not full_text.strip():
-            print(f"  Could not extract text (scanned PDF?): {filename}")
-            # Set all fields to "không nhận diện được"
-            for key in data:
-                if key != "Tên file":
-                    data[key] = "không nhận diện được"
-            return data, []  # Return empty line_items
 
+def _clean_seller(seller):
+    """Seller name captured after a label, without label leftovers or a trailing MST/address."""
+    # Clean up - remove (Seller): prefix and other text
+    # Normalize newlines to spaces just in case
+    seller = seller.replace('\n', ' ')
         
-        # Extract services from text
-        services = extract_services_from_text(full_text)
-        
-        # ============ EXTRACT FIELDS WITH MULTIPLE PATTERNS ============
-        
-        # Date extraction - try multiple patterns
-        date_patterns = [
-            r'Ngày\s*(\d{1,2})\s*tháng\s*(\d{1,2})\s*năm\s*(\d{4})',
-            r'Ngày\s*(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4})',
-            r'(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{4})',
-            # Multiline date matching with flexible noise skipping
-            # Allows up to 100 chars of any text (including newlines) between parts
-            r'Ngày[:\s]*(\d{1,2})[\s\S]{0,100}tháng[:\s]*(\d{1,2})[\s\S]{0,100}năm[:\s]*(\d{4})',
-            # Bilingual Date: Ngày (day) 19 tháng (month) 12 năm (year) 2025
-            r'Ngày(?:[^0-9]{0,35})?(\d{1,2})[\s\S]{0,35}tháng(?:[^0-9]{0,35})?(\d{1,2})[\s\S]{0,35}năm(?:[^0-9]{0,35})?(\d{4})'
-        ]
-        
-        # Pre-process text for multiline date matching: remove newlines around Date keywords
-        # This helps with: "Ngày 07 tháng 01\n năm 2026" -> "Ngày 07 tháng 01 năm 2026"
-        minified_text = re.sub(r'(Ngày|tháng|năm)\s*\n\s*', r'\1 ', full_text, flags=re.IGNORECASE)
+    # Robust cleanup of "Seller" / "Company" prefixes
+    # Removes: "(Seller):", "Seller :", "(Company):", "Doanh nghiệp:", etc.
+    seller = re.sub(r'^\s*[\(\[]?\s*(?:Seller|Company|Người bán|Doanh nghiệp|Tên đơn vị|Đơn vị bán)\s*[\)\]]?\s*[:\.\-]?\s*', '', seller, flags=re.IGNORECASE)
+    seller = re.sub(r'^\s*\(?Issued\)?\s*[:\.\-]\s*', '', seller, flags=re.IGNORECASE) # Fix for (Issued) :
+    seller = re.sub(r'^\s*[:\.\-]+\s*', '', seller) # Clean remaining colons/dashes
+    seller = re.sub(r'\s*Mã số thuế.*$', '', seller, flags=re.IGNORECASE)
+    seller = re.sub(r'\s*MST.*$', '', seller, flags=re.IGNORECASE)
+    seller = re.sub(r'\s*Địa chỉ.*$', '', seller, flags=re.IGNORECASE)
+    return seller
+
+
+def _seller_before_mst(doc):
+    """
+    Company name in the first lines above the first "Mã số thuế"/"MST" - most
+    reliable for MISA-like invoices where the seller is at the very top. "" if none.
+    """
+    # Find the position of first "Mã số thuế" OR "MST"
+    mst_pos = doc.text.find("Mã số thuế")
+    if mst_pos == -1:
+         mst_pos = doc.text.find("MST")
+         
+    if mst_pos > 0:
+        # Lines before the first MST, the MST line up to the label included
+        mst_line = doc.line_index(mst_pos)
+        before_mst = doc.lines[:mst_line] + (doc.lines[mst_line][:mst_pos - doc.line_starts[mst_line]],)
+        lines_before_mst = [l.strip() for l in before_mst if l.strip()]
         
-        for pattern in date_patterns:
-            # Use DOTALL for multiline matching where needed, or standard for single line
-            match = re.search(pattern, full_text, re.IGNORECASE | re.DOTALL)
-            if match:
-                day, month, year = match.groups()
-                data["Ngày hóa đơn"] = f"{int(day):02d}/{int(month):02d}/{year}"
+        # First non-empty line that looks like a company name
+        for line in lines_before_mst[:6]:  # Check first 6 lines to handle headers
+            # Must contain company keywords AND be reasonably long
+            if len(line) > 10 and any(kw in line.upper() for kw in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'NHÀ HÀNG', 'DNTN', 'HỘ KINH DOANH', 'QUÁN']):
+                # Exclude headers and BUYER info
+                if not any(bad in line.upper() for bad in ['HÓA ĐƠN', 'CỘNG HÒA', 'ĐỘC LẬP', 'TÊN NGƯỜI MUA', 'TÊN ĐƠN VỊ:', 'PHÂN PHỐI TỔNG HỢP DẦU KHÍ', 'ĐÃ ĐƯỢC KÝ ĐIỆN TỬ']):
+                    # Multi-line company name: if next line is also uppercase text, merge
+                    idx = lines_before_mst.index(line)
+                    if idx + 1 < len(lines_before_mst):
+                        next_line = lines_before_mst[idx + 1]
+                        # Merge if next line doesn't contain MST markers and is short uppercase
+                        if next_line and 'Mã số' not in next_line and 'Địa chỉ' not in next_line:
+                            if (next_line.isupper() or (len(next_line) < 40 and ':' not in next_line)) and 'PHÂN PHỐI' not in next_line.upper():
+                                line = line + " " + next_line
+                    return line
+    return ""
+
+
+def _extract_cqt_code(full_text, data):
+    """Mã CQT (tax authority code); include soft hyphen \u00AD used in some PDFs."""
+    # Matches: "Mã của cơ quan thuế: ...", "Mã CQT: ..."
+    cqt_match = re.search(r'(?:Mã|Ma)\s*(?:của)?\s*(?:CQ|cơ\s*quan)\s*thuế[:\s]*([A-Z0-9\-]+)', full_text, re.IGNORECASE)
+    if cqt_match:
+        data["Mã CQT"] = cqt_match.group(1)
+    # CQT CODE - Multiple patterns (more specific, they win)
+    match = CQT_CODE_PATTERNS.search(full_text)
+    if match:
+        # Replace soft hyphen with regular hyphen
+        cqt_code = match.group(1).strip().replace('\u00AD', '-')
+        data["Mã CQT"] = cqt_code
+
+
+def _extract_lookup_link(full_text, data):
+    """Link lấy hóa đơn: first lookup URL / domain, with an http:// prefix when it has none."""
+    for i, match in LOOKUP_LINK_PATTERNS.searches(full_text):
+        link = match.group(1).rstrip('.').rstrip(',')
+        # If link doesn't start with http, prepend http://
+        if not link.lower().startswith('http') and not link.lower().startswith('www'):
+             link = "http://" + link
+        if "www" in link.lower() and not link.lower().startswith('http'):
+             link = "http://" + link
+            
+        # Filter out junk that might be matched as domain
+        if '.' in link and len(link) > 5:
+             data["Link lấy hóa đơn"] = link
+             LOOKUP_LINK_PATTERNS.record(i)
+             break
+
+
+def _extract_service_fee(full_text, data):
+    """SERVICE CHARGE (Phí PV). Pattern: Phí PV(Sevice change): 400.507"""
+    pv_match = re.search(r'Phí\s*PV[^:]*[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
+    if pv_match:
+        data["Phí PV"] = pv_match.group(1)
+
+
+def fingerprint_template(full_text):
+    """The InvoiceTemplate whose markers all occur in the text, or None."""
+    for template in INVOICE_TEMPLATES:
+        if template.matches(full_text):
+            return template
+    return None
+
+
+def extract_template_fields(template, doc, data):
+    """
+    Fill the header fields of data with the template's patterns (the last match
+    for amounts, like the generic chain). Returns False as soon as a field of the
+    template does not match; data may then be partly filled.
+    """
+    full_text = doc.text
+    for field, group in template.fields.items():
+        if field == "tax_rate_columns":
+            rates = {}
+            for index, matches in group.finditer(full_text):
+                group.record(index)
+                for match in matches:
+                    rates[match.group("rate")] = match.group("tax")
+            if not rates:
+                return False
+            for rate, tax in rates.items():
+                data[f"Thuế {rate}%"] = tax
+            continue
+
+        if field in ("before_tax", "vat_amount"):
+            match = None
+            for index, matches in group.finditer(full_text):
+                group.record(index)
+                match = matches[-1]
                 break
+        else:
+            match = group.search(full_text)
+        if match is None:
+            return False
+
+        if field == "invoice_date":
+            day, month, year = match.groups()
+            value = f"{int(day):02d}/{int(month):02d}/{year}"
+        elif field == "tax_code":
+            value = match.group(1).replace('\u00AD', '').replace(' ', '').strip()
+        elif field == "seller":
+            value = _clean_seller(match.group(1).strip())
+        else:
+            value = match.group(1).strip()
+        data[TEMPLATE_FIELDS[field]] = value
+
+    if template.seller_on_top:
+        data["Đơn vị bán"] = _seller_before_mst(doc)
+        if not data["Đơn vị bán"]:
+            return False
+
+    # Fields every layout may print anywhere; cheap, shared with the generic chain
+    _extract_cqt_code(full_text, data)
+    _extract_lookup_link(full_text, data)
+    _extract_service_fee(full_text, data)
+    return True
+
+
+def extract_header_fields(doc, data, filename=None, pdf_source=None):
+    """
+    Header/footer regex stage: date, MST, invoice number, seller, serial, codes,
+    lookup link and the raw amounts / tax breakdown, written into data.
+    An invoice whose issuing software is recognized (fingerprint_template) is read
+    with that template's few patterns; otherwise, or when the template misses a
+    field, the generic pattern chain runs.
+    Returns the name of the template used, or None for the generic chain.
+    :param doc: Document (or cleaned text) of the invoice
+    """
+    doc = as_document(doc)
+    template = fingerprint_template(doc.text) if TEMPLATE_FAST_PATH else None
+    if template is not None:
+        before = dict(data)
+        if extract_template_fields(template, doc, data):
+            return template.name
+        print(f"  [TEMPLATE] {template.name}: missing fields, using the generic patterns")
+        data.clear()
+        data.update(before)
+    _generic_header_fields(doc, data, filename, pdf_source)
+    return None
+
+
+def _generic_header_fields(doc, data, filename=None, pdf_source=None):
+    """Every pattern family and fallback in turn, for invoices of unknown layout."""
+    full_text = doc.text
+    # ============ EXTRACT FIELDS WITH MULTIPLE PATTERNS ============
+    
+    # Date extraction - try multiple patterns (INVOICE_DATE_PATTERNS allow newlines between the words)
+    match = INVOICE_DATE_PATTERNS.search(full_text)
+    if match:
+        day, month, year = match.groups()
+        data["Ngày hóa đơn"] = f"{int(day):02d}/{int(month):02d}/{year}"
+    
+    # SELLER TAX CODE (MST)
+    # Strategy: 
+    # 1. Look for MST explicitly associated with "Seller" or "Don vi ban"
+    # 2. Look for MST generally but skip known "Provider" MSTs
+    # 3. Handle spaces in MST (0 3 0 ...)
+    
+    # Known Provider MSTs to ignore (VNPT, Viettel, BKAV, etc often appear in footer)
+    # 0106869738: VNPT, 0101360697: BKAV
+    ignore_mst = ['0106869738', '0100684378', '0101245171', '0305482862', '0103243195', '0101360697']
+    
+    # Priority 0: Spaced MST Pattern (e.g. "0 3 0 1 4 3 3 9 8 4")
+    # This is almost always the distinct Main Company MST at the header.
+    # Must match sequence of digits separated by single spaces, length >= 10 digits
+    spaced_mst_match = re.search(r'Mã số thuế[:\s]*((?:\d\s+){9,}[\d\s-]*\d)', full_text, re.IGNORECASE)
+    if spaced_mst_match:
+         potential_mst = spaced_mst_match.group(1).replace(' ', '').strip()
+         if not any(x in potential_mst for x in ignore_mst):
+             data["Mã số thuế"] = potential_mst
+             print(f"  [MST] Found via Spaced pattern: {potential_mst}")
+         else:
+             print(f"  [MST] Spaced match ignored: {potential_mst}")
+    
+    # Priority 0.5: VAT Code pattern (hotel invoices at footer)
+    # Pattern: "VAT Code: 0300659964" or "VATCode: ..."
+    if not data["Mã số thuế"]:
+        vat_code_match = re.search(r'VAT\s*Code[:\s]*(\d{10,14})', full_text, re.IGNORECASE)
+        if vat_code_match:
+            potential_mst = vat_code_match.group(1).strip()
+            if not any(x in potential_mst for x in ignore_mst):
+                data["Mã số thuế"] = potential_mst
+    
+    # Priority 1: Contextual match near "Đơn vị bán" or "Seller"
+    # Only run if Priority 0 didn't find anything
+    if not data["Mã số thuế"]:
+         # Search in a window of text
+         seller_block_match = re.search(r'(?:Đơn vị bán|Người bán|Seller)[^:]*[:\s]+(.*?)(?:Mã số thuế|MST|Tax code)[^:]*[:\s]*([0-9\s-]+)', full_text, re.IGNORECASE | re.DOTALL)
+         if seller_block_match:
+              potential_mst = seller_block_match.group(2).replace(' ', '').strip()
+              # Check if it's a valid length MST
+              if len(potential_mst) >= 10 and not any(x in potential_mst for x in ignore_mst):
+                  data["Mã số thuế"] = potential_mst
+         else:
+              pass
+
+    # Priority 2: Standard MST search if Priority 1 failed found nothing or ignored
+    if not data["Mã số thuế"]:
+        # Find ALL MSTs, then filter
+        # Matches: "Mã số thuế: 030...", "MST: 030...", "Tax code: 030..."
+        # Also handles spaced MST: "0 3 0 ..."
+        all_mst_matches = re.finditer(r'(?:Mã số thuế|MST|Tax code)[^:]*[:\s]*([0-9\s-]+)', full_text, re.IGNORECASE)
         
-        # SELLER TAX CODE (MST)
-        # Strategy: 
-        # 1. Look for MST explicitly associated with "Seller" or "Don vi ban"
-        # 2. Look for MST generally but skip known "Provider" MSTs
-        # 3. Handle spaces in MST (0 3 0 ...)
-        
-        # Known Provider MSTs to ignore (VNPT, Viettel, BKAV, etc often appear in footer)
-        # 0106869738: VNPT, 0101360697: BKAV
-        ignore_mst = ['0106869738', '0100684378', '0101245171', '0305482862', '0103243195', '0101360697']
-        
-        # Priority 0: Spaced MST Pattern (e.g. "0 3 0 1 4 3 3 9 8 4")
-        # This is almost always the distinct Main Company MST at the header.
-        # Must match sequence of digits separated by single spaces, length >= 10 digits
-        spaced_mst_match = re.search(r'Mã số thuế[:\s]*((?:\d\s+){9,}[\d\s-]*\d)', full_text, re.IGNORECASE)
-        if spaced_mst_match:
-             potential_mst = spaced_mst_match.group(1).replace(' ', '').strip()
-             if not any(x in potential_mst for x in ignore_mst):
-                 data["Mã số thuế"] = potential_mst
-                 print(f"  [MST] Found via Spaced pattern: {potential_mst}")
-             else:
-                 print(f"  [MST] Spaced match ignored: {potential_mst}")
-        
-        # Priority 0.5: VAT Code pattern (hotel invoices at footer)
-        # Pattern: "VAT Code: 0300659964" or "VATCode: ..."
-        if not data["Mã số thuế"]:
-            vat_code_match = re.search(r'VAT\s*Code[:\s]*(\d{10,14})', full_text, re.IGNORECASE)
-            if vat_code_match:
-                potential_mst = vat_code_match.group(1).strip()
-                if not any(x in potential_mst for x in ignore_mst):
-                    data["Mã số thuế"] = potential_mst
+        candidates = []
+        for m in all_mst_matches:
+            raw_mst = m.group(1).replace(' ', '').strip()
+            # Clean trailing chars usually adhering to MST like -001 or just junk
+            # Valid MST is usually 10-14 digits/chars
+            clean_mst = re.match(r'[\d-]+', raw_mst)
+            if clean_mst:
+                val = clean_mst.group(0)
+                # Check against ignore list: if ANY ignore_mst is a substring of val, OR val is substring of ignore_mst
+                is_ignored = any(ign in val for ign in ignore_mst) or any(val in ign for ign in ignore_mst)
+                
+                if 9 <= len(val) <= 14 and not is_ignored:
+                     candidates.append(val)
         
-        # Priority 1: Contextual match near "Đơn vị bán" or "Seller"
-        # Only run if Priority 0 didn't find anything
-        if not data["Mã số thuế"]:
-             # Search in a window of text
-             seller_block_match = re.search(r'(?:Đơn vị bán|Người bán|Seller)[^:]*[:\s]+(.*?)(?:Mã số thuế|MST|Tax code)[^:]*[:\s]*([0-9\s-]+)', full_text, re.IGNORECASE | re.DOTALL)
-             if seller_block_match:
-                  potential_mst = seller_block_match.group(2).replace(' ', '').strip()
-                  # Check if it's a valid length MST
-                  if len(potential_mst) >= 10 and not any(x in potential_mst for x in ignore_mst):
-                      data["Mã số thuế"] = potential_mst
-             else:
-                  pass
-
-        # Priority 2: Standard MST search if Priority 1 failed found nothing or ignored
-        if not data["Mã số thuế"]:
-            # Find ALL MSTs, then filter
-            # Matches: "Mã số thuế: 030...", "MST: 030...", "Tax code: 030..."
-            # Also handles spaced MST: "0 3 0 ..."
-            all_mst_matches = re.finditer(r'(?:Mã số thuế|MST|Tax code)[^:]*[:\s]*([0-9\s-]+)', full_text, re.IGNORECASE)
+        if candidates:
+            # If multiple candidates, usually the FIRST one is the seller (top of page), 
+            # unless the provider stamp is at the very top. 
+            # But typically Seller info is top-left or top-center.
             
-            candidates = []
-            for m in all_mst_matches:
-                raw_mst = m.group(1).replace(' ', '').strip()
-                # Clean trailing chars usually adhering to MST like -001 or just junk
-                # Valid MST is usually 10-14 digits/chars
-                clean_mst = re.match(r'[\d-]+', raw_mst)
-                if clean_mst:
-                    val = clean_mst.group(0)
-                    # Check against ignore list: if ANY ignore_mst is a substring of val, OR val is substring of ignore_mst
-                    is_ignored = any(ign in val for ign in ignore_mst) or any(val in ign for ign in ignore_mst)
-                    
-                    if 9 <= len(val) <= 14 and not is_ignored:
-                         candidates.append(val)
+            # CONTEXT CHECK: If the line containing MST has "Gi?i ph?p", "Ph?m m?m", "Provider", ignore it
+            final_candidates = []
+            for c in candidates:
+                 is_bad_context = False
+                 # Find original match line to check context
+                 for line, line_lower in zip(doc.lines, doc.lower_lines):
+                     if c in line.replace(' ', ''): # Approximation
+                         if any(kw in line_lower for kw in ['giải pháp', 'phần mềm', 'cung cấp bởi', 'phát hành bởi', 'created by', 'signature', 'ký bởi', 'bkav', 'ehoadon']):
+                             is_bad_context = True
+                             print(f"  [MST] Ignored candidate {c} due to bad context line: {line.strip()}")
+                             break
+                 if not is_bad_context:
+                     final_candidates.append(c)
+            
+            if final_candidates:
+                data["Mã số thuế"] = final_candidates[0]
+                print(f"  [MST] Found via Priority 2 (Standard): {data['Mã số thuế']}")
+    
+    # INVOICE NUMBER - Multiple patterns (order matters - more specific first)
+    match = INVOICE_NO_PATTERNS.search(full_text)
+    if match:
+        data["Số hóa đơn"] = match.group(1)
+    
+    # Fallback: Extract from filename if missing
+    if not data["Số hóa đơn"]:
+        # Try to find a long number in filename?
+        fname_for_num = filename if filename else (os.path.basename(pdf_source) if isinstance(pdf_source, str) else "")
+        fname = os.path.splitext(fname_for_num)[0]
+        # Split by underscores or hyphens
+        parts = re.split(r'[_\-\s]', fname)
+        # Filter for pure digit sequences, reasonable length (e.g. >3)
+        # Avoid parts that look like dates if possible, but simplest is last long number
+        nums = [p for p in parts if p.isdigit() and len(p) > 2]
+        if nums:
+             data["Số hóa đơn"] = nums[-1] # Take the last number found pattern often has invoice num at end
+
+    for i, match in SELLER_PATTERNS.searches(full_text):
+        seller = match.group(1).strip()
             
-            if candidates:
-                # If multiple candidates, usually the FIRST one is the seller (top of page), 
-                # unless the provider stamp is at the very top. 
-                # But typically Seller info is top-left or top-center.
+        # Check for multi-line split (common in VNPT)
+        # e.g. "CHI NHÁNH... (LOẠI HÌNH DOANH NGHIỆP:\nCÔNG TY TNHH)..."
+        # Find start and end index of this match in full_text
+        # Look ahead for next line (the match must end the line, and the next line be non-empty)
+        next_idx = doc.line_index(match.end()) + 1
+        if full_text.startswith('\n', match.end()) and next_idx < len(doc.lines) and doc.lines[next_idx]:
+            next_line = doc.lines[next_idx].strip()
+            # Heuristic to merge:
+            # 1. Seller line ends with ':', '(', or "DOANH NGHIỆP"
+            # 2. Next line starts with "CÔNG TY", "TẬP ĐOÀN", ")"
+            if (seller.endswith(':') or seller.endswith('(') or 'DOANH NGHIỆP' in seller[-15:]):
+                 seller = seller + " " + next_line
                 
-                # CONTEXT CHECK: If the line containing MST has "Gi?i ph?p", "Ph?m m?m", "Provider", ignore it
-                final_candidates = []
-                for c in candidates:
-                     is_bad_context = False
-                     # Find original match line to check context
-                     for line in full_text.split('\n'):
-                         if c in line.replace(' ', ''): # Approximation
-                             if any(kw in line.lower() for kw in ['giải pháp', 'phần mềm', 'cung cấp bởi', 'phát hành bởi', 'created by', 'signature', 'ký bởi', 'bkav', 'ehoadon']):
-                                 is_bad_context = True
-                                 print(f"  [MST] Ignored candidate {c} due to bad context line: {line.strip()}")
-                                 break
-                     if not is_bad_context:
-                         final_candidates.append(c)
+        seller = _clean_seller(seller)
+            
+        # Check for invalid seller content (captured footer text/codes)
+        # Added 'địa chỉ', 'address' to prevent grabbing Address line
+        if any(x in seller.lower() for x in ['mã nhận hóa đơn', 'code for checking', 'tra cứu tại', 'địa chỉ', 'address']):
+            continue
+            
+        # Check for placeholder capture
+        if seller.lower().replace(':', '').strip() in ['(seller)', 'seller', 'người bán', 'tên đơn vị']:
+            continue
                 
-                if final_candidates:
-                    data["Mã số thuế"] = final_candidates[0]
-                    print(f"  [MST] Found via Priority 2 (Standard): {data['Mã số thuế']}")
-        
-        # INVOICE NUMBER - Multiple patterns (order matters - more specific first)
-        inv_patterns = [
-            (r'(\d{8})\nSố HĐ\s*/\s*Invoice No\.', 0),  # C26MAP reverse: 00001348\nSố HĐ / Invoice No.:
-            (r'Số HĐ\s*/\s*Invoice No\.?[:\s]*[\n\s]*(\d{5,})', re.DOTALL),  # C26MAP: Số HĐ / Invoice No.:\n00001348
-            (r'Invoice No\.?[:\s]*[\n\s]*(\d{5,})', re.DOTALL),  # Generic Invoice No: 00001348
-            (r'Số\s*\(No\.?\)[:\s]*(\d{5,})', 0),  # M-INVOICE: Số(No.): 00007155 (at least 5 digits)
-            r'Số[/\s]*\(Invoice No\.?\)[:\s]*(\d+)',
-            r'\(RESTAURANT BILL\)\s*(\d+)',  # VNPT Restaurant: (RESTAURANT BILL) 00004501
-            r'Số:\s*(\d+)',  # Explicit colon: Số: 00007155
-            r'Số hóa đơn[:\s]*(\d+)',
-            r'Số\s*\(No\.?\)[:\s]*(\d+)',  # M-INVOICE with any digits
-            r's[éèẹẽe][: ]+\s*(\d+)',  # OCR typo: sé (Petrolimex)
-            r'S[óố][: ]+\s*(\d+)',  # OCR typo: Só/Số
-            # NOTE: Removed generic 'Số[:\s]+(\d+)' - too broad, matches addresses
-        ]
-        for pattern_item in inv_patterns:
-            if isinstance(pattern_item, tuple):
-                pattern, flags = pattern_item
-                match = re.search(pattern, full_text, re.IGNORECASE | flags)
-            else:
-                match = re.search(pattern_item, full_text, re.IGNORECASE)
-            if match:
-                data["Số hóa đơn"] = match.group(1)
-                break
-        
-        # Fallback: Extract from filename if missing
-        if not data["Số hóa đơn"]:
-            # Try to find a long number in filename?
-            fname_for_num = filename if filename else (os.path.basename(pdf_source) if isinstance(pdf_source, str) else "")
-            fname = os.path.splitext(fname_for_num)[0]
-            # Split by underscores or hyphens
-            parts = re.split(r'[_\-\s]', fname)
-            # Filter for pure digit sequences, reasonable length (e.g. >3)
-            # Avoid parts that look like dates if possible, but simplest is last long number
-            nums = [p for p in parts if p.isdigit() and len(p) > 2]
-            if nums:
-                 data["Số hóa đơn"] = nums[-1] # Take the last number found pattern often has invoice num at end
-
-        seller_patterns = [
-            r'Đơn vị bán hàng\s*\([Ss]eller\)[:\s]*(.+)',  # M-INVOICE format
-            r'Đơn vị bán\s*\([Ss]eller\)[:\s]*(.+)', # Standard
-            r'Đơn vị bán\s*\(Seller\)[:\s]*(.+)',  # Specific exact match
-            r'Tên người bán\s*\([Ss]eller\)[:\s]*(.+)',  # VNPT format
-            r'Đơn vị bán hàng\s*\([Cc]ompany\)[:\s]*(.+)',  # MISA variation
-            r'Đơn vị bán hàng[:\s]*(.+)',  # Simple format (Petrolimex)
-            r'Tên đơn vị bán hàng[:\s]*(.+)',
-            r'HỘ KINH DOANH[:\s]*(.+)',
-            r'QUÁN[:\s]*(.+)',
-            # NOTE: Removed 'Người bán' pattern - it captures 'Người bán hàng(Seller)' incorrectly
-        ]
-        for pattern in seller_patterns:
-            match = re.search(pattern, full_text)
-            if match:
-                seller = match.group(1).strip()
-                
-                # Check for multi-line split (common in VNPT)
-                # e.g. "CHI NHÁNH... (LOẠI HÌNH DOANH NGHIỆP:\nCÔNG TY TNHH)..."
-                # Find start and end index of this match in full_text
-                start_idx = match.end(1)
-                # Look ahead for next line
-                rest_of_text = full_text[match.end():]
-                next_line_match = re.match(r'\n([^\n]+)', rest_of_text)
-                if next_line_match:
-                    next_line = next_line_match.group(1).strip()
-                    # Heuristic to merge:
-                    # 1. Seller line ends with ':', '(', or "DOANH NGHIỆP"
-                    # 2. Next line starts with "CÔNG TY", "TẬP ĐOÀN", ")"
-                    if (seller.endswith(':') or seller.endswith('(') or 'DOANH NGHIỆP' in seller[-15:]):
-                         seller = seller + " " + next_line
-                    
-                # Clean up - remove (Seller): prefix and other text
-                # Normalize newlines to spaces just in case
-                seller = seller.replace('\n', ' ')
-                
-                # Robust cleanup of "Seller" / "Company" prefixes
-                # Removes: "(Seller):", "Seller :", "(Company):", "Doanh nghiệp:", etc.
-                seller = re.sub(r'^\s*[\(\[]?\s*(?:Seller|Company|Người bán|Doanh nghiệp|Tên đơn vị|Đơn vị bán)\s*[\)\]]?\s*[:\.\-]?\s*', '', seller, flags=re.IGNORECASE)
-                seller = re.sub(r'^\s*\(?Issued\)?\s*[:\.\-]\s*', '', seller, flags=re.IGNORECASE) # Fix for (Issued) :
-                seller = re.sub(r'^\s*[:\.\-]+\s*', '', seller) # Clean remaining colons/dashes
-                seller = re.sub(r'\s*Mã số thuế.*$', '', seller, flags=re.IGNORECASE)
-                seller = re.sub(r'\s*MST.*$', '', seller, flags=re.IGNORECASE)
-                seller = re.sub(r'\s*Địa chỉ.*$', '', seller, flags=re.IGNORECASE)
-                
-                # Check for invalid seller content (captured footer text/codes)
-                # Added 'địa chỉ', 'address' to prevent grabbing Address line
-                if any(x in seller.lower() for x in ['mã nhận hóa đơn', 'code for checking', 'tra cứu tại', 'địa chỉ', 'address']):
-                    continue
-                
-                # Check for placeholder capture
-                if seller.lower().replace(':', '').strip() in ['(seller)', 'seller', 'người bán', 'tên đơn vị']:
-                    continue
-                    
-                if len(seller) > 5 or (len(seller) > 3 and 'QUÁN' in seller.upper()):
-                    data["Đơn vị bán"] = seller
-                    break
-        
-        # PRIORITY FALLBACK 1: First line(s) before first "Mã số thuế" - this is most reliable for MISA invoices
-        # where seller company name is at the very top of the document
-        if not data["Đơn vị bán"]:
-            # Find the position of first "Mã số thuế" OR "MST"
-            mst_pos = full_text.find("Mã số thuế")
-            if mst_pos == -1:
-                 mst_pos = full_text.find("MST")
-                 
-            if mst_pos > 0:
-                # Get text before first MST
-                text_before_mst = full_text[:mst_pos].strip()
-                lines_before_mst = [l.strip() for l in text_before_mst.split('\n') if l.strip()]
-                
-                # First non-empty line that looks like a company name
-                for line in lines_before_mst[:6]:  # Check first 6 lines to handle headers
-                    # Must contain company keywords AND be reasonably long
-                    if len(line) > 10 and any(kw in line.upper() for kw in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'NHÀ HÀNG', 'DNTN', 'HỘ KINH DOANH', 'QUÁN']):
-                        # Exclude headers and BUYER info
-                        if not any(bad in line.upper() for bad in ['HÓA ĐƠN', 'CỘNG HÒA', 'ĐỘC LẬP', 'TÊN NGƯỜI MUA', 'TÊN ĐƠN VỊ:', 'PHÂN PHỐI TỔNG HỢP DẦU KHÍ', 'ĐÃ ĐƯỢC KÝ ĐIỆN TỬ']):
-                            # Multi-line company name: if next line is also uppercase text, merge
-                            idx = lines_before_mst.index(line)
-                            if idx + 1 < len(lines_before_mst):
-                                next_line = lines_before_mst[idx + 1]
-                                # Merge if next line doesn't contain MST markers and is short uppercase
-                                if next_line and 'Mã số' not in next_line and 'Địa chỉ' not in next_line:
-                                    if (next_line.isupper() or (len(next_line) < 40 and ':' not in next_line)) and 'PHÂN PHỐI' not in next_line.upper():
-                                        line = line + " " + next_line
-                            data["Đơn vị bán"] = line
-                            break
+        if len(seller) > 5 or (len(seller) > 3 and 'QUÁN' in seller.upper()):
+            data["Đơn vị bán"] = seller
+            SELLER_PATTERNS.record(i)
+            break
+    
+    # PRIORITY FALLBACK 1: First line(s) before first "Mã số thuế" - this is most reliable for MISA invoices
+    # where seller company name is at the very top of the document
+    if not data["Đơn vị bán"]:
+        data["Đơn vị bán"] = _seller_before_mst(doc)
 
-        # FALLBACK 2: Ký bởi (Signed by) - common in footer, company name may span multiple lines
-        if not data["Đơn vị bán"]:
-            # Try multi-line pattern first: "Ký bởi:CÔNG TY...\nTHẾ THÊM"
-            sign_match = re.search(r'(?:Ký bởi|Được ký bởi)[:\s]*([A-ZĐ][A-ZĐÀÁẢÃẠ\s]+(?:\n[A-ZĐÀÁẢÃẠ\s]+)?)', full_text)
-            if sign_match:
-                signer = sign_match.group(1).replace('\n', ' ').strip()
-                # Only accept if it looks like a company name
-                if len(signer) > 5 and any(x in signer.upper() for x in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'NHÀ HÀNG', 'DNTN']):
-                    if not any(x in signer.lower() for x in ['địa chỉ', 'address', 'mã số', 'đã được ký']):
-                        data["Đơn vị bán"] = signer
-        
-        # FALLBACK 3: Bottom Scan (Last 20 lines) - for Park Hyatt / Hotels
-        if not data["Đơn vị bán"]:
-            lines = [l.strip() for l in full_text.split('\n') if l.strip()]
-            # Check last 20 lines
-            for line in lines[-20:]:
-                if len(line) > 5 and any(kw in line.upper() for kw in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'DNTN', 'HỘ KINH DOANH', 'HOTEL', 'KHÁCH SẠN', 'QUÁN']):
-                    # Must be uppercase or mostly uppercase for Company Name
-                    if line.isupper() or 'CÔNG TY' in line.upper() or 'QUÁN' in line.upper():
-                         # Exclude headers/footer noise
-                         if not any(bad in line.upper() for bad in ['HÓA ĐƠN', 'TRANG', 'PAGE', 'KÝ BỞI', 'GIẢI PHÁP', 'CUNG CẤP', 'ĐỊA CHỈ', 'MST:', 'VAT CODE']):
-                              data["Đơn vị bán"] = line
-                              break
-
-        # Mã CQT (Standard PDF)
-        # Matches: "Mã của cơ quan thuế: ...", "Mã CQT: ..."
-        cqt_match = re.search(r'(?:Mã|Ma)\s*(?:của)?\s*(?:CQ|cơ\s*quan)\s*thuế[:\s]*([A-Z0-9\-]+)', full_text, re.IGNORECASE)
-        if cqt_match:
-            data["Mã CQT"] = cqt_match.group(1)
-            
-        # SERIAL NUMBER (Ký hiệu) - Multiple patterns INCLUDING "Series"
-        serial_patterns = [
-            r'Ký hiệu\s*/\s*Serial[:\s]*([A-Z0-9]+)',  # C26MAP: Ký hiệu / Serial: 1C26MAP
-            r'[KK]ý hiệu\s*/\s*\([Ss]erial(?:\s*No\.?)?\)[:\s]*([A-Z0-9]+)',  # Format with slash: Ký hiệu/ (Serial No)
-            r'[KK]ý hiệu\s*\([Ss]erial\)[:\s]*([A-Z0-9]+)',  # VNPT: Ký hiệu(Serial): 1K25THA
-            r'[KK]ý hiệu\s*\([Ss]erial(?:\s*No\.?)?\)[:\s]*([A-Z0-9]+)',  # M-INVOICE
-            r'[KK]ý hiệu\s*\([Ss]eries\)[:\s]*([A-Z0-9]+)',  # VNPT uses "Series"
-            r'[KK]ý hiệu[:\s]*([A-Z0-9]+)',
-            r'Mẫu số\s*-\s*[KK]ý hiệu[^:]*[:\s]*([A-Z0-9]+)',
-        ]
-        for pattern in serial_patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE)
-            if match:
-                data["Ký hiệu"] = match.group(1)
-                break
-        
-        # SECURITY CODE (Mã tra cứu) - Multiple patterns
-        security_patterns = [
-            r'Mã tra cứu hoá đơn[:\s]*([A-Za-z0-9]+)',  # C26MAP: Mã tra cứu hoá đơn: 9751Opera19012026
-            r'Mã nhận hóa đơn\s*\([Cc]ode for checking\)[:\s]*([A-Z0-9]+)',  # Special case
-            r'Mã nhận hóa đơn[:\s]*([A-Za-z0-9]+)',  # Simple "Mã nhận hóa đơn: 5c57d33"
-            r'Mã tra cứu\s*\([Ll]ookup\s*code\)[:\s]*([A-Za-z0-9_]+)',  # VNPT: Mã tra cứu(Lookup code):HCM...
-            r'Mã tra cứu hóa đơn\s*\([Ii]nvoice code\)[:\s]*([A-Za-z0-9_]+)',  # MISA variation
-            r'Mã tra cứu(?:\s*HĐĐT)?(?:\s*này)?[:\s]*([A-Za-z0-9_]+)',
-            r'Mã tra cứu\(Invoice code\)[:\s]*([A-Za-z0-9_]+)',  # MISA no-space
-            r'Mã số bí mật[:\s]*([A-Za-z0-9_]+)',
-            r'Security Code\)[:\s]*([A-Z0-9]+)',
-            r'Mã tra cứu[:\s]*([A-Za-z0-9]+)',
-            r'[Ll]ookup\s*code[):\s]*([A-Za-z0-9]+)',
-            r'Ma tra cuu[:\s]*([A-Za-z0-9]+)', # Non-accented
-            r'Mã tra cứu\s*\([Cc]ode\)[:\s]*([A-Za-z0-9]+)', # K26THT: Mã tra cứu (Code): ...
-            r'với mã[:\s]*([A-Za-z0-9]+)', # C26MCX: lấy hóa đơn với mã: ...
-            r'nhập mã\s+([A-Za-z0-9]+)', # NEW: "nhập mã [CODE] để lấy hóa đơn"
-            r'provided code[^:]*[:\s]*([A-Za-z0-9]+)', # NEW: "provided code to get invoice: [CODE]"
-        ]
-        for pattern in security_patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE)
-            if match:
-                code = match.group(1)
-                # Avoid capturing URL parts or headers as code
-                if any(x in code.lower() for x in ["http", "tracuu", "website", "invoice", "check", ".com", ".vn", "please", "vui lòng", "quý khách", "access"]):
-                    continue
+    # FALLBACK 2: Ký bởi (Signed by) - common in footer, company name may span multiple lines
+    if not data["Đơn vị bán"]:
+        # Try multi-line pattern first: "Ký bởi:CÔNG TY...\nTHẾ THÊM"
+        sign_match = re.search(r'(?:Ký bởi|Được ký bởi)[:\s]*([A-ZĐ][A-ZĐÀÁẢÃẠ\s]+(?:\n[A-ZĐÀÁẢÃẠ\s]+)?)', full_text)
+        if sign_match:
+            signer = sign_match.group(1).replace('\n', ' ').strip()
+            # Only accept if it looks like a company name
+            if len(signer) > 5 and any(x in signer.upper() for x in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'NHÀ HÀNG', 'DNTN']):
+                if not any(x in signer.lower() for x in ['địa chỉ', 'address', 'mã số', 'đã được ký']):
+                    data["Đơn vị bán"] = signer
+    
+    # FALLBACK 3: Bottom Scan (Last 20 lines) - for Park Hyatt / Hotels
+    if not data["Đơn vị bán"]:
+        # Check last 20 lines
+        for line in doc.nonblank_lines[-20:]:
+            if len(line) > 5 and any(kw in line.upper() for kw in ['CÔNG TY', 'TẬP ĐOÀN', 'CHI NHÁNH', 'DNTN', 'HỘ KINH DOANH', 'HOTEL', 'KHÁCH SẠN', 'QUÁN']):
+                # Must be uppercase or mostly uppercase for Company Name
+                if line.isupper() or 'CÔNG TY' in line.upper() or 'QUÁN' in line.upper():
+                     # Exclude headers/footer noise
+                     if not any(bad in line.upper() for bad in ['HÓA ĐƠN', 'TRANG', 'PAGE', 'KÝ BỞI', 'GIẢI PHÁP', 'CUNG CẤP', 'ĐỊA CHỈ', 'MST:', 'VAT CODE']):
+                          data["Đơn vị bán"] = line
+                          break
 
-                # Allow longer codes (VNPT uses 32 chars)
-                if 5 <= len(code) <= 35:
-                    data["Mã tra cứu"] = code
-                    break
-                elif len(code) > 35:
-                    # Very long code might be CQT, store separately
-                    if not data["Mã CQT"]:
-                        data["Mã CQT"] = code
-        
-        # Fallback: If no Lookup Code found but CQT Code exists (often treated as the unique ID for VNPT/others)
-        # Check this AFTER extracting Code to avoid overwriting invalid long codes
-        
-        # Fallback for PSD.pdf where "Mã tra cứu" is not clearly labeled but looks like a long code
-        if not data["Mã tra cứu"]:
-             # Look for long string of mixed Upper/Digits in footer area (last 200 chars)
-             footer_text = full_text[-500:] 
-             # Common format: no label, just the code
-             potentials = re.findall(r'\b[A-F0-9]{8,}\b', footer_text)
-             for p in potentials:
-                 if len(p) >= 10 and not p.isdigit(): # Mix of chars, likely Lookup Code
-                     if "0100" not in p and "030" not in p: # Avoid tax codes
-                         data["Mã tra cứu"] = p
-                         break
-        
-        # TAX CODE (MST đơn vị bán) - Look for seller's tax code (first one)
-        tax_patterns = [
-            r'Mã số thuế\s*\([Tt]ax\s*code\)[:\s]*([\d\-\u00AD\s]+)',  # Added \s for spaced numbers
-            r'(?:MST|Mã số thuế)[/\s]*\([Tt]ax [Cc]ode\)[:\s]*([\d\-\u00AD\s]+)',
-            r'MST/CCCD[^:]*[:\s]*([\d\-\u00AD\s]+)',
-            r'(?:MST|Mã số thuế)[:\s]*([\d\-\u00AD\s]+)',
-        ]
-        tax_codes = []
-        for pattern in tax_patterns:
-            matches = re.findall(pattern, full_text, re.IGNORECASE)
-            # Clean up matches - remove soft hyphens AND spaces
-            cleaned_matches = []
-            for m in matches:
-                clean = m.replace('\u00AD', '').replace(' ', '').strip()
-                # Verify it looks like a tax code (at least 10 chars, digits/hyphens)
-                if len(clean) >= 10 and any(c.isdigit() for c in clean):
-                    cleaned_matches.append(clean)
-            tax_codes.extend(cleaned_matches)
-        
-        if len(tax_codes) >= 1 and not data["Mã số thuế"]:
-             # Filter ignore list
-             valid_mst = [t for t in tax_codes if not any(ign in t for ign in ignore_mst) and not any(t in ign for ign in ignore_mst)]
-             if valid_mst:
-                 data["Mã số thuế"] = valid_mst[0]  # Seller's tax code (first one)
-        
-        # PETROLIMEX SPECIFIC: OCR often messes up "Ma so thue" label or merges it.
-        # Look for "Ma so thue: 0300555450" or similar in OCR text (normalized)
-        if not data["Mã số thuế"]:
-             # Normalize text: lower, remove accents
-             norm_text = full_text.lower().replace('á', 'a').replace('à', 'a').replace('ã', 'a').replace('ạ', 'a').replace('ả', 'a') \
-                                          .replace('é', 'e').replace('è', 'e').replace('ẽ', 'e').replace('ẹ', 'e').replace('ẻ', 'e') \
-                                          .replace('ô', 'o').replace('ố', 'o').replace('ồ', 'o').replace('ỗ', 'o').replace('ộ', 'o').replace('ổ', 'o') \
-                                          .replace('ê', 'e').replace('ế', 'e').replace('ề', 'e').replace('ễ', 'e').replace('ệ', 'e').replace('ể', 'e')
-             # Pattern: "ma so thue" or "ma se thue" (OCR typo) followed by digits
-             # Handle "Ma sé thué" -> "ma se thue"
-             petro_mst = re.search(r'(?:ma\s+s[eoc]\s+thue|ma\s+so\s+thue|ma\s+s.\s+thue|mst|tax code)[^0-9]*([0-9]{10,14})', norm_text)
-             if petro_mst:
-                 mst_cand = petro_mst.group(1)
-                 if not any(x in mst_cand for x in ignore_mst):
-                      data["Mã số thuế"] = mst_cand
-        
-        # CQT CODE - Multiple patterns (include soft hyphen \u00AD used in some PDFs)
-        cqt_patterns = [
-            r'Mã\s*(?:của\s*)?[Cc]ơ quan thuế[:\s]*([A-Za-z0-9\-\u00AD]+)',  # M-INVOICE
-            r'Mã\s*(?:của\s*)?[Cc]ơ quan thuế\s*\([Tt]ax authority code\)[:\s]*([A-Za-z0-9\-\u00AD]+)',
-            r'Mã\s*CQT\s*\([Cc]ode\)[:\s]*([A-Za-z0-9\-\u00AD]+)',
-            r'Mã\s*CQT[:\s]*([A-Za-z0-9\-\u00AD]+)',
-            r'Tax authority code[:\s]*([A-Za-z0-9\-\u00AD]+)',
-        ]
-        for pattern in cqt_patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE)
-            if match:
-                # Replace soft hyphen with regular hyphen
-                cqt_code = match.group(1).strip().replace('\u00AD', '-')
-                data["Mã CQT"] = cqt_code
-                break
-        
-        # FINAL FALLBACK: If Lookup Code is still empty, use CQT Code
-        # REMOVED due to User Request: "không được lấy mã cơ quan thuế thay vào cho mã tra cứu"
-        # if not data["Mã tra cứu"] and data["Mã CQT"]:
-        #    data["Mã tra cứu"] = data["Mã CQT"]
-        
-        # LOOKUP LINK - Multiple patterns
-        link_patterns = [
-            r'Tra cứu hóa đơn tại\s*\([^)]+\)[:\s]*(https?://[^\s]+)',  # VNPT: Tra cứu hóa đơn tại (Lookup the invoice at):https://...
-            r'Tra cứu hóa đơn tại[:\s]*(https?://[^\s]+)',  # Simple format
-            r'(?:Tra cứu[^:]*tại|Trang tra cứu|website)[:\s]*(https?://[^\s]+)',
-            r'(https?://[^\s]*(?:tracuu|tra-cuu|invoice|vnpt-invoice|minvoice)[^\s]*)',
-            # Pattern for links without http/https (e.g. hoadon.pvoil.vn, tracuu.wininvoice.vn)
-            r'(?:Tra cứu[^:]*tại|Trang tra cứu|website)[:\s]*([a-zA-Z0-9.-]+\.[a-zA-Z]{2,}(?:/[^\s]*)?)',
-        ]
-        for pattern in link_patterns:
-            match = re.search(pattern, full_text, re.IGNORECASE)
-            if match:
-                link = match.group(1).rstrip('.').rstrip(',')
-                # If link doesn't start with http, prepend http://
-                if not link.lower().startswith('http') and not link.lower().startswith('www'):
-                     link = "http://" + link
-                if "www" in link.lower() and not link.lower().startswith('http'):
-                     link = "http://" + link
-                
-                # Filter out junk that might be matched as domain
-                if '.' in link and len(link) > 5:
-                     data["Link lấy hóa đơn"] = link
-                     break
-        
-        # USER REQUEST: "mã tra cứu luôn hiển thị bên cạnh link tra cứu"
-        # Search specifically for Code near Link (using generic link patterns if exact link mismatch)
-        if not data["Mã tra cứu"]:
-             # Pattern: Link followed by Code (within proximity)
-             # Matches: http://... <space> CODE
-             # We iterate to find the Best candidate
-             prox_patterns = [
-                 r'(?:https?://[^\s]+)[\s\n]+([A-Za-z0-9]{6,50})\b', # Link -> Code
-                 r'\b([A-Za-z0-9]{6,50})[\s\n]+(?:https?://[^\s]+)', # Code -> Link
-             ]
-             for p in prox_patterns:
-                 matches = re.finditer(p, full_text, re.IGNORECASE)
-                 for m in matches:
-                      cand = m.group(1)
-                      # Filter junk
-                      if cand.lower() in ["website", "http", "https", "link", "tại", "vnbox", "vnpt", "invoice"]:
-                          continue
-                      if "tracuu" in cand.lower():
-                          continue
-                      # Filter if it matches MST
-                      if data["Mã số thuế"] and cand == data["Mã số thuế"]:
-                          continue
-                      # Filter if it looks like a pure date (dd/mm/yyyy no separators? rare) or phone number
-                      
-                      # Validation: Lookup Codes usually complicated. 
-                      # If purely numeric, risky? No, some are numeric.
-                      
-                      if 6 <= len(cand) <= 50:
-                           data["Mã tra cứu"] = cand
-                           break
-                 if data["Mã tra cứu"]:
+    # SERIAL NUMBER (Ký hiệu) - Multiple patterns INCLUDING "Series"
+    match = SERIAL_PATTERNS.search(full_text)
+    if match:
+        data["Ký hiệu"] = match.group(1)
+    
+    # SECURITY CODE (Mã tra cứu) - Multiple patterns
+    for i, match in LOOKUP_CODE_PATTERNS.searches(full_text):
+        code = match.group(1)
+        # Avoid capturing URL parts or headers as code
+        if any(x in code.lower() for x in ["http", "tracuu", "website", "invoice", "check", ".com", ".vn", "please", "vui lòng", "quý khách", "access"]):
+            continue
+
+        # Allow longer codes (VNPT uses 32 chars)
+        if 5 <= len(code) <= 35:
+            data["Mã tra cứu"] = code
+            LOOKUP_CODE_PATTERNS.record(i)
+            break
+        elif len(code) > 35:
+            # Very long code might be CQT, store separately
+            if not data["Mã CQT"]:
+                data["Mã CQT"] = code
+    
+    # Fallback: If no Lookup Code found but CQT Code exists (often treated as the unique ID for VNPT/others)
+    # Check this AFTER extracting Code to avoid overwriting invalid long codes
+    
+    # Fallback for PSD.pdf where "Mã tra cứu" is not clearly labeled but looks like a long code
+    if not data["Mã tra cứu"]:
+         # Look for long string of mixed Upper/Digits in footer area (last 200 chars)
+         footer_text = full_text[-500:] 
+         # Common format: no label, just the code
+         potentials = re.findall(r'\b[A-F0-9]{8,}\b', footer_text)
+         for p in potentials:
+             if len(p) >= 10 and not p.isdigit(): # Mix of chars, likely Lookup Code
+                 if "0100" not in p and "030" not in p: # Avoid tax codes
+                     data["Mã tra cứu"] = p
                      break
+    
+    # TAX CODE (MST đơn vị bán) - Look for seller's tax code (first one)
+    tax_codes = []
+    for i, matches in TAX_CODE_PATTERNS.findall(full_text):
+        TAX_CODE_PATTERNS.record(i)
+        # Clean up matches - remove soft hyphens AND spaces
+        cleaned_matches = []
+        for m in matches:
+            clean = m.replace('\u00AD', '').replace(' ', '').strip()
+            # Verify it looks like a tax code (at least 10 chars, digits/hyphens)
+            if len(clean) >= 10 and any(c.isdigit() for c in clean):
+                cleaned_matches.append(clean)
+        tax_codes.extend(cleaned_matches)
+    
+    if len(tax_codes) >= 1 and not data["Mã số thuế"]:
+         # Filter ignore list
+         valid_mst = [t for t in tax_codes if not any(ign in t for ign in ignore_mst) and not any(t in ign for ign in ignore_mst)]
+         if valid_mst:
+             data["Mã số thuế"] = valid_mst[0]  # Seller's tax code (first one)
+    
+    # PETROLIMEX SPECIFIC: OCR often messes up "Ma so thue" label or merges it.
+    # Look for "Ma so thue: 0300555450" or similar in OCR text (normalized)
+    if not data["Mã số thuế"]:
+         # Normalized text: lower, no accents
+         norm_text = doc.folded
+         # Pattern: "ma so thue" or "ma se thue" (OCR typo) followed by digits
+         # Handle "Ma sé thué" -> "ma se thue"
+         petro_mst = re.search(r'(?:ma\s+s[eoc]\s+thue|ma\s+so\s+thue|ma\s+s.\s+thue|mst|tax code)[^0-9]*([0-9]{10,14})', norm_text)
+         if petro_mst:
+             mst_cand = petro_mst.group(1)
+             if not any(x in mst_cand for x in ignore_mst):
+                  data["Mã số thuế"] = mst_cand
+    
+    # Mã CQT (Standard PDF) - overrides a long code stored above when labeled
+    _extract_cqt_code(full_text, data)
+    
+    # FINAL FALLBACK: If Lookup Code is still empty, use CQT Code
+    # REMOVED due to User Request: "không được lấy mã cơ quan thuế thay vào cho mã tra cứu"
+    # if not data["Mã tra cứu"] and data["Mã CQT"]:
+    #    data["Mã tra cứu"] = data["Mã CQT"]
+    
+    # LOOKUP LINK - Multiple patterns
+    _extract_lookup_link(full_text, data)
+    
+    # USER REQUEST: "mã tra cứu luôn hiển thị bên cạnh link tra cứu"
+    # Search specifically for Code near Link (using generic link patterns if exact link mismatch)
+    if not data["Mã tra cứu"]:
+         # Pattern: Link followed by Code (within proximity)
+         # Matches: http://... <space> CODE
+         # We iterate to find the Best candidate
+         prox_patterns = [
+             r'(?:https?://[^\s]+)[\s\n]+([A-Za-z0-9]{6,50})\b', # Link -> Code
+             r'\b([A-Za-z0-9]{6,50})[\s\n]+(?:https?://[^\s]+)', # Code -> Link
+         ]
+         for p in prox_patterns:
+             matches = re.finditer(p, full_text, re.IGNORECASE)
+             for m in matches:
+                  cand = m.group(1)
+                  # Filter junk
+                  if cand.lower() in ["website", "http", "https", "link", "tại", "vnbox", "vnpt", "invoice"]:
+                      continue
+                  if "tracuu" in cand.lower():
+                      continue
+                  # Filter if it matches MST
+                  if data["Mã số thuế"] and cand == data["Mã số thuế"]:
+                      continue
+                  # Filter if it looks like a pure date (dd/mm/yyyy no separators? rare) or phone number
+                  
+                  # Validation: Lookup Codes usually complicated. 
+                  # If purely numeric, risky? No, some are numeric.
+                  
+                  if 6 <= len(cand) <= 50:
+                       data["Mã tra cứu"] = cand
+                       break
+             if data["Mã tra cứu"]:
+                 break
+    
+    # AMOUNTS - Multiple patterns
+    # Before tax
+    for i, matches in BEFORE_TAX_PATTERNS.findall(full_text):
+        # Take the LAST match as it's likely the grand total on the last page
+        data["Số tiền trước Thuế"] = matches[-1]
+        BEFORE_TAX_PATTERNS.record(i)
+        break
+    
+    # VAT AMOUNT (Tiền thuế)
+    for i, matches in VAT_AMOUNT_PATTERNS.findall(full_text):
+        # Take the LAST match
+        data["Tiền thuế"] = matches[-1]
+        VAT_AMOUNT_PATTERNS.record(i)
+        break
+    
+    # VAT RATE BREAKDOWN (detect amounts by specific tax rates)
+    # Format 1 - Sapo: "Thuế suất 8% : 995,000 79,600 1,074,600" where 2nd number is tax
+    # Format 2 - M-Invoice: "Tổng tiền chịu thuế suất: 8% 655.000 52.400 707.400" where 2nd number after % is tax
+    # Format 3 - Simple: "Tổng tiền thuế GTGT 8%: 17.592,59"
+    
+    # Multi-column patterns (Sapo, M-Invoice, MISA): X% before_tax tax_amount total
+    # NOTE: Use [^:\n]* instead of [^:]* to prevent matching across newlines
+    for i, matches in TAX_RATE_COLUMN_PATTERNS.finditer(full_text):
+        column, group_idx = TAX_RATE_COLUMN_PATTERNS.info[i]
+        data[column] = matches[-1].group(group_idx)
+        TAX_RATE_COLUMN_PATTERNS.record(i)
+    
+    # Single-value patterns (try if multi-column didn't find anything)
+    if not any(data[c] for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác"]):
+        for i, matches in TAX_RATE_SIMPLE_PATTERNS.findall(full_text):
+            column, = TAX_RATE_SIMPLE_PATTERNS.info[i]
+            data[column] = matches[-1]
+            TAX_RATE_SIMPLE_PATTERNS.record(i)
+                
+    # Extra Fallback: "Tiền thuế" with simple label (often found in Footer)
+    if not data["Tiền thuế"]:
+        # Try finding just loose "Tiền thuế ...."
+        simple_tax = re.search(r'(?:Tiền thuế|Thuế GTGT|VAT)\s*[\(\d%]*\)?[:\s]*([0-9]+[.,][0-9]+)', full_text, re.IGNORECASE)
+        if simple_tax:
+             data["Tiền thuế"] = simple_tax.group(1)
         
-        # AMOUNTS - Multiple patterns
-        # Before tax
-        before_tax_patterns = [
-            r'Cộng tiền hàng\s*/\s*Total charges[:\s]*([\d\.,]+)',  # C26MAP: Cộng tiền hàng / Total charges: 6.615.000
-            r'Cộng tiền hàng[^:]*[:\s]*([\d\.,]+)',
-            r'Cộng ti[êề]n hàng[^:]*[:\s]*([\d\.,]+)', # OCR typo: tiên
-            r'Tổng tiền chưa thuế[^:]*[:\s]*([\d\.,]+)',  # M-INVOICE
-            r'Thành ti[êềẫ]n trước thuế[^:]*[:\s]*([\d\.,]+)', # OCR typo: tiễn
-            r'Amount before VAT[^:]*[:\s]*([\d\.,]+)',
-            r'Sub total[^:]*[:\s]*([\d\.,]+)',
-        ]
-        for pattern in before_tax_patterns:
-            matches = re.findall(pattern, full_text, re.IGNORECASE)
-            if matches:
-                # Take the LAST match as it's likely the grand total on the last page
-                data["Số tiền trước Thuế"] = matches[-1]
-                break
-        
-        # VAT AMOUNT (Tiền thuế)
-        vat_patterns = [
-            r'Tiền thuế GTGT\s*/\s*VAT[:\s]*([\d\.,]+)',  # C26MAP: Tiền thuế GTGT / VAT: 529.200
-            r'Tổng tiền thuế GTGT \d+%[:\s]*([\d\.,]+)', # Specific rate line
-            r'\|?Tiền thu[êế] GTGT\s*\(\s*\d+\s*%\s*\)\s*([\d\.,]+)', # MOST SPECIFIC: |Tiền thuê GTGT ( 8% ) 59.265
-            r'\|?Tiền thu[êế] GTGT[^:]*[:\s]+(\d[\d\.,]+)', # |Tiền thuê GTGT: 59.265
-            r'Tiền thuế\s*\(VAT\s*Amount\)[^:]*[:\s]*([\d\.,]+)',
-            r'Tổng tiền thuế[^:]*[:\s]*([\d\.,]+)',  # M-INVOICE
-            r'Tiền thu[êế] GTGT[^:]*[:\s]+(\d[\d\.,]+)', # OCR typo: thuê (ensure starts with digit)
-            r'VAT amount[^:]*[:\s]*([\d\.,]+)',
-            r'Cộng tiền thuế GTGT[^:]*[:\s]*([\d\.,]+)',
-        ]
-        for pattern in vat_patterns:
-            matches = re.findall(pattern, full_text, re.IGNORECASE)
-            if matches:
-                 # Take the LAST match
-                data["Tiền thuế"] = matches[-1]
-                break
-        
-        # VAT RATE BREAKDOWN (detect amounts by specific tax rates)
-        # Format 1 - Sapo: "Thuế suất 8% : 995,000 79,600 1,074,600" where 2nd number is tax
-        # Format 2 - M-Invoice: "Tổng tiền chịu thuế suất: 8% 655.000 52.400 707.400" where 2nd number after % is tax
-        # Format 3 - Simple: "Tổng tiền thuế GTGT 8%: 17.592,59"
-        
-        # Multi-column patterns (Sapo, M-Invoice, MISA): X% before_tax tax_amount total
-        # NOTE: Use [^:\n]* instead of [^:]* to prevent matching across newlines
-        multi_col_patterns = [
-            # Sapo/MISA format: "Thuế suất 8%(VAT rate 8%): before tax total" - allow text after %
-            (r'Thuế suất\s*0\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 0%", 2),
-            (r'Thuế suất\s*5\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 2),
-            (r'Thuế suất\s*8\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 2),
-            (r'Thuế suất\s*10\s*%[^:\n]*[:\s]+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 2),
-            # Golden Gate 5-column format: "thuế suất khác... 8% before discount after_disc TAX total"
-            (r'Thuế suất\s*khác[^0-9\n]*8\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 4),
-            (r'Thuế suất\s*khác[^0-9\n]*10\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 4),
-            (r'Thuế suất\s*khác[^0-9\n]*5\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 4),
-            # M-Invoice format: "Tổng tiền chịu thuế suất... 8% before tax total"
-            (r'Tổng tiền chịu thuế suất[^:\n]*:\s*0\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 0%", 2),
-            (r'Tổng tiền chịu thuế suất[^:\n]*:\s*5\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 5%", 2),
-            (r'Tổng tiền chịu thuế suất[^:\n]*:\s*8\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 8%", 2),
-            (r'Tổng tiền chịu thuế suất[^:\n]*:\s*10\s*%\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)\s+(\d[\d\.,]*)', "Thuế 10%", 2),
-            # Format: "Thuế suất GTGT: 8%" (followed by tax amount or just standalone)
-            (r'Thuế suất(?:\s*GTGT)?[:\s]*8\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 8%", 1),
-            (r'Thuế suất(?:\s*GTGT)?[:\s]*10\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 10%", 1),
-            (r'Thuế suất(?:\s*GTGT)?[:\s]*5\s*%\s*Tiền thuế GTGT[:\s]*(\d[\d\.,]*)', "Thuế 5%", 1),
-            # Format: "Tiền thuế GTGT: ( 8% ) 37.037" (C26MCX)
-            (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*8\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 8%", 1),
-            (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*10\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 10%", 1),
-            (r'Tiền thuế GTGT[:\s]*[\(\[]?\s*5\s*%\s*[\)\]]?\s*(\d[\d\.,]*)', "Thuế 5%", 1),
-            # Format: "Tiền thuế ( 10% ): 154.545" (C26TKM) - no GTGT
-            (r'Tiền thuế[:\s]*[\(\[]?\s*10\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 10%", 1),
-            (r'Tiền thuế[:\s]*[\(\[]?\s*8\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 8%", 1),
-            (r'Tiền thuế[:\s]*[\(\[]?\s*5\s*%\s*[\)\]]?[:\s]*(\d[\d\.,]*)', "Thuế 5%", 1),
-            # Loose format: "Tiền thuế ... 10% ... amount"
-            (r'Tiền thuế[^%\d]*10\s*%.*?(\d[\d\.,]*)', "Thuế 10%", 1),
-            (r'Tiền thuế[^%\d]*8\s*%.*?(\d[\d\.,]*)', "Thuế 8%", 1),
-            (r'Tiền thuế[^%\d]*5\s*%.*?(\d[\d\.,]*)', "Thuế 5%", 1),
-        ]
-        for pattern, column, group_idx in multi_col_patterns:
-            matches = list(re.finditer(pattern, full_text, re.IGNORECASE))
-            if matches:
-                data[column] = matches[-1].group(group_idx)
-        
-        # Single-value patterns (try if multi-column didn't find anything)
-        if not any(data[c] for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác"]):
-            simple_patterns = [
-                # "Tổng tiền thuế GTGT 8%: 17.592,59" format
-                (r'Tổng tiền thuế GTGT\s*0\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 0%"),
-                (r'Tổng tiền thuế GTGT\s*5\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 5%"),
-                (r'Tổng tiền thuế GTGT\s*8\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 8%"),
-                (r'Tổng tiền thuế GTGT\s*10\s*%\s*[:\s]*(\d[\d\.,]*)', "Thuế 10%"),
-                # "Thuế GTGT (8%): amount" format
-                (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*0\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 0%"),
-                (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*5\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 5%"),
-                (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*8\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 8%"),
-                (r'(?:thuế gtgt|VAT)\s*[\(\[]?\s*10\s*%\s*[\)\]]?\s*[:\s]*(\d[\d\.,]*)', "Thuế 10%"),
-                # "Tiền thuế GTGT ( 8% ) amount" format (OCR typo)
-                (r'Tiền thu[êế] GTGT\s*\(\s*0\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 0%"),
-                (r'Tiền thu[êế] GTGT\s*\(\s*5\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 5%"),
-                (r'Tiền thu[êế] GTGT\s*\(\s*8\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 8%"),
-                (r'Tiền thu[êế] GTGT\s*\(\s*10\s*%\s*\)\s*(\d[\d\.,]*)', "Thuế 10%"),
-            ]
-            for pattern, column in simple_patterns:
-                matches = re.findall(pattern, full_text, re.IGNORECASE)
-                if matches:
-                    data[column] = matches[-1]
-                matches = re.findall(pattern, full_text, re.IGNORECASE)
-                if matches:
-                    data[column] = matches[-1]
-                    
-        # Extra Fallback: "Tiền thuế" with simple label (often found in Footer)
+        # If still not found, try finding line with "10%" or "8%" and taking the number at the end
         if not data["Tiền thuế"]:
-            # Try finding just loose "Tiền thuế ...."
-            simple_tax = re.search(r'(?:Tiền thuế|Thuế GTGT|VAT)\s*[\(\d%]*\)?[:\s]*([0-9]+[.,][0-9]+)', full_text, re.IGNORECASE)
-            if simple_tax:
-                 data["Tiền thuế"] = simple_tax.group(1)
-            
-            # If still not found, try finding line with "10%" or "8%" and taking the number at the end
-            if not data["Tiền thuế"]:
-                 rate_lines = re.findall(r'(?:10%|8%)\s+([0-9][\d\.,]+)', full_text)
-                 if rate_lines:
-                     # Usually the last number on a "10%" line is the tax amount or total
-                     # This is risky but better than nothing for 0318...pdf
-                     pass
-
-        # SERVICE CHARGE (Phí PV)
-        # Pattern: Phí PV(Sevice change): 400.507
-        pv_match = re.search(r'Phí\s*PV[^:]*[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
-        if pv_match:
-            data["Phí PV"] = pv_match.group(1)
-
-
-
-        # If we found total tax but no breakdown, calculate rate from amounts
-        if data["Tiền thuế"] and not any(data[c] for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%"]):
-            total_tax = parse_money(data["Tiền thuế"])
-            before_tax = parse_money(data["Số tiền trước Thuế"])
-            if total_tax and before_tax and before_tax > 0:
-                rate = round(total_tax / before_tax * 100)
-                if rate in [0, 5, 8, 10]:
-                    key = f"Thuế {rate}%"
-                    # Calculate implicitly to ensure correct rounding if we are filling it
-                    # But here we just move Total Tax to the bucket.
-                    # However, if we ever needed to recalculate Pre-Tax, we need consistent logic.
-                    data[key] = data["Tiền thuế"]
-                else:
-                    data["Thuế khác"] = data["Tiền thuế"]
-        
-        # Priority 3.5: Handle "Hóa đơn bán hàng" (Sales Invoice - direct sale, often no dedicated TAX line)
-        # Identify by Title or "Total amount" pattern from log: "a, dịch vụ(Total amount): 5.400.000"
-        is_sales_invoice = "HÓA ĐƠN BÁN HÀNG" in full_text.upper() or "(SALES INVOICE)" in full_text.upper()
+             rate_lines = re.findall(r'(?:10%|8%)\s+([0-9][\d\.,]+)', full_text)
+             if rate_lines:
+                 # Usually the last number on a "10%" line is the tax amount or total
+                 # This is risky but better than nothing for 0318...pdf
+                 pass
+
+    # SERVICE CHARGE (Phí PV)
+    _extract_service_fee(full_text, data)
+
+
+def reconcile_amounts(doc, data, services):
+    """
+    Tax reconciliation stage: fill missing totals from each other, the summary
+    table and the line items. Returns the cleaned line items.
+    :param doc: Document (or cleaned text) of the invoice
+    """
+    doc = as_document(doc)
+    full_text = doc.text
+    line_items = []
+
+    # If we found total tax but no breakdown, calculate rate from amounts
+    if data["Tiền thuế"] and not any(data[c] for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%"]):
+        total_tax = _parse_amount(data["Tiền thuế"])
+        before_tax = _parse_amount(data["Số tiền trước Thuế"])
+        if total_tax and before_tax and before_tax > 0:
+            rate = round(total_tax / before_tax * 100)
+            if rate in [0, 5, 8, 10]:
+                key = f"Thuế {rate}%"
+                # Calculate implicitly to ensure correct rounding if we are filling it
+                # But here we just move Total Tax to the bucket.
+                # However, if we ever needed to recalculate Pre-Tax, we need consistent logic.
+                data[key] = data["Tiền thuế"]
+            else:
+                data["Thuế khác"] = data["Tiền thuế"]
+    
+    # Priority 3.5: Handle "Hóa đơn bán hàng" (Sales Invoice - direct sale, often no dedicated TAX line)
+    # Identify by Title or "Total amount" pattern from log: "a, dịch vụ(Total amount): 5.400.000"
+    full_text_upper = doc.upper
+    is_sales_invoice = "HÓA ĐƠN BÁN HÀNG" in full_text_upper or "(SALES INVOICE)" in full_text_upper
+    
+    if is_sales_invoice:
+         # Try to find total amount if missing
+         if not data["Số tiền sau"]:
+             # Pattern from log: "a, dịch vụ(Total amount): 5.400.000"
+             # And generic "Total amount: ..."
+             sales_total_match = re.search(r'(?:Total amount|dịch vụ\s*\(Total amount\))[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
+             if sales_total_match:
+                 data["Số tiền sau"] = sales_total_match.group(1).strip()
         
-        if is_sales_invoice:
-             # Try to find total amount if missing
-             if not data["Số tiền sau"]:
-                 # Pattern from log: "a, dịch vụ(Total amount): 5.400.000"
-                 # And generic "Total amount: ..."
-                 sales_total_match = re.search(r'(?:Total amount|dịch vụ\s*\(Total amount\))[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
-                 if sales_total_match:
-                     data["Số tiền sau"] = sales_total_match.group(1).strip()
+         # For Sales Invoice, if 'Tax' is missing, usually Header Amount = Total Amount
+         if data["Số tiền sau"] and not data["Số tiền trước Thuế"]:
+             data["Số tiền trước Thuế"] = data["Số tiền sau"]
+             # Tax is implicitly included or 0, but usually we just leave Tax empty or 0
+    
+    # Priority 4: Auto-classify "Dịch vụ du lịch"
+    # Check Seller Name for keywords
+    seller_upper = data.get("Đơn vị bán", "").upper()
+    
+    if "DU LỊCH" in seller_upper or "TRAVEL" in seller_upper or "DỊCH VỤ DU LỊCH" in full_text_upper:
+        data["Phân loại"] = "Dịch vụ du lịch"
+    
+    # Refine Seller Name for this specific invoice if it was cut off
+    # Text: "HỘ KINH DOANH DỊCH VỤ DU LỊCH NHÂN LỢI PHÁT"
+    if "NHÂN LỢI PHÁT" in full_text_upper and not data["Đơn vị bán"]:
+         seller_match = re.search(r'HỘ KINH DOANH DỊCH VỤ DU LỊCH [^\n]+', full_text, re.IGNORECASE)
+         if seller_match:
+             data["Đơn vị bán"] = seller_match.group(0).strip()
+    
+    # After tax (total payment)
+    for i, matches in AFTER_TAX_PATTERNS.finditer(full_text):
+        AFTER_TAX_PATTERNS.record(i)
+        match = matches[-1] # Take the LAST match
             
-             # For Sales Invoice, if 'Tax' is missing, usually Header Amount = Total Amount
-             if data["Số tiền sau"] and not data["Số tiền trước Thuế"]:
-                 data["Số tiền trước Thuế"] = data["Số tiền sau"]
-                 # Tax is implicitly included or 0, but usually we just leave Tax empty or 0
-        
-        # Priority 4: Auto-classify "Dịch vụ du lịch"
-        # Check Seller Name for keywords
-        seller_upper = data.get("Đơn vị bán", "").upper()
-        full_text_upper = full_text.upper()
-        
-        if "DU LỊCH" in seller_upper or "TRAVEL" in seller_upper or "DỊCH VỤ DU LỊCH" in full_text_upper:
-            data["Phân loại"] = "Dịch vụ du lịch"
-        
-        # Refine Seller Name for this specific invoice if it was cut off
-        # Text: "HỘ KINH DOANH DỊCH VỤ DU LỊCH NHÂN LỢI PHÁT"
-        if "NHÂN LỢI PHÁT" in full_text_upper and not data["Đơn vị bán"]:
-             seller_match = re.search(r'HỘ KINH DOANH DỊCH VỤ DU LỊCH [^\n]+', full_text, re.IGNORECASE)
-             if seller_match:
-                 data["Đơn vị bán"] = seller_match.group(0).strip()
-        
-        # After tax (total payment)
-        after_tax_patterns = [
-            r'Tổng cộng\s*/\s*Total Amount[:\s]*([\d\.,]+)',  # C26MAP: Tổng cộng / Total Amount: 7.144.200
-            # Golden Gate 5-column FIRST (most specific): 5 numbers separated by spaces
-            r'Tổng cộng tiền thanh toán\s*\(Total amount\)\s*([\d\.,\s]+)', # Golden Gate: 5 numbers, take the last one
-            # 3-column patterns
-            r'Tổng cộng\s*\(Total amount\)\s*[:]\s*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # File 2025_812...
-            r'Tổng\s*cộng\s*\([Tt]otal\)?[:\s]*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # MISA: Tổng cộng(Total): 375.000 30.000 405.000
-            r'Tổngcộng[:\s]*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # No-space: Tổngcộng: 2.816.100 256.158 3.072.258
-            r'Tổng cộng\s*[:]\s*([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # SAPO/EasyInvoice: Tổng cộng: [Before] [VAT] [Total]
-            r'Tổng tiền chịu thuế suất.*[:\s]*[\d\.,]*%\s+([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', # M-INVOICE table summary
-            r'[Tt]ổng\s*tiền\s*thanh\s*toán\s*\([^)]+\)[:\s]*([\d\.,]+)',  # MISA: Tổng tiền thanh toán (Total amount): 1.800.000
-            r'[IT].{1,3}ng\s*số\s*ti[êề]n\s*thanh\s*toán[:\s]*([\d\.,]+)', # OCR typo: Iông, tiên (Petrolimex)
-            r'Cộng tiền hàng hóa, dịch vụ[:\s]*[\d\.,]+\s+[\d\.,]+\s+([\d\.,]+)', # File 1226-TK-200k (Total on next line)
-            r'[Tt]ổng\s*cộng\s*tiền\s*thanh\s*toán[^:]*[:\s]*([\d\.,]+)',
-            r'[Tt]otal\s*payment[^:]*[:\s]*([\d\.,]+)',
-            r'TỔNG CỘNG TIỀN THANH TOÁN[^:]*[:\s]*([\d\.,]+)',
-            r'Tổng cộng[:\s]+([\d\.,]+)\s+[\d\.,]+\s+([\d\.,]+)',  # Multi-page format
-            r'thuế suất:\s*\d+%\s+([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)',  # Tax rate line
-        ]
-        for pattern in after_tax_patterns:
-            matches = list(re.finditer(pattern, full_text, re.IGNORECASE))
-            if matches:
-                match = matches[-1] # Take the LAST match
-                
-                # Handle multi-column format (before_tax, vat, after_tax)
-                if match.lastindex and match.lastindex >= 3:
-                    # Specific check for SAPO/EasyInvoice where Group 1=Before, Group 2=VAT, Group 3=Total
-                    # Overwrite existing values as summary line is more reliable
-                    data["Số tiền sau"] = match.group(match.lastindex)
-                    data["Tiền thuế"] = match.group(2)
-                    data["Số tiền trước Thuế"] = match.group(1)
-                elif match.lastindex and match.lastindex >= 2:
-                    data["Số tiền sau"] = match.group(match.lastindex)
-                    # For format with 2 columns, be careful about overwriting
-                    if not data["Số tiền trước Thuế"]:
-                        data["Số tiền trước Thuế"] = match.group(1)
-                else:
-                    # Single group or Golden Gate complex case
-                    val = match.group(1)
-                    # Use helper split if it looks like multiple numbers (Golden Gate)
-                    parts = val.strip().split()
-                    if len(parts) >= 5 and all(c in '0123456789.,' for c in ''.join(parts)):
-                         # Golden Gate 5-column: before discount after_disc TAX total
-                         # 1.656.000 100.000 1.556.000 124.480 1.680.480
-                         data["Số tiền sau"] = parts[-1]      # 1.680.480
-                         data["Tiền thuế"] = parts[-2]        # 124.480
-                         data["Số tiền trước Thuế"] = parts[0] # 1.656.000 (NOT parts[-3])
-                    elif len(parts) >= 3 and all(c in '0123456789.,' for c in ''.join(parts)):
-                         # 3-column: before TAX total
-                         data["Số tiền sau"] = parts[-1]
-                         data["Tiền thuế"] = parts[-2]
-                         data["Số tiền trước Thuế"] = parts[0]
-                    else:
-                         data["Số tiền sau"] = val
-                break
-        
-        # SPECIAL CASE: Hộ Kinh Doanh with Tax Reduction Note (Nghị quyết 204/2025/QH15)
-        # e.g. "Cộng tiền bán hàng hóa, dịch vụ: 2.289.962" -> This is the final amount to pay
-        if not data["Số tiền sau"] or not data["Số tiền trước Thuế"]:
-             # Check for "Cộng tiền bán hàng hóa, dịch vụ" which is common in direct sales invoices
-             direct_sales_match = re.search(r'Cộng tiền bán hàng hóa, dịch vụ[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
-             if direct_sales_match:
-                 amount = direct_sales_match.group(1)
-                 # If we haven't set "Số tiền sau", use this. 
-                 # Usually for Hộ Kinh Doanh, total payment = total goods amount (minus discount if any, but usually final)
-                 if not data["Số tiền sau"]:
-                     data["Số tiền sau"] = amount
-                 if not data["Số tiền trước Thuế"]:
-                     data["Số tiền trước Thuế"] = amount
-                 # If extracted "Tiền thuế" is empty, it might be 0 or calculated from reduction note, 
-                 # but usually direct sales don't list VAT separately like deductive invoices. 
-                 # We leave VAT empty or 0 if not found.
-
-        # SPECIAL PATTERN: Before Tax + VAT on one line (File 1226-TK-200k.pdf)
-        # Cộng tiền hàng hóa, dịch vụ: 219.907 17.593
-        # Prioritize this summary line as it matches User's preferred values (rounded)
-        double_match = re.search(r'Cộng tiền hàng hóa, dịch vụ[:\s]*([\d\.,]+)\s+([\d\.,]+)', full_text, re.IGNORECASE)
-        if double_match:
-             # Check if the second number looks like money (digits/dots)
-             # Force overwrite to ensure we get the summary values
-             data["Số tiền trước Thuế"] = double_match.group(1)
-             data["Tiền thuế"] = double_match.group(2)
-        
-        # For SALES INVOICE (no VAT): if Số tiền sau is empty but we have before tax amount
-        if not data["Số tiền sau"] and data["Số tiền trước Thuế"]:
-            if "SALES INVOICE" in full_text or "HÓA ĐƠN BÁN HÀNG" in full_text:
-                data["Số tiền sau"] = data["Số tiền trước Thuế"]
+        # Handle multi-column format (before_tax, vat, after_tax)
+        if match.lastindex and match.lastindex >= 3:
+            # Specific check for SAPO/EasyInvoice where Group 1=Before, Group 2=VAT, Group 3=Total
+            # Overwrite existing values as summary line is more reliable
+            data["Số tiền sau"] = match.group(match.lastindex)
+            data["Tiền thuế"] = match.group(2)
+            data["Số tiền trước Thuế"] = match.group(1)
+        elif match.lastindex and match.lastindex >= 2:
+            data["Số tiền sau"] = match.group(match.lastindex)
+            # For format with 2 columns, be careful about overwriting
+            if not data["Số tiền trước Thuế"]:
+                data["Số tiền trước Thuế"] = match.group(1)
+        else:
+            # Single group or Golden Gate complex case
+            val = match.group(1)
+            # Use helper split if it looks like multiple numbers (Golden Gate)
+            parts = val.strip().split()
+            if len(parts) >= 5 and all(c in '0123456789.,' for c in ''.join(parts)):
+                 # Golden Gate 5-column: before discount after_disc TAX total
+                 # 1.656.000 100.000 1.556.000 124.480 1.680.480
+                 data["Số tiền sau"] = parts[-1]      # 1.680.480
+                 data["Tiền thuế"] = parts[-2]        # 124.480
+                 data["Số tiền trước Thuế"] = parts[0] # 1.656.000 (NOT parts[-3])
+            elif len(parts) >= 3 and all(c in '0123456789.,' for c in ''.join(parts)):
+                 # 3-column: before TAX total
+                 data["Số tiền sau"] = parts[-1]
+                 data["Tiền thuế"] = parts[-2]
+                 data["Số tiền trước Thuế"] = parts[0]
             else:
-                sales_match = re.search(r'Cộng tiền bán hàng[^:]*[:\s]*([\d\.,]+)', full_text)
-                if sales_match:
-                    data["Số tiền sau"] = sales_match.group(1)
-        
-        # Calculate and validate money values
-        # Validate money values - must be >= 1000
-        for col in ["Số tiền trước Thuế", "Tiền thuế", "Số tiền sau"]:
-            val = parse_money(data[col])
-            if val is not None and val < 1000:
-                data[col] = ""  # Invalid, clear it
-        
-        # Calculate Số tiền sau if not found but we have before tax and VAT
-        if not data["Số tiền sau"]:
-            before = parse_money(data["Số tiền trước Thuế"])
-            vat = parse_money(data["Tiền thuế"])
-            if before is not None and vat is not None:
-                data["Số tiền sau"] = format_money(before + vat)
-            elif before is not None and vat is None:
-                # No VAT found yet. BUT check if we have "Thuế khác" indicating a rate!
-                # If we have a rate (e.g. "10"), we should NOT assume Total = PreTax yet.
-                if data["Thuế khác"] and data["Thuế khác"].strip() in ["10", "5", "8"]:
-                     pass # Wait for calculation
-                
-                # If Thuế khác is same as Total or Tax, it's noise
-                if data["Thuế khác"]:
-                     val_num = parse_money(data["Thuế khác"])
-                     total_num = parse_money(data["Số tiền sau"])
-                     tax_num = parse_money(data["Tiền thuế"])
-                     if val_num and (val_num == total_num or val_num == tax_num):
-                          data["Thuế khác"] = ""
-                else:
-                    # No VAT, total = before tax
-                    data["Số tiền sau"] = data["Số tiền trước Thuế"]
-        
-        # REVERSE CASE: If we have Số tiền sau (total) but no Số tiền trước Thuế (before tax)
-        # and no VAT was found, then this is a non-VAT invoice, so set pre-tax = post-tax
-        if data["Số tiền sau"] and not data["Số tiền trước Thuế"]:
-            after = parse_money(data["Số tiền sau"])
-            vat = parse_money(data["Tiền thuế"])
-            if after is not None and (vat is None or vat == 0):
-                # No VAT found or VAT is 0, so pre-tax = post-tax
-                data["Số tiền trước Thuế"] = data["Số tiền sau"]
-            elif after is not None and vat is not None:
-                # VAT exists, so calculate pre-tax = post-tax - VAT
-                # VAT exists, so calculate pre-tax = post-tax - VAT
-                data["Số tiền trước Thuế"] = format_money(after - vat)
-        
-        # SPECIAL FIX for PSD.pdf where total is hidden in garbage
-        # We recovered "2,950,000" from garbage but regex didn't catch it as Total.
-        # Check if we have a valid recovered amount in line items but no Invoice Total?
-        # Actually, let's look for the specific garbage string containing the Total
-        if not data["Số tiền sau"]:
-             garbage_total = re.search(r"0'}([\d\.,]+)'\}'\}", full_text)
-             if garbage_total:
-                 val = garbage_total.group(1)
                  data["Số tiền sau"] = val
-                 # Use this as PreTax too if missing (or calc tax)
-                 if not data["Số tiền trước Thuế"]:
-                      data["Số tiền trước Thuế"] = val
-
-        # FALLBACK: If "Số tiền trước Thuế" or "Số tiền sau" is still missing, 
-        # try to sum up the Line Items!
-        if (not data["Số tiền trước Thuế"] or not data["Số tiền sau"]) and line_items:
-            print("  -> Calculating totals from line items...")
-            total_items = 0
-            for item in line_items:
-                amt = parse_money(item.get("amount", "0"))
-                if amt:
-                    total_items += amt
+        break
+    
+    # SPECIAL CASE: Hộ Kinh Doanh with Tax Reduction Note (Nghị quyết 204/2025/QH15)
+    # e.g. "Cộng tiền bán hàng hóa, dịch vụ: 2.289.962" -> This is the final amount to pay
+    if not data["Số tiền sau"] or not data["Số tiền trước Thuế"]:
+         # Check for "Cộng tiền bán hàng hóa, dịch vụ" which is common in direct sales invoices
+         direct_sales_match = re.search(r'Cộng tiền bán hàng hóa, dịch vụ[:\s]*([\d\.,]+)', full_text, re.IGNORECASE)
+         if direct_sales_match:
+             amount = direct_sales_match.group(1)
+             # If we haven't set "Số tiền sau", use this. 
+             # Usually for Hộ Kinh Doanh, total payment = total goods amount (minus discount if any, but usually final)
+             if not data["Số tiền sau"]:
+                 data["Số tiền sau"] = amount
+             if not data["Số tiền trước Thuế"]:
+                 data["Số tiền trước Thuế"] = amount
+             # If extracted "Tiền thuế" is empty, it might be 0 or calculated from reduction note, 
+             # but usually direct sales don't list VAT separately like deductive invoices. 
+             # We leave VAT empty or 0 if not found.
+
+    # SPECIAL PATTERN: Before Tax + VAT on one line (File 1226-TK-200k.pdf)
+    # Cộng tiền hàng hóa, dịch vụ: 219.907 17.593
+    # Prioritize this summary line as it matches User's preferred values (rounded)
+    double_match = re.search(r'Cộng tiền hàng hóa, dịch vụ[:\s]*([\d\.,]+)\s+([\d\.,]+)', full_text, re.IGNORECASE)
+    if double_match:
+         # Check if the second number looks like money (digits/dots)
+         # Force overwrite to ensure we get the summary values
+         data["Số tiền trước Thuế"] = double_match.group(1)
+         data["Tiền thuế"] = double_match.group(2)
+    
+    # For SALES INVOICE (no VAT): if Số tiền sau is empty but we have before tax amount
+    if not data["Số tiền sau"] and data["Số tiền trước Thuế"]:
+        if "SALES INVOICE" in full_text or "HÓA ĐƠN BÁN HÀNG" in full_text:
+            data["Số tiền sau"] = data["Số tiền trước Thuế"]
+        else:
+            sales_match = re.search(r'Cộng tiền bán hàng[^:]*[:\s]*([\d\.,]+)', full_text)
+            if sales_match:
+                data["Số tiền sau"] = sales_match.group(1)
+    
+    # Calculate and validate money values
+    # Validate money values - must be >= 1000
+    for col in ["Số tiền trước Thuế", "Tiền thuế", "Số tiền sau"]:
+        val = _parse_amount(data[col])
+        if val is not None and val < 1000:
+            data[col] = ""  # Invalid, clear it
+    
+    # Calculate Số tiền sau if not found but we have before tax and VAT
+    if not data["Số tiền sau"]:
+        before = _parse_amount(data["Số tiền trước Thuế"])
+        vat = _parse_amount(data["Tiền thuế"])
+        if before is not None and vat is not None:
+            data["Số tiền sau"] = _format_amount(before + vat)
+        elif before is not None and vat is None:
+            # No VAT found yet. BUT check if we have "Thuế khác" indicating a rate!
+            # If we have a rate (e.g. "10"), we should NOT assume Total = PreTax yet.
+            if data["Thuế khác"] and data["Thuế khác"].strip() in ["10", "5", "8"]:
+                 pass # Wait for calculation
             
-            if total_items > 0:
-                if not data["Số tiền trước Thuế"] and not data["Số tiền sau"]:
-                     # Assume line items are pre-tax (standard) or post-tax? 
-                     # Usually line items amount column is Before Tax.
-                     data["Số tiền trước Thuế"] = format_money(total_items)
-                elif not data["Số tiền trước Thuế"]:
-                     data["Số tiền trước Thuế"] = format_money(total_items)
-                elif not data["Số tiền sau"]:
-                     # If we have PreTax but no PostTax, we need Tax to calc Total.
-                     # If we just calculated PreTax, let's see if we can calc Total
-                     pass
-                     
-        # Re-run Tax Calculation in case we just populated Pre-Tax from items
-        if data["Tiền thuế"] and not data["Số tiền sau"] and data["Số tiền trước Thuế"]:
-             b = parse_money(data["Số tiền trước Thuế"])
-             t = parse_money(data["Tiền thuế"])
-             if b and t:
-                 data["Số tiền sau"] = format_money(b + t)
-        
-        # --- NEW STRATEGY: PARSE SUMMARY TABLES (Footer) ---
-        # Many invoices (like PSD.pdf and 0318...pdf) have a summary block with tax rates
-        # Pattern: "Hàng hóa ... 8% ... [PreTax] ... [Tax] ... [Total]"
-        # Pattern: "Cộng HHDV ... 10% ... [PreTax] ... [Tax]"
-        
-        # 1. Parse Detail Lines for Tax Rates (8%, 10%, 5%, 0%)
-        # Look for lines containing "8%" or "10%" followed by multiple money numbers
-        summary_lines = re.findall(r'(?:Hàng hóa|Cộng HHDV|Thuế suất|Total amount).*?(10%|8%|5%|0%).*?([\d\.,]+)\s+([\d\.,]+)(?:\s+([\d\.,]+))?', full_text, re.IGNORECASE)
-        
-        tax_total_calc = 0
-        pre_tax_total_calc = 0
+            # If Thuế khác is same as Total or Tax, it's noise
+            if data["Thuế khác"]:
+                 val_num = _parse_amount(data["Thuế khác"])
+                 total_num = _parse_amount(data["Số tiền sau"])
+                 tax_num = _parse_amount(data["Tiền thuế"])
+                 if val_num and (val_num == total_num or val_num == tax_num):
+                      data["Thuế khác"] = ""
+            else:
+                # No VAT, total = before tax
+                data["Số tiền sau"] = data["Số tiền trước Thuế"]
+    
+    # REVERSE CASE: If we have Số tiền sau (total) but no Số tiền trước Thuế (before tax)
+    # and no VAT was found, then this is a non-VAT invoice, so set pre-tax = post-tax
+    if data["Số tiền sau"] and not data["Số tiền trước Thuế"]:
+        after = _parse_amount(data["Số tiền sau"])
+        vat = _parse_amount(data["Tiền thuế"])
+        if after is not None and (vat is None or vat == 0):
+            # No VAT found or VAT is 0, so pre-tax = post-tax
+            data["Số tiền trước Thuế"] = data["Số tiền sau"]
+        elif after is not None and vat is not None:
+            # VAT exists, so calculate pre-tax = post-tax - VAT
+            # VAT exists, so calculate pre-tax = post-tax - VAT
+            data["Số tiền trước Thuế"] = _format_amount(after - vat)
+    
+    # SPECIAL FIX for PSD.pdf where total is hidden in garbage
+    # We recovered "2,950,000" from garbage but regex didn't catch it as Total.
+    # Check if we have a valid recovered amount in line items but no Invoice Total?
+    # Actually, let's look for the specific garbage string containing the Total
+    if not data["Số tiền sau"]:
+         garbage_total = re.search(r"0'}([\d\.,]+)'\}'\}", full_text)
+         if garbage_total:
+             val = garbage_total.group(1)
+             data["Số tiền sau"] = val
+             # Use this as PreTax too if missing (or calc tax)
+             if not data["Số tiền trước Thuế"]:
+                  data["Số tiền trước Thuế"] = val
+
+    # FALLBACK: If "Số tiền trước Thuế" or "Số tiền sau" is still missing, 
+    # try to sum up the Line Items!
+    if (not data["Số tiền trước Thuế"] or not data["Số tiền sau"]) and line_items:
+        print("  -> Calculating totals from line items...")
+        total_items = 0
+        for item in line_items:
+            amt = _parse_amount(item.get("amount", "0"))
+            if amt:
+                total_items += amt
         
-        for rate_str, num1, num2, num3 in summary_lines:
-            # Usually: Rate, PreTax, Tax, [Total] OR Rate, [Total], [Tax]
-            # Heuristic: Tax is usually smaller than PreTax. 
-            # num1, num2, num3 are strings.
-            try:
-                vals = [parse_money(n) for n in [num1, num2, num3] if n]
-                vals.sort() # Sorted: [Smallest, Medium, Largest]
+        if total_items > 0:
+            if not data["Số tiền trước Thuế"] and not data["Số tiền sau"]:
+                 # Assume line items are pre-tax (standard) or post-tax? 
+                 # Usually line items amount column is Before Tax.
+                 data["Số tiền trước Thuế"] = _format_amount(total_items)
+            elif not data["Số tiền trước Thuế"]:
+                 data["Số tiền trước Thuế"] = _format_amount(total_items)
+            elif not data["Số tiền sau"]:
+                 # If we have PreTax but no PostTax, we need Tax to calc Total.
+                 # If we just calculated PreTax, let's see if we can calc Total
+                 pass
+                 
+    # Re-run Tax Calculation in case we just populated Pre-Tax from items
+    if data["Tiền thuế"] and not data["Số tiền sau"] and data["Số tiền trước Thuế"]:
+         b = _parse_amount(data["Số tiền trước Thuế"])
+         t = _parse_amount(data["Tiền thuế"])
+         if b and t:
+             data["Số tiền sau"] = _format_amount(b + t)
+    
+    # --- NEW STRATEGY: PARSE SUMMARY TABLES (Footer) ---
+    # Many invoices (like PSD.pdf and 0318...pdf) have a summary block with tax rates
+    # Pattern: "Hàng hóa ... 8% ... [PreTax] ... [Tax] ... [Total]"
+    # Pattern: "Cộng HHDV ... 10% ... [PreTax] ... [Tax]"
+    
+    # 1. Parse Detail Lines for Tax Rates (8%, 10%, 5%, 0%)
+    # Look for lines containing "8%" or "10%" followed by multiple money numbers
+    summary_lines = re.findall(r'(?:Hàng hóa|Cộng HHDV|Thuế suất|Total amount).*?(10%|8%|5%|0%).*?([\d\.,]+)\s+([\d\.,]+)(?:\s+([\d\.,]+))?', full_text, re.IGNORECASE)
+    
+    tax_total_calc = 0
+    pre_tax_total_calc = 0
+    
+    for rate_str, num1, num2, num3 in summary_lines:
+        # Usually: Rate, PreTax, Tax, [Total] OR Rate, [Total], [Tax]
+        # Heuristic: Tax is usually smaller than PreTax. 
+        # num1, num2, num3 are strings.
+        try:
+            vals = [_parse_amount(n) for n in [num1, num2, num3] if n]
+            vals.sort() # Sorted: [Smallest, Medium, Largest]
+            
+            # Smallest is likely Tax (if > 0)
+            # Largest is Total (or PreTax if Total missing)
+            
+            # If we have 2 numbers: PreTax and Tax
+            # If we have 3 numbers: PreTax, Tax, Total
+            
+            if len(vals) >= 2:
+                current_tax = vals[0]
+                current_pre = vals[-1] # Largest is PreTax (if 2 nums) or Total (if 3 nums)? 
+                # Actually, if 3 nums: Tax, PreTax, Total. PreTax is middle.
+                if len(vals) == 3:
+                     current_pre = vals[1]
                 
-                # Smallest is likely Tax (if > 0)
-                # Largest is Total (or PreTax if Total missing)
+                # Store in specific tax column
+                rate_key = f"Thuế {rate_str}"
+                data[rate_key] = _format_amount(current_tax)
                 
-                # If we have 2 numbers: PreTax and Tax
-                # If we have 3 numbers: PreTax, Tax, Total
+                tax_total_calc += current_tax
+                pre_tax_total_calc += current_pre
                 
-                if len(vals) >= 2:
-                    current_tax = vals[0]
-                    current_pre = vals[-1] # Largest is PreTax (if 2 nums) or Total (if 3 nums)? 
-                    # Actually, if 3 nums: Tax, PreTax, Total. PreTax is middle.
-                    if len(vals) == 3:
-                         current_pre = vals[1]
+                # print(f"  -> Found Summary Line: {rate_str} | Tax: {current_tax} | Pre: {current_pre}")
+        except:
+            pass
+    
+    # If we found summary data, assume it's the source of truth for Totals
+    if tax_total_calc > 0:
+        if not data["Tiền thuế"] or _parse_amount(data["Tiền thuế"]) != tax_total_calc:
+             data["Tiền thuế"] = _format_amount(tax_total_calc)
+    
+    # 2. Parse Grand Total Line with multiple numbers
+    # Pattern: "Tổng cộng tiền ... [PreTax] [Tax] [Total]" (common in 0318...pdf)
+    grand_total_match = re.search(r'(?:Tổng cộng tiền|Grand total).*?([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', full_text, re.IGNORECASE)
+    if grand_total_match:
+         v1 = _parse_amount(grand_total_match.group(1))
+         v2 = _parse_amount(grand_total_match.group(2))
+         v3 = _parse_amount(grand_total_match.group(3))
+         
+         vals = [v for v in [v1, v2, v3] if v is not None]
+         vals.sort()
+         if len(vals) == 3:
+             # Tax, PreTax, Total
+             data["Tiền thuế"] = _format_amount(vals[0])
+             data["Số tiền trước Thuế"] = _format_amount(vals[1])
+             data["Số tiền sau"] = _format_amount(vals[2])
+             print(f"  -> Found Grand Total Line: Total={vals[2]}, Tax={vals[0]}")
+
+    # Missing Lookup Code for PSD.pdf (e5100...)
+    if not data["Mã tra cứu"]:
+         # Pattern: "nhập mã ...", "key in the provided code ... : [code]"
+         code_match = re.search(r'(?:nhập mã|provided code).*?([a-f0-9]{30,})', full_text, re.IGNORECASE)
+         if code_match:
+             data["Mã tra cứu"] = code_match.group(1)
+         
+         # Additional Lookup Code Pattern (PC-...)
+         # Example: PC-260107070845-3863477
+         pc_match = re.search(r'Mã tra cứu[:\s]*([A-Z0-9-]+)', full_text, re.IGNORECASE)
+         if pc_match:
+             data["Mã tra cứu"] = pc_match.group(1)
+    
+    # FINAL: If Tax Rate found (e.g. "Thuế khác": "10") but Column Empty, fill it
+    # This fixes 0318...pdf where "Thuế khác" picked up "10" but didn't fill "Thuế 10%"
+    if data["Thuế khác"] in ["10", "8", "5", "0"]:
+        rate_key = f"Thuế {data['Thuế khác']}%"
+        if not data[rate_key] and data["Tiền thuế"]:
+            data[rate_key] = data["Tiền thuế"]
+            data["Thuế khác"] = ""
+        elif not data[rate_key] and data["Số tiền trước Thuế"]:
+            # Calculate tax from rate
+            try:
+                rate = int(data["Thuế khác"])
+                pre = _parse_amount(data["Số tiền trước Thuế"])
+                if pre:
+                    calc_tax = int(round(pre * rate / 100))
+                    data[rate_key] = _format_amount(calc_tax)
+                    if not data["Tiền thuế"]:
+                         data["Tiền thuế"] = _format_amount(calc_tax)
                     
-                    # Store in specific tax column
-                    rate_key = f"Thuế {rate_str}"
-                    data[rate_key] = format_money(current_tax)
+                    # Use loose check for Total assignment
+                    current_total = _parse_amount(data["Số tiền sau"])
+                    pre_val = _parse_amount(data["Số tiền trước Thuế"])
                     
-                    tax_total_calc += current_tax
-                    pre_tax_total_calc += current_pre
+                    # If Total is empty OR Total == PreTax (from premature assignment), update it!
+                    if not data["Số tiền sau"] or (current_total and pre_val and abs(current_total - pre_val) < 100):
+                         data["Số tiền sau"] = _format_amount(pre + calc_tax)
                     
-                    # print(f"  -> Found Summary Line: {rate_str} | Tax: {current_tax} | Pre: {current_pre}")
+                    data["Thuế khác"] = ""
             except:
                 pass
+
+    
+    
+    # Store line items for multi-row expansion
+    if services:
+        line_items = services
+        # POST-PROCESS: Clean garbage from items
+        for item in line_items:
+            for k in ["name", "amount"]:
+                val = item.get(k, "")
+                if isinstance(val, str) and ("0'}" in val or "}'}" in val):
+                    # Standard Garbage Removal using Regex
+                    garbage_match = re.search(r"0'}.*?([\d\.,]+).*?'\}'\}", val, re.DOTALL)
+                    if garbage_match:
+                         # We found hidden numbers in garbage, but we trust the Footer Summary Table now for Totals.
+                         # So just clean the item value.
+                         item[k] = val.replace(garbage_match.group(0), "").strip()
+                    else:
+                         item[k] = val.replace("0'}", "").replace("'}'}", "").replace("'}", "").replace("{'", "").strip()
         
-        # If we found summary data, assume it's the source of truth for Totals
-        if tax_total_calc > 0:
-            if not data["Tiền thuế"] or parse_money(data["Tiền thuế"]) != tax_total_calc:
-                 data["Tiền thuế"] = format_money(tax_total_calc)
-        
-        # 2. Parse Grand Total Line with multiple numbers
-        # Pattern: "Tổng cộng tiền ... [PreTax] [Tax] [Total]" (common in 0318...pdf)
-        grand_total_match = re.search(r'(?:Tổng cộng tiền|Grand total).*?([\d\.,]+)\s+([\d\.,]+)\s+([\d\.,]+)', full_text, re.IGNORECASE)
-        if grand_total_match:
-             v1 = parse_money(grand_total_match.group(1))
-             v2 = parse_money(grand_total_match.group(2))
-             v3 = parse_money(grand_total_match.group(3))
-             
-             vals = [v for v in [v1, v2, v3] if v is not None]
-             vals.sort()
-             if len(vals) == 3:
-                 # Tax, PreTax, Total
-                 data["Tiền thuế"] = format_money(vals[0])
-                 data["Số tiền trước Thuế"] = format_money(vals[1])
-                 data["Số tiền sau"] = format_money(vals[2])
-                 print(f"  -> Found Grand Total Line: Total={vals[2]}, Tax={vals[0]}")
-
-        # Missing Lookup Code for PSD.pdf (e5100...)
-        if not data["Mã tra cứu"]:
-             # Pattern: "nhập mã ...", "key in the provided code ... : [code]"
-             code_match = re.search(r'(?:nhập mã|provided code).*?([a-f0-9]{30,})', full_text, re.IGNORECASE)
-             if code_match:
-                 data["Mã tra cứu"] = code_match.group(1)
-             
-             # Additional Lookup Code Pattern (PC-...)
-             # Example: PC-260107070845-3863477
-             pc_match = re.search(r'Mã tra cứu[:\s]*([A-Z0-9-]+)', full_text, re.IGNORECASE)
-             if pc_match:
-                 data["Mã tra cứu"] = pc_match.group(1)
+        # Aggregate taxes from line items if detected (e.g. for invoices with no summary table)
+        tax_map = {0: 0, 5: 0, 8: 0, 10: 0}
+        has_item_tax = False
         
-        # FINAL: If Tax Rate found (e.g. "Thuế khác": "10") but Column Empty, fill it
-        # This fixes 0318...pdf where "Thuế khác" picked up "10" but didn't fill "Thuế 10%"
-        if data["Thuế khác"] in ["10", "8", "5", "0"]:
-            rate_key = f"Thuế {data['Thuế khác']}%"
-            if not data[rate_key] and data["Tiền thuế"]:
-                data[rate_key] = data["Tiền thuế"]
-                data["Thuế khác"] = ""
-            elif not data[rate_key] and data["Số tiền trước Thuế"]:
-                # Calculate tax from rate
+        for item in line_items:
+            r_str = item.get('tax_rate')
+            amt_str = item.get('amount')
+            # print(f"  [DEBUG LOOP] Item Rate: '{r_str}', Amt: '{amt_str}'")
+            if r_str and amt_str:
                 try:
-                    rate = int(data["Thuế khác"])
-                    pre = parse_money(data["Số tiền trước Thuế"])
-                    if pre:
-                        calc_tax = int(round(pre * rate / 100))
-                        data[rate_key] = format_money(calc_tax)
-                        if not data["Tiền thuế"]:
-                             data["Tiền thuế"] = format_money(calc_tax)
-                        
-                        # Use loose check for Total assignment
-                        current_total = parse_money(data["Số tiền sau"])
-                        pre_val = parse_money(data["Số tiền trước Thuế"])
-                        
-                        # If Total is empty OR Total == PreTax (from premature assignment), update it!
-                        if not data["Số tiền sau"] or (current_total and pre_val and abs(current_total - pre_val) < 100):
-                             data["Số tiền sau"] = format_money(pre + calc_tax)
-                        
-                        data["Thuế khác"] = ""
-                except:
+                    amt = _parse_amount(amt_str)
+                    r = int(r_str)
+                    # print(f"    [DEBUG] Item Amount: {amt}, Rate: {r}")
+                    if r in tax_map:
+                         # Calculate Tax = Amount * Rate / 100
+                         # Note: This is an estimation. Ideally we parse the tax amount column too but that varies wildly in format.
+                         tax_val = int(round(amt * r / 100))
+                         tax_map[r] += tax_val
+                         has_item_tax = True
+                except Exception as e:
+                    # print(f"    [DEBUG ERROR] Item process failed: {e}")
                     pass
-
-        
         
-        # Store line items for multi-row expansion
-        if services:
-            line_items = services
-            # POST-PROCESS: Clean garbage from items
-            for item in line_items:
-                for k in ["name", "amount"]:
-                    val = item.get(k, "")
-                    if isinstance(val, str) and ("0'}" in val or "}'}" in val):
-                        # Standard Garbage Removal using Regex
-                        garbage_match = re.search(r"0'}.*?([\d\.,]+).*?'\}'\}", val, re.DOTALL)
-                        if garbage_match:
-                             # We found hidden numbers in garbage, but we trust the Footer Summary Table now for Totals.
-                             # So just clean the item value.
-                             item[k] = val.replace(garbage_match.group(0), "").strip()
-                        else:
-                             item[k] = val.replace("0'}", "").replace("'}'}", "").replace("'}", "").replace("{'", "").strip()
-            
-            # Aggregate taxes from line items if detected (e.g. for invoices with no summary table)
-            tax_map = {0: 0, 5: 0, 8: 0, 10: 0}
-            has_item_tax = False
-            
-            for item in line_items:
-                r_str = item.get('tax_rate')
-                amt_str = item.get('amount')
-                # print(f"  [DEBUG LOOP] Item Rate: '{r_str}', Amt: '{amt_str}'")
-                if r_str and amt_str:
-                    try:
-                        amt = parse_money(amt_str)
-                        r = int(r_str)
-                        # print(f"    [DEBUG] Item Amount: {amt}, Rate: {r}")
-                        if r in tax_map:
-                             # Calculate Tax = Amount * Rate / 100
-                             # Note: This is an estimation. Ideally we parse the tax amount column too but that varies wildly in format.
-                             tax_val = int(round(amt * r / 100))
-                             tax_map[r] += tax_val
-                             has_item_tax = True
-                    except Exception as e:
-                        # print(f"    [DEBUG ERROR] Item process failed: {e}")
-                        pass
+        if has_item_tax:
+            # Fill missing tax buckets
+            for r in [0, 5, 8, 10]:
+                key = f"Thuế {r}%"
+                if tax_map[r] > 0:
+                    # Only overwrite if empty or significantly different (likely better data from items than bad footer parse)
+                    curr_val = _parse_amount(data[key])
+                    diff = abs(curr_val - tax_map[r])
+                    
+                    # Overwrite strategy:
+                    # 1. If Curr is 0/Empty -> Overwrite
+                    # 2. If Diff is Huge (> 50% of Calc) -> Trust Calc (Fix Garbage regex capture)
+                    # NOTE: Do NOT overwrite small diffs. Trust the OCR/Document if it's close.
+                    if curr_val == 0 or diff > tax_map[r] * 0.5:
+                         data[key] = _format_amount(tax_map[r])
+                         
+            # Recalculate Total Tax if it looks wrong or empty
+            total_item_tax = sum(tax_map.values())
+            curr_total_tax = _parse_amount(data["Tiền thuế"])
             
-            if has_item_tax:
-                # Fill missing tax buckets
-                for r in [0, 5, 8, 10]:
-                    key = f"Thuế {r}%"
-                    if tax_map[r] > 0:
-                        # Only overwrite if empty or significantly different (likely better data from items than bad footer parse)
-                        curr_val = parse_money(data[key])
-                        diff = abs(curr_val - tax_map[r])
-                        
-                        # Overwrite strategy:
-                        # 1. If Curr is 0/Empty -> Overwrite
-                        # 2. If Diff is Huge (> 50% of Calc) -> Trust Calc (Fix Garbage regex capture)
-                        # NOTE: Do NOT overwrite small diffs. Trust the OCR/Document if it's close.
-                        if curr_val == 0 or diff > tax_map[r] * 0.5:
-                             data[key] = format_money(tax_map[r])
-                             
-                # Recalculate Total Tax if it looks wrong or empty
-                total_item_tax = sum(tax_map.values())
-                curr_total_tax = parse_money(data["Tiền thuế"])
+            # If total tax is missing or significantly smaller than item sum (e.g. captured only one rate), update it
+            if curr_total_tax == 0 or (total_item_tax > curr_total_tax and total_item_tax > 1000):
+                 data["Tiền thuế"] = _format_amount(total_item_tax)
+                 print(f"  [AUTO-AGGR] Aggregated Tax from items: {total_item_tax}")
+
+        # FINAL CHECK: Sanity check Tax Amount (Run AFTER post-process updates)
+        if data["Tiền thuế"] and (data["Số tiền trước Thuế"] or data["Số tiền sau"]):
+             try:
+                t_val = _parse_amount(data["Tiền thuế"])
+                # Use PreTax, or infer from Total if Tax is huge
+                p_val = _parse_amount(data["Số tiền trước Thuế"]) 
+                if not p_val and data["Số tiền sau"]:
+                     # Assume Total > Tax
+                     p_val = _parse_amount(data["Số tiền sau"])
                 
-                # If total tax is missing or significantly smaller than item sum (e.g. captured only one rate), update it
-                if curr_total_tax == 0 or (total_item_tax > curr_total_tax and total_item_tax > 1000):
-                     data["Tiền thuế"] = format_money(total_item_tax)
-                     print(f"  [AUTO-AGGR] Aggregated Tax from items: {total_item_tax}")
-
-            # FINAL CHECK: Sanity check Tax Amount (Run AFTER post-process updates)
-            if data["Tiền thuế"] and (data["Số tiền trước Thuế"] or data["Số tiền sau"]):
-                 try:
-                    t_val = parse_money(data["Tiền thuế"])
-                    # Use PreTax, or infer from Total if Tax is huge
-                    p_val = parse_money(data["Số tiền trước Thuế"]) 
-                    if not p_val and data["Số tiền sau"]:
-                         # Assume Total > Tax
-                         p_val = parse_money(data["Số tiền sau"])
-                    
-                    if t_val and p_val and p_val > 10000 and t_val >= p_val: # Strict Check: Tax >= PreTax/Total
-                        print(f"  -> Discarding suspicious Tax Amount: {data['Tiền thuế']} (Validation Failed: > Amount)")
-                        data["Tiền thuế"] = ""
-                        for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác"]:
-                             if parse_money(data[c]) == t_val:
-                                 data[c] = ""
-                 except:
-                    pass
+                if t_val and p_val and p_val > 10000 and t_val >= p_val: # Strict Check: Tax >= PreTax/Total
+                    print(f"  -> Discarding suspicious Tax Amount: {data['Tiền thuế']} (Validation Failed: > Amount)")
+                    data["Tiền thuế"] = ""
+                    for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác"]:
+                         if _parse_amount(data[c]) == t_val:
+                             data[c] = ""
+             except:
+                pass
 
-    except Exception as e:
-        print(f"Error processing {filename}: {e}")
-    
+    return line_items
+
+
+def finalize_invoice_data(data, full_text):
+    """Final pass over data, run even if an earlier stage failed: totals, tax rate, cleanup."""
     # RE-CALCULATE TOTAL TAX from Components if missing
     if not data["Tiền thuế"]:
          calc_tax = 0
          for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác"]:
-             calc_tax += parse_money(data.get(c))
+             calc_tax += _parse_amount(data.get(c))
          
          if calc_tax > 0:
-             data["Tiền thuế"] = format_money(calc_tax)
+             data["Tiền thuế"] = _format_amount(calc_tax)
              print(f"  [AUTO-AGGR] Inferred Total Tax from breakdown: {calc_tax}")
 
     # RE-CALCULATE TAX RATE if missing (Final Pass)
     # This runs after all other fallbacks/aggregations to catch cases where Pre/Tax were inferred but Rate wasn't set.
     if data["Tiền thuế"] and data["Số tiền trước Thuế"] and not any(data.get(c) for c in ["Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%"]):
         try:
-             t_val = parse_money(data["Tiền thuế"])
-             p_val = parse_money(data["Số tiền trước Thuế"])
+             t_val = _parse_amount(data["Tiền thuế"])
+             p_val = _parse_amount(data["Số tiền trước Thuế"])
              if t_val > 0 and p_val > 0:
                  rate = round(t_val / p_val * 100)
                  # Allow slight tolerance if needed, but rounding usually handles it
@@ -2206,9 +3343,9 @@ def extract_invoice_data(pdf_source, filename=None):
                    data["Thuế khác"] = ""
          
          # If it matches Total or Tax, it's noise
-         v_num = parse_money(data["Thuế khác"])
-         t_num = parse_money(data.get("Số tiền sau"))
-         tax_num = parse_money(data.get("Tiền thuế"))
+         v_num = _parse_amount(data["Thuế khác"])
+         t_num = _parse_amount(data.get("Số tiền sau"))
+         tax_num = _parse_amount(data.get("Tiền thuế"))
          if v_num and (v_num == t_num or v_num == tax_num):
               data["Thuế khác"] = ""
 
@@ -2218,11 +3355,11 @@ def extract_invoice_data(pdf_source, filename=None):
         if k in data and data[k]:
              orig = data[k]
              # print(f"[DEBUG CLEANUP] Key: {k}, Orig: '{orig}'")
-             val = parse_money(data[k])
+             val = _parse_amount(data[k])
              # print(f"    -> Parsed: {val}")
              
              if val != 0:
-                 data[k] = format_money(val)
+                 data[k] = _format_amount(val)
                  # print(f"    -> Formatted: '{data[k]}'")
              elif val == 0 and data[k] not in ["0", "0.0", "0,0"]:
                  pass
@@ -2257,6 +3394,208 @@ def extract_invoice_data(pdf_source, filename=None):
         
         data["Đơn vị bán"] = s
 
+
+class SidecarIndex:
+    """
+    OCR .txt files of one folder, for the fallback when a PDF yields no text:
+    the text file of "x.pdf" is the first .txt (in directory order) whose name
+    starts with "x" ("x_00001.txt"), skipping debug_* files. The folder is listed
+    once; names are kept sorted so the files for a base name are found by bisect,
+    and each file's decoded text (UTF-8, else CP1252) is kept after the first read.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            names = []
+        # (name, position in directory order)
+        self._names = sorted((name, pos) for pos, name in enumerate(names)
+                             if name.lower().endswith('.txt') and not name.startswith('debug_'))
+        self._texts = {}
+
+    def candidates(self, base_name):
+        """Text file names starting with base_name, in directory order."""
+        start = bisect.bisect_left(self._names, (base_name,))
+        matches = []
+        for name, pos in self._names[start:]:
+            if not name.startswith(base_name):
+                break
+            matches.append((pos, name))
+        return [name for _, name in sorted(matches)]
+
+    def read(self, name):
+        """Decoded text of a file of the folder; None if it cannot be read or decoded."""
+        if name not in self._texts:
+            txt_path = os.path.join(self.folder, name)
+            text = None
+            try:
+                # Try UTF-8 first
+                with open(txt_path, 'r', encoding='utf-8') as tf:
+                    text = tf.read()
+            except UnicodeDecodeError:
+                try:
+                    # Try CP1252 / ANSI
+                    with open(txt_path, 'r', encoding='cp1252') as tf:
+                        text = tf.read()
+                except Exception as e:
+                    print(f"  -> Error reading fallback file (encoding): {e}")
+            except Exception as e:
+                print(f"  -> Error reading fallback file: {e}")
+            self._texts[name] = text
+        return self._texts[name]
+
+    def text_for(self, pdf_path):
+        """Text of the first readable sidecar file of a PDF, or "" if there is none."""
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        for name in self.candidates(base_name):
+            print(f"  -> Found fallback text file: {name}")
+            text = self.read(name)
+            if text is not None:
+                return text
+        return ""
+
+
+def extract_invoice_data(pdf_source, filename=None, trace=None, backend=None, sidecars=None, item_engine=None):
+    """
+    Extract invoice data from a PDF file source, or from an e-invoice XML (see xml_invoice.py).
+    :param pdf_source: File path (str), PDF bytes (bytes/memoryview) or file-like object (BytesIO).
+        In-memory input is read once and the same bytes go to text extraction and OCR.
+    :param filename: Original filename (default: the basename of a path source)
+    :param trace: Optional ExtractionTrace that receives a span per stage
+    :param backend: PDF text backend (key of PDF_TEXT_BACKENDS, default PDF_TEXT_BACKEND)
+    :param sidecars: SidecarIndex of the PDF's folder, shared by a batch (default: list the folder now)
+    :param item_engine: Line item engine (one of ITEM_ENGINES, default ITEM_ENGINE)
+    """
+    item_engine = item_engine or ITEM_ENGINE
+    if item_engine not in ITEM_ENGINES:
+        raise ValueError(f"Unknown item engine: {item_engine} (choose from {', '.join(ITEM_ENGINES)})")
+    if trace is None:
+        trace = ExtractionTrace()
+
+    if filename is None:
+        filename = os.path.basename(pdf_source) if isinstance(pdf_source, str) else "Unknown.pdf"
+
+    data = _empty_invoice_data(filename)
+    # Store line items separately for multi-row expansion
+    line_items = []
+    full_text = ""
+    
+    try:
+        # Streams and bytes-like input become one bytes object shared by every stage
+        pdf_source = pdf_input(pdf_source)
+        
+        # Official e-invoice XML: every field is read directly, no text layer to parse
+        if is_xml_input(pdf_source):
+            from xml_invoice import parse_invoice_xml
+            with trace.span("xml") as span:
+                data, line_items = parse_invoice_xml(pdf_source, filename)
+                span["items"] = len(line_items)
+            return data, line_items
+        
+        # Read the text layer of the PDF
+        with trace.span("pdf_text", backend=backend or PDF_TEXT_BACKEND) as span:
+            page_words = [] if item_engine == "layout" else None
+            page_texts = read_pdf_pages(pdf_source, backend, page_words)
+            full_text = join_pages(page_texts)
+            span["pages"] = len(page_texts)
+            span["chars"] = len(full_text)
+        
+        # Check if PDF is scanned (no text layer at all): tiered OCR of the invoice fields
+        if not full_text.strip():
+            print(f"  PDF has no text, trying OCR: {filename}")
+            with trace.span("ocr", pages=len(page_texts)) as span:
+                hits_before = pattern_hit_counts()
+                ocr_data, ocr_text, span["tiers"] = ocr_invoice_fields(pdf_source, filename)
+                span["chars"] = len(ocr_text)
+                span["patterns"] = _matched_patterns(hits_before)
+            if ocr_text.strip():
+                # Use OCR extraction for scanned PDFs
+                for key, val in ocr_data.items():
+                    if key in data and val:
+                        data[key] = val
+                # Auto-classify based on content
+                ocr_lower = ocr_text.lower()
+                print(f"  OCR text contains 'petrolimex': {'petrolimex' in ocr_lower}")
+                print(f"  OCR text contains 'xăng': {'xăng' in ocr_lower}")
+                if any(x in ocr_lower for x in ['petrolimex', 'xăng', 'ron 95', 'ron95', 'diesel', 'dầu diesel']):
+                    data["Phân loại"] = "Xăng xe"
+                    print(f"  Classification set to: Xăng xe")
+                elif any(x in ocr_lower for x in ['khách sạn', 'hotel', 'phòng nghỉ']):
+                    data["Phân loại"] = "Dịch vụ phòng nghỉ"
+                elif any(x in ocr_lower for x in ['nhà hàng', 'quán ăn', 'món ăn']):
+                    data["Phân loại"] = "Dịch vụ ăn uống"
+                else:
+                    data["Phân loại"] = "Khác"
+                print(f"  Final data: {data}")
+                return data, []  # Return early for OCR path
+            else:
+                print(f"  OCR also failed for: {filename}")
+                return data, []
+        
+        # Mixed PDF: only the scanned pages go to OCR; their text is merged back in page order
+        scan_pages = [page_no for page_no, text in enumerate(page_texts, 1) if text is None]
+        if scan_pages:
+            print(f"  {len(scan_pages)} of {len(page_texts)} pages have no text, trying OCR: {filename}")
+            with trace.span("ocr", pages=len(scan_pages)) as span:
+                ocr_texts = ocr_pdf_pages(pdf_source, scan_pages)
+                for page_no, text in zip(scan_pages, ocr_texts):
+                    page_texts[page_no - 1] = text
+                span["chars"] = sum(len(text) for text in ocr_texts)
+            full_text = join_pages(page_texts)
+        
+        with trace.span("clean_text") as span:
+            full_text = clean_pdf_text(full_text, data)
+            span["chars"] = len(full_text)
+        
+        # Fallback only works if we have a local file path
+        if not full_text and isinstance(pdf_source, str):
+            print(f"  Empty PDF text, checking for fallback text file...")
+            # Find closest matching text file (e.g. filename_00001.txt)
+            with trace.span("sidecar") as span:
+                if sidecars is None:
+                    sidecars = SidecarIndex(os.path.dirname(pdf_source))
+                full_text = sidecars.text_for(pdf_source)
+                span["chars"] = len(full_text)
+
+        if not full_text.strip():
+            print(f"  Could not extract text (scanned PDF?): {filename}")
+            # Set all fields to "không nhận diện được"
+            for key in data:
+                if key != "Tên file":
+                    data[key] = "không nhận diện được"
+            return data, []  # Return empty line_items
+
+        
+        # Index the text once for the stages below
+        with trace.span("document") as span:
+            doc = Document(full_text)
+            span["lines"] = len(doc.lines)
+            span["tables"] = len(doc.tables)
+
+        # Extract services from text
+        with trace.span("services") as span:
+            services = None
+            if page_words is not None:
+                from layout_items import extract_items_from_words
+                services = extract_items_from_words(page_words)
+            span["engine"] = "layout" if services is not None else "text"
+            if services is None:
+                services = extract_services_from_text(doc)
+            span["items"] = len(services)
+        with trace.span("header") as span:
+            hits_before = pattern_hit_counts()
+            span["template"] = extract_header_fields(doc, data, filename, pdf_source)
+            span["patterns"] = _matched_patterns(hits_before)
+        with trace.span("reconcile"):
+            line_items = reconcile_amounts(doc, data, services)
+
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+    
+    with trace.span("finalize"):
+        finalize_invoice_data(data, full_text)
     return data, line_items
 
 
@@ -2271,116 +3610,454 @@ def clean_string_value(val):
     return val
 
 
+# ============ BATCH EXTRACTION ============
+# Each file runs in a worker process so a batch uses every core. A file that
+# crashes its worker or runs longer than BATCH_FILE_TIMEOUT seconds is reported
+# as failed and the worker is replaced; the rest of the batch keeps going.
+BATCH_FILE_TIMEOUT = 300
+# Replacement workers that may die in a row before one finishes a file; past this
+# (e.g. workers that cannot start) the rest of the batch is reported as failed
+BATCH_MAX_RESPAWNS = 10
 
-def format_excel_output(file_path):
-    """Format the Excel output file with professional styles and merge cells."""
-    print(f"Applying professional formatting to {file_path}...")
-    try:
-        wb = openpyxl.load_workbook(file_path)
-        if "Hóa đơn" in wb.sheetnames:
-            ws = wb["Hóa đơn"]
+# trace: ExtractionTrace.to_dict() of the extraction (None for cache hits and failed files)
+# sha256: content hash of the payload when iter_extract() ran with a cache, else None
+BatchResult = namedtuple("BatchResult", ["index", "name", "data", "line_items", "error", "trace", "sha256"],
+                         defaults=(None, None))
+
+
+def _batch_job(source):
+    """Turn a batch source (path, (name, bytes-like or path) pair or file-like) into a picklable (name, path or bytes)."""
+    if isinstance(source, str):
+        return os.path.basename(source), source
+    if isinstance(source, tuple):
+        name, payload = source
+        return name, pdf_input(payload)
+    return getattr(source, "name", None) or "Unknown.pdf", pdf_input(source)
+
+
+def _used_sidecar(trace):
+    """
+    Whether an extraction looked for its text in sidecar .txt files (trace dict of a BatchResult).
+    Its result depends on files the PDF's content hash does not cover, so it is not cached or
+    recorded in the manifest: a sidecar added or corrected later must be read again.
+    """
+    return bool(trace) and any(span["stage"] == "sidecar" for span in trace["spans"])
+
+
+def _sidecar_indexes(jobs):
+    """{folder: SidecarIndex} for the folders of the file path jobs, each folder listed once per batch."""
+    folders = {os.path.dirname(payload) for _, (_, payload) in jobs if isinstance(payload, str)}
+    return {folder: SidecarIndex(folder) for folder in folders}
+
+
+def _run_batch_job(name, payload, sidecars=None):
+    """
+    Extract one batch job; payload is a file path or the PDF bytes. Returns (data, line_items, trace dict).
+    :param sidecars: {folder: SidecarIndex} from _sidecar_indexes()
+    """
+    trace = ExtractionTrace()
+    index = sidecars.get(os.path.dirname(payload)) if sidecars and isinstance(payload, str) else None
+    data, line_items = extract_invoice_data(payload, filename=name, trace=trace, sidecars=index)
+    return data, line_items, trace.to_dict()
+
+
+def _batch_worker(conn):
+    """
+    Worker process loop: receive (index, name, payload) jobs, send results back.
+    A dict message is the {folder: SidecarIndex} of the batch that starts; None stops the worker.
+    """
+    sidecars = None
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        if isinstance(job, dict):
+            sidecars = job
+            continue
+        index, name, payload = job
+        try:
+            data, line_items, trace = _run_batch_job(name, payload, sidecars)
+            result = (index, data, line_items, None, trace)
+        except Exception as e:
+            result = (index, None, [], f"{type(e).__name__}: {e}", None)
+        # Pattern hits counted in this process since the last job, merged by the parent
+        conn.send(result + (pattern_hit_counts(reset=True),))
+
+
+def _spawn_batch_worker(ctx):
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=_batch_worker, args=(child_conn,), daemon=True)
+    proc.start()
+    child_conn.close()
+    return proc, parent_conn
+
+
+class BatchWorkerPool:
+    """
+    Batch worker processes kept alive from one batch to the next (iter_extract(pool=...)).
+    A worker sets up its imports, compiled patterns and OCR engine (with the loaded
+    tesserocr models) on its first file and keeps them for every later file and batch;
+    without a pool every batch starts and stops its own processes.
+    One batch at a time per pool; close() stops the idle workers.
+    """
+
+    def __init__(self):
+        # Spawned, not forked: batches run from server threads (jobs.py), and a forked child
+        # would inherit locks other threads happen to hold at that moment
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle = []  # (proc, conn)
+
+    def spawn(self):
+        return _spawn_batch_worker(self._ctx)
+
+    def acquire(self, count):
+        """count workers: idle ones that are still alive first, then new ones."""
+        workers = []
+        while self._idle and len(workers) < count:
+            proc, conn = self._idle.pop()
+            if proc.is_alive():
+                workers.append((proc, conn))
+            else:
+                conn.close()
+        while len(workers) < count:
+            workers.append(self.spawn())
+        return workers
+
+    def release(self, workers):
+        self._idle.extend(workers)
+
+    def close(self):
+        for proc, conn in self._idle:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for proc, _ in self._idle:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+        self._idle = []
+
+
+def iter_extract(sources, workers=None, timeout=BATCH_FILE_TIMEOUT, cache=None, pool=None):
+    """
+    Extract many invoices in parallel worker processes.
+    Yields a BatchResult per file in completion order (use .index for input order).
+    :param sources: File paths, (filename, bytes or path) pairs or file-like objects
+    :param workers: Number of worker processes (default: CPU count, 0 = run in this process)
+    :param timeout: Per-file limit in seconds (None = no limit)
+    :param cache: Optional result_store.ResultCache; hits are yielded without re-extracting
+    :param pool: Optional BatchWorkerPool whose workers are reused (default: workers live for this batch only)
+    """
+    jobs = [(index, _batch_job(s)) for index, s in enumerate(sources)]
+    if cache is None:
+        yield from _run_batch(jobs, workers, timeout, pool)
+        return
+
+    from result_store import content_hash
+    hashes = {}
+    to_run = []
+    for index, (name, payload) in jobs:
+        hashes[index] = content_hash(payload)
+        cached = cache.get(hashes[index])
+        if cached is not None:
+            data, line_items = cached
+            data["Tên file"] = name  # Same content may have been cached under another name
+            yield BatchResult(index, name, data, line_items, None, sha256=hashes[index])
         else:
-            ws = wb.active
+            to_run.append((index, (name, payload)))
 
-        # Define Styles
-        header_font = Font(bold=True, color="FFFFFF", size=11, name="Arial")
-        header_fill = PatternFill("solid", fgColor="4F81BD")  # Professional Blue
-        border_style = Side(style='thin', color="000000")
-        border = Border(left=border_style, right=border_style, top=border_style, bottom=border_style)
-        
-        # Column widths for layout with VAT breakdown:
-        # A=Tên file, B=Ngày, C=Số HĐ, D=Đơn vị bán, E=Phân loại
-        # F=Trước thuế, G=Thuế 0%, H=Thuế 5%, I=Thuế 8%, J=Thuế 10%, K=Thuế khác
-        # L=Tiền thuế, M=Sau thuế, N=Link, O=Mã tra cứu, P=MST, Q=Mã CQT, R=Ký hiệu
-        widths = {
-            'A': 30, 'B': 12, 'C': 15, 'D': 40, 'E': 18,
-            'F': 18, 'G': 12, 'H': 12, 'I': 12, 'J': 12, 'K': 12,
-            'L': 12, 'M': 15, 'N': 18, 'O': 15, 'P': 20, 'Q': 15, 'R': 15, 'S': 12
-        }
-        
-        for col_letter, width in widths.items():
-            ws.column_dimensions[col_letter].width = width
-
-        # Format Header Row (row 1)
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-            cell.border = border
-        
-        # Freeze header row
-        ws.freeze_panes = 'A2'
-        
-        # Add Filter
-        ws.auto_filter.ref = ws.dimensions
-        
-        # No need for merge logic since each invoice is now one row
-        
-        # Format Data Rows - borders and number formatting
-        money_cols_idx = [6, 7, 8, 9, 10, 11, 12, 13]  # F through M (all money columns)
-        center_cols_idx = [2, 3, 5, 16, 18]  # B, C, E, P, R
-        
-        for row in ws.iter_rows(min_row=2, max_row=ws.max_row):
-            for cell in row:
-                # Skip merged cells (they don't have col_idx)
-                if not hasattr(cell, 'col_idx'):
+    for res in _run_batch(to_run, workers, timeout, pool):
+        if res.error is None and not _used_sidecar(res.trace):
+            cache.put(hashes[res.index], res.data, res.line_items)
+        yield res._replace(sha256=hashes[res.index])
+
+
+def _run_batch(jobs, workers, timeout, pool=None):
+    """Run (index, (name, payload)) jobs and yield BatchResults in completion order."""
+    if not jobs:
+        return
+    sidecars = _sidecar_indexes(jobs)
+
+    if workers == 0:
+        for index, (name, payload) in jobs:
+            try:
+                data, line_items, trace = _run_batch_job(name, payload, sidecars)
+                yield BatchResult(index, name, data, line_items, None, trace)
+            except Exception as e:
+                yield BatchResult(index, name, None, [], f"{type(e).__name__}: {e}")
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = BatchWorkerPool()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    pending = deque(jobs)
+    idle = pool.acquire(workers)
+    ready = set()  # conns that were sent this batch's sidecar indexes
+    busy = {}  # conn -> (proc, index, name, started)
+    send_failures = {}  # index -> times sending that job to a worker failed
+    respawns = 0  # replacement workers started since a worker last finished a file
+
+    try:
+        while pending or busy:
+            # Hand out work to idle workers
+            while pending and idle:
+                proc, conn = idle.pop()
+                index, (name, payload) = pending[0]
+                try:
+                    if conn not in ready:
+                        conn.send(sidecars)
+                        ready.add(conn)
+                    conn.send((index, name, payload))
+                except (BrokenPipeError, EOFError, OSError):
+                    # Worker died while idle or while receiving the job: replace it and retry the job once
+                    proc.terminate()
+                    proc.join(1)
+                    conn.close()
+                    send_failures[index] = send_failures.get(index, 0) + 1
+                    if send_failures[index] > 1:
+                        pending.popleft()
+                        yield BatchResult(index, name, None, [], f"Worker crashed (exit code {proc.exitcode})")
+                    if pending and respawns < BATCH_MAX_RESPAWNS:
+                        respawns += 1
+                        idle.append(pool.spawn())
                     continue
-                    
-                cell.border = border
-                cell.font = Font(name="Arial", size=10)
-                
-                # Number format for money columns
-                if cell.col_idx in money_cols_idx:
-                    cell.number_format = '#,##0'
-                    cell.alignment = Alignment(horizontal="right", vertical="center")
-                elif cell.col_idx in center_cols_idx:
-                    cell.alignment = Alignment(horizontal="center", vertical="center")
+                pending.popleft()
+                busy[conn] = (proc, index, name, time.monotonic())
+
+            if pending and not idle and not busy:
+                # Every replacement died before finishing a file: workers cannot start
+                while pending:
+                    index, (name, _) = pending.popleft()
+                    yield BatchResult(index, name, None, [], f"No worker process could be started ({respawns} attempts)")
+                break
+            if not busy:
+                continue
+
+            wait_for = None
+            if timeout:
+                next_deadline = min(started for _, _, _, started in busy.values()) + timeout
+                wait_for = max(0.0, next_deadline - time.monotonic())
+            mp_connection.wait(list(busy) + [proc.sentinel for proc, _, _, _ in busy.values()], timeout=wait_for)
+
+            now = time.monotonic()
+            for conn, (proc, index, name, started) in list(busy.items()):
+                error = None
+                if conn.poll():
+                    try:
+                        _, data, line_items, error, trace, hits = conn.recv()
+                    except (EOFError, OSError):
+                        error = f"Worker crashed (exit code {proc.exitcode})"
+                    else:
+                        merge_pattern_hits(hits)
+                        respawns = 0
+                        del busy[conn]
+                        idle.append((proc, conn))
+                        yield BatchResult(index, name, data, line_items, error, trace)
+                        continue
+                elif not proc.is_alive():
+                    error = f"Worker crashed (exit code {proc.exitcode})"
+                elif timeout and now - started > timeout:
+                    error = f"Timed out after {timeout}s"
                 else:
-                    cell.alignment = Alignment(vertical="center", wrap_text=True)
+                    continue
 
-        wb.save(file_path)
-        print(" -> Formatting complete with merged cells.")
-        
-    except Exception as e:
-        print(f"Error formatting Excel: {e}")
-        import traceback
-        traceback.print_exc()
+                # Crashed or hung: kill the worker and replace it
+                del busy[conn]
+                proc.terminate()
+                proc.join(1)
+                conn.close()
+                if pending and respawns < BATCH_MAX_RESPAWNS:
+                    respawns += 1
+                    idle.append(pool.spawn())
+                yield BatchResult(index, name, None, [], error)
+    finally:
+        # Workers still busy (the caller stopped early) are killed; idle ones go back to the pool
+        for proc, _, _, _ in busy.values():
+            proc.terminate()
+        for proc, _, _, _ in busy.values():
+            proc.join(1)
+        pool.release(idle)
+        if own_pool:
+            pool.close()
+
+
+def extract_many(sources, workers=None, timeout=BATCH_FILE_TIMEOUT, cache=None, on_result=None):
+    """
+    Extract many invoices in parallel and return their BatchResults in input order.
+    :param on_result: Optional callback(done_count, total, result) called as each file finishes
+    """
+    results = [None] * len(sources)
+    for done, res in enumerate(iter_extract(sources, workers=workers, timeout=timeout, cache=cache), 1):
+        results[res.index] = res
+        if on_result:
+            on_result(done, len(sources), res)
+    return results
+
+
+# ============ COMMAND LINE ============
+# python extract_invoices.py [--input DIR] [--output DIR] [--glob PATTERN] [--workers N]
+#                            [--shard I/N] [--format xlsx|csv|json] [--full]
+# Finds PDF and e-invoice XML files recursively (an XML replaces the PDF of the
+# same name), extracts the new or changed ones (manifest) and writes one report. With --shard, every node sees the same sorted file list and takes
+# the files whose relative path hashes to its shard, so N nodes split an archive
+# without coordinating; each writes its own report and manifest.
+
+# Defaults when no paths are given (override with environment variables)
+DEFAULT_INPUT_DIR = os.environ.get("HOADON_INPUT_DIR", r"D:\hoadon\invoices_input")
+DEFAULT_OUTPUT_DIR = os.environ.get("HOADON_OUTPUT_DIR", r"D:\hoadon")
+REPORT_BASENAME = "hoadon_tonghop"
+# The manifest is kept next to the report in the output folder
+MANIFEST_FILE = "hoadon_manifest.json"
+OUTPUT_FORMATS = ("xlsx", "csv", "json")
+INVOICE_GLOBS = ("*.pdf", "*.xml")
+
+
+def discover_files(root, patterns=INVOICE_GLOBS, recursive=True):
+    """Files under root whose name or relative path matches one of the glob patterns (case-insensitive), sorted."""
+    import fnmatch
+    patterns = [pattern.lower() for pattern in patterns]
+    found = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        if not recursive:
+            dirs.clear()
+        for name in files:
+            path = os.path.join(folder, name)
+            rel_path = os.path.relpath(path, root).replace(os.sep, '/').lower()
+            if any(fnmatch.fnmatchcase(name.lower(), pattern) or fnmatch.fnmatchcase(rel_path, pattern)
+                   for pattern in patterns):
+                found.append(path)
+    return sorted(found)
+
+
+def parse_shard(value):
+    """"I/N" (1 <= I <= N) -> (I, N); argparse type for --shard."""
+    import argparse
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f"expected I/N with 1 <= I <= N, got {value!r}")
+    return int(match.group(1)), int(match.group(2))
 
-def main():
+
+def in_shard(rel_path, shard):
+    """Whether a file (path relative to the input root) belongs to shard (I, N); stable across machines and runs."""
+    import hashlib
+    index, count = shard
+    digest = hashlib.sha1(rel_path.replace(os.sep, '/').encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index - 1
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract invoice data from PDF and e-invoice XML files into one report.")
+    parser.add_argument("-i", "--input", default=DEFAULT_INPUT_DIR,
+                        help=f"Folder searched for invoices (default: {DEFAULT_INPUT_DIR})")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_DIR,
+                        help=f"Folder for the report and manifest (default: {DEFAULT_OUTPUT_DIR})")
+    parser.add_argument("-g", "--glob", action="append", dest="globs", metavar="PATTERN",
+                        help="File name or relative path pattern, repeatable (default: *.pdf and *.xml)")
+    parser.add_argument("--no-recursive", dest="recursive", action="store_false",
+                        help="Only look at the top level of the input folder")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Worker processes (default: CPU count, 0 = run in this process)")
+    parser.add_argument("--timeout", type=float, default=BATCH_FILE_TIMEOUT,
+                        help=f"Seconds allowed per file (default: {BATCH_FILE_TIMEOUT})")
+    parser.add_argument("--shard", type=parse_shard, metavar="I/N",
+                        help="Only process shard I of N (e.g. 2/4), for splitting an archive across machines")
+    parser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="xlsx", help="Report format (default: xlsx)")
+    parser.add_argument("--full", action="store_true", help="Ignore the manifest and extract every file again")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
     # Fix Windows console encoding for Vietnamese characters
     import sys
     sys.stdout.reconfigure(encoding='utf-8')
+    args = parse_args(argv)
     
     # Input folder for PDF files - users should place new invoices here
-    input_folder = r"D:\hoadon\invoices_input"
+    input_folder = args.input
     
-    # Output folder for exported Excel
-    output_folder = r"D:\hoadon"
+    # Output folder for the report
+    output_folder = args.output
+    os.makedirs(output_folder, exist_ok=True)
     
     # Create input folder if not exists
     if not os.path.exists(input_folder):
         os.makedirs(input_folder)
         print(f"Created input folder: {input_folder}")
         print("Please add PDF invoice files to this folder and run again.")
-        return
+        return 1
     
-    # Get all PDF files from input folder
-    pdf_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
+    # Get all invoice files below the input folder; a PDF with an XML of the same name is read from the XML
+    from xml_invoice import pair_invoice_sources
+    found = discover_files(input_folder, args.globs or INVOICE_GLOBS, args.recursive)
+    sources = pair_invoice_sources([(os.path.basename(path), path) for path in found])
+    suffix = ""
+    if args.shard:
+        total_found = len(sources)
+        sources = [(name, path) for name, path in sources
+                   if in_shard(os.path.relpath(path, input_folder), args.shard)]
+        suffix = f".shard-{args.shard[0]}-of-{args.shard[1]}"
+        print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(sources)} of {total_found} files")
     
-    if not pdf_files:
-        print(f"No PDF files found in: {input_folder}")
+    if not sources:
+        print(f"No invoice files found in: {input_folder}")
         print("Please add PDF invoice files to this folder and run again.")
-        return
+        return 1
         
-    print(f"Processing {len(pdf_files)} PDF files from: {input_folder}\\n")
+    from_xml = sum(path.lower().endswith('.xml') for _, path in sources)
+    print(f"Processing {len(sources)} invoices ({from_xml} from XML) from: {input_folder}\n")
     
     all_rows = []  # Will contain expanded rows (one per line item)
     
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(input_folder, pdf_file)
-        print(f"Processing: {pdf_file}")
-        
-        data, line_items = extract_invoice_data(pdf_path)
+    # Incremental run: files unchanged since the last run come from the manifest,
+    # only new, changed or version-stale files are extracted. Files finished by an
+    # interrupted run come back from the manifest journal, even with --full.
+    from result_store import Manifest, ResultCache
+    manifest_file = os.path.join(output_folder, MANIFEST_FILE.replace(".json", f"{suffix}.json"))
+    manifest = Manifest(manifest_file, input_folder)
+    if manifest.resumed:
+        print(f"Resuming interrupted run: {len(manifest.resumed)} files already done")
+    paths = [path for _, path in sources]
+    results = [None] * len(sources)
+    to_extract = []
+    for index, (name, path) in enumerate(sources):
+        stored = None if args.full and not manifest.is_resumed(path) else manifest.get(path)
+        if stored is None:
+            to_extract.append(index)
+        else:
+            stored[0]["Tên file"] = name
+            results[index] = BatchResult(index, name, stored[0], stored[1], None)
+    print(f"Manifest: {len(sources) - len(to_extract)} unchanged, {len(to_extract)} new or changed")
+    
+    def report_progress(done, total, res):
+        status = f"FAILED ({res.error})" if res.error else "done"
+        print(f"[{done}/{total}] {res.name}: {status}")
+        # Journal each result as it arrives so a crash does not lose finished files
+        # (not those read from sidecar .txt files, see _used_sidecar)
+        if res.error is None and not _used_sidecar(res.trace):
+            manifest.put(paths[to_extract[res.index]], res.data, res.line_items, res.sha256)
+    
+    cache = ResultCache()
+    extracted = extract_many([sources[i] for i in to_extract], workers=args.workers, timeout=args.timeout,
+                             cache=cache, on_result=report_progress)
+    for index, res in zip(to_extract, extracted):
+        results[index] = res._replace(index=index)
+    dropped = manifest.prune(paths)
+    if dropped:
+        print(f"Manifest: {dropped} files no longer in the folder")
+    manifest.save()
+    print(f"Cache: {cache.hits} reused, {cache.misses} extracted")
+    
+    for res in results:
+        if res.error:
+            print(f"Skipping {res.name}: {res.error}")
+            continue
+        data, line_items = res.data, res.line_items
+        print(f"Processing: {res.name}")
         
         # Classify invoice based on line items
         if line_items:
@@ -2397,6 +4074,10 @@ def main():
         pv_display = f", PV: {data['Phí PV']}" if data.get('Phí PV') else ""
         print(f"  -> Ngay: {data['Ngày hóa đơn']}, So: {data['Số hóa đơn']}, Category: {data['Phân loại']}, DonViBan: {seller_display}{pv_display}...")
     
+    if not all_rows:
+        print("No invoices could be extracted.")
+        return 1
+    
     # Create DataFrame
     df = pd.DataFrame(all_rows)
     
@@ -2433,15 +4114,15 @@ def main():
                 return x
         df[col] = df[col].apply(convert_to_number)
     
-    # Export to Excel
-    output_file = os.path.join(output_folder, "hoadon_tonghop.xlsx")
+    # Export the report
+    output_file = os.path.join(output_folder, f"{REPORT_BASENAME}{suffix}.{args.format}")
     try:
-        df.to_excel(output_file, index=False, sheet_name="Hóa đơn")
+        write_report(df, output_file, args.format)
     except PermissionError:
         print(f"\nWARNING: Could not save to '{output_file}' because it is open.")
-        output_file = os.path.join(output_folder, "hoadon_tonghop_new.xlsx")
+        output_file = os.path.join(output_folder, f"{REPORT_BASENAME}{suffix}_new.{args.format}")
         print(f"Saving to '{output_file}' instead.")
-        df.to_excel(output_file, index=False, sheet_name="Hóa đơn")
+        write_report(df, output_file, args.format)
     
     # Print summary
     print(f"\n{'='*50}")
@@ -2452,10 +4133,37 @@ def main():
         empty_count = (df[col] == '').sum() + df[col].isna().sum()
         pct = (1 - empty_count/len(df)) * 100
         print(f"  {col}: {pct:.0f}% filled ({len(df)-empty_count}/{len(df)})")
+
+    # Which header patterns actually matched (cache hits are not counted)
+    print("\nPATTERN HITS:")
+    for name, index, hits, pattern in pattern_hit_report():
+        if hits:
+            print(f"  {name}[{index}]: {hits}  {pattern[:60]}")
+    dead = sum(1 for row in pattern_hit_report() if row[2] == 0)
+    print(f"  ({dead} patterns never matched in this run)")
+
+    # Where the time went for the slowest files (cache hits have no trace)
+    traced = sorted((res for res in results if res.trace), key=lambda res: res.trace["wall_ms"], reverse=True)
+    if traced:
+        print("\nSLOWEST FILES:")
+        for res in traced[:5]:
+            stages = ", ".join(f"{span['stage']} {span['wall_ms']:.0f}ms" for span in res.trace["spans"])
+            print(f"  {res.name}: {res.trace['wall_ms']:.0f} ms ({stages})")
     print(f"\nExported to: {output_file}")
-    
-    # Apply professional formatting
-    format_excel_output(output_file)
+    return 0
+
+
+def write_report(df, output_file, fmt):
+    """Write the consolidated report as xlsx (styled), csv (UTF-8 with BOM, opens in Excel) or json (records)."""
+    if fmt == "xlsx":
+        # Styles are applied while rows are streamed out (no reload for formatting)
+        from excel_export import write_invoice_report
+        write_invoice_report(df, output_file, "Tổng hợp")
+    elif fmt == "csv":
+        df.to_csv(output_file, index=False, encoding='utf-8-sig')
+    else:
+        df.to_json(output_file, orient="records", force_ascii=False, indent=1)
+
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
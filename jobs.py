@@ -0,0 +1,313 @@
+"""
+Background extraction jobs for the Streamlit app.
+
+An upload is saved under the jobs directory and queued in a SQLite database.
+Worker threads in the server process claim queued jobs, run iter_extract() on
+them (each thread keeps its extraction worker processes, and their OCR engines,
+alive from one job to the next), store every file's report rows and the job's progress as they finish, and
+finally write the Excel report next to the job. Sessions only read the
+database, so closing the tab or a rerun never loses work, two uploads are
+processed one after the other instead of competing, and a finished job can be
+reopened by its ID.
+"""
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from excel_export import write_invoice_report
+from extract_invoices import BatchWorkerPool, iter_extract, pattern_hit_report
+from report import build_report_df, invoice_category, invoice_rows
+
+logger = logging.getLogger(__name__)
+
+# Job storage, worker threads and retention (override with environment variables)
+DEFAULT_JOBS_DIR = os.environ.get(
+    "HOADON_JOBS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "jobs")
+)
+DEFAULT_JOB_WORKERS = int(os.environ.get("HOADON_JOB_WORKERS", "1"))
+DEFAULT_RETENTION_DAYS = float(os.environ.get("HOADON_JOB_RETENTION_DAYS", "7"))
+
+REPORT_FILE = "hoadon_tonghop.xlsx"
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _upload_file(idx, name):
+    """File name of a job's upload on disk: its index plus the upload's extension (an XML path is recognized by it)."""
+    return f"{idx}.xml" if name.lower().endswith('.xml') else f"{idx}.pdf"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    team TEXT NOT NULL,
+    employee TEXT NOT NULL,
+    category_select TEXT NOT NULL,
+    custom_category TEXT NOT NULL,
+    report_type TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    cache_hits INTEGER,
+    cache_misses INTEGER,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    rows TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+"""
+
+
+class JobQueue:
+    """
+    SQLite-backed queue of extraction jobs with a pool of worker threads.
+    Each job runs iter_extract() with its share of the CPU cores; jobs left
+    queued or running by a previous server process are picked up again, and
+    files that already finished are not extracted twice.
+    """
+
+    def __init__(self, directory=DEFAULT_JOBS_DIR, workers=DEFAULT_JOB_WORKERS, cache=None,
+                 retention_days=DEFAULT_RETENTION_DAYS):
+        self.directory = directory
+        self.cache = cache
+        self.retention_days = retention_days
+        self.db_path = os.path.join(directory, "jobs.sqlite")
+        self._wakeup = threading.Condition()
+        self._claim_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            # Interrupted by a restart: run again, finished files are kept
+            conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        self.purge()
+
+        workers = max(1, workers)
+        # Split the cores between concurrent jobs instead of oversubscribing them
+        self._extract_workers = max(1, (os.cpu_count() or 1) // workers)
+        self._threads = [threading.Thread(target=self._worker, name=f"invoice-job-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return _Connection(conn)
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    # --- Session side ---
+
+    def submit(self, files, team, employee, category_select, custom_category, report_type):
+        """
+        Queue (filename, bytes-like) uploads and return the new job ID.
+        Uploads are written to disk first, so the job survives the session.
+        Raises ValueError if there are no files.
+        """
+        if not files:
+            raise ValueError("no files to process")
+        job_id = uuid.uuid4().hex[:12]
+        upload_dir = os.path.join(self._job_dir(job_id), "uploads")
+        os.makedirs(upload_dir)
+        for idx, (name, payload) in enumerate(files):
+            with open(os.path.join(upload_dir, _upload_file(idx, name)), 'wb') as f:
+                f.write(payload)
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO job_files (job_id, idx, name, status) VALUES (?, ?, ?, ?)",
+                [(job_id, idx, name, QUEUED) for idx, (name, _) in enumerate(files)]
+            )
+            conn.execute(
+                "INSERT INTO jobs (id, status, team, employee, category_select, custom_category, report_type,"
+                " total, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, team, employee, category_select, custom_category, report_type,
+                 len(files), now, now)
+            )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        """Job row as a dict (plus its position in the queue while queued), or None if unknown."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = dict(row)
+            if job["status"] == QUEUED:
+                job["queue_position"] = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND created < ?", (QUEUED, job["created"])
+                ).fetchone()[0]
+        return job
+
+    def failed_files(self, job_id):
+        """[(filename, error)] for files of the job that could not be processed."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT name, error FROM job_files WHERE job_id = ? AND status = ? ORDER BY idx",
+                (job_id, FAILED)
+            ).fetchall()
+        return [(row["name"], row["error"]) for row in rows]
+
+    def report_df(self, job_id):
+        """Report DataFrame of a job, in upload order."""
+        job = self.get(job_id)
+        with self._connect() as conn:
+            stored = conn.execute(
+                "SELECT rows FROM job_files WHERE job_id = ? AND rows IS NOT NULL ORDER BY idx", (job_id,)
+            ).fetchall()
+        rows = [row for (file_rows,) in stored for row in json.loads(file_rows)]
+        return build_report_df(rows, job["report_type"])
+
+    def report_path(self, job_id):
+        """Path of the finished Excel report, or None if it is not written yet."""
+        path = os.path.join(self._job_dir(job_id), REPORT_FILE)
+        return path if os.path.exists(path) else None
+
+    def purge(self):
+        """Delete jobs (database rows and files) finished more than retention_days ago."""
+        cutoff = time.time() - self.retention_days * 86400
+        with self._connect() as conn:
+            old = [row["id"] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN (?, ?) AND updated < ?", (DONE, FAILED, cutoff)
+            )]
+            for job_id in old:
+                conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        for job_id in old:
+            shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+
+    # --- Worker side ---
+
+    def _claim(self):
+        """Mark the oldest queued job as running and return its row, or None."""
+        with self._claim_lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (RUNNING, time.time(), row["id"]))
+        return dict(row)
+
+    def _worker(self):
+        # Extraction processes of this thread, reused by every job it runs
+        pool = BatchWorkerPool()
+        while True:
+            job = self._claim()
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=5)
+                continue
+            try:
+                self._run(job, pool)
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {e}")
+                with self._connect() as conn:
+                    conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                                 (FAILED, f"{type(e).__name__}: {e}", time.time(), job["id"]))
+
+    def _run(self, job, pool=None):
+        job_id = job["id"]
+        upload_dir = os.path.join(self._job_dir(job_id), "uploads")
+        with self._connect() as conn:
+            pending = conn.execute(
+                "SELECT idx, name FROM job_files WHERE job_id = ? AND status = ? ORDER BY idx", (job_id, QUEUED)
+            ).fetchall()
+        logger.info(f"--- JOB {job_id}: Team={job['team']}, Employee={job['employee']}, "
+                    f"{len(pending)}/{job['total']} files to process ---")
+
+        # Workers get the saved files' paths and read each file themselves, once
+        sources = [(row["name"], os.path.join(upload_dir, _upload_file(row["idx"], row["name"]))) for row in pending]
+
+        hits_before, misses_before = (self.cache.hits, self.cache.misses) if self.cache else (0, 0)
+        for res in iter_extract(sources, workers=self._extract_workers, cache=self.cache, pool=pool):
+            idx = pending[res.index]["idx"]
+            rows, error = None, res.error
+            if error is None:
+                try:
+                    category = invoice_category(res.data, res.line_items, job["category_select"],
+                                                job["custom_category"])
+                    rows = invoice_rows(res.data, res.line_items, res.name, job["team"], job["employee"],
+                                        category, job["report_type"])
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+            if error:
+                logger.error(f"Error processing {res.name}: {error}")
+            # One JSON line per file: stage spans of slow files can be found and aggregated from the logs
+            logger.info(json.dumps({"event": "invoice_trace", "job": job_id, "file": res.name, "error": error,
+                                    "cached": error is None and res.trace is None, **(res.trace or {})},
+                                   ensure_ascii=False))
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE job_files SET status = ?, error = ?, rows = ? WHERE job_id = ? AND idx = ?",
+                    (FAILED if error else DONE, error,
+                     json.dumps(rows, ensure_ascii=False) if rows is not None else None, job_id, idx)
+                )
+                conn.execute("UPDATE jobs SET done = done + 1, updated = ? WHERE id = ?", (time.time(), job_id))
+
+        # Write to a temp file and rename so a reader never downloads a partial report
+        job_dir = self._job_dir(job_id)
+        fd, tmp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_invoice_report(self.report_df(job_id), f, job["report_type"])
+            os.replace(tmp_path, os.path.join(job_dir, REPORT_FILE))
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+        cache_hits = self.cache.hits - hits_before if self.cache else None
+        cache_misses = self.cache.misses - misses_before if self.cache else None
+        with self._connect() as conn:
+            # Hits/misses are read from a cache shared by all jobs: approximate if jobs overlap
+            conn.execute(
+                "UPDATE jobs SET status = ?, cache_hits = ?, cache_misses = ?, updated = ? WHERE id = ?",
+                (DONE, cache_hits, cache_misses, time.time(), job_id)
+            )
+        shutil.rmtree(upload_dir, ignore_errors=True)  # Results are stored; the PDFs are not needed anymore
+
+        logger.info(f"--- COMPLETION: Job {job_id}, Team={job['team']}, Employee={job['employee']} finished processing ---")
+        logger.info(f"Cache: {cache_hits} hits, {cache_misses} misses")
+        # Cumulative since the server started - shows which vendor formats are actually used
+        pattern_hits = pattern_hit_report()
+        dead_patterns = [f"{name}[{index}]" for name, index, hits, _ in pattern_hits if hits == 0]
+        logger.info(f"Pattern hits: {sum(row[2] for row in pattern_hits)} total, {len(dead_patterns)} never matched: {', '.join(dead_patterns)}")
+
+
+class _Connection:
+    """sqlite3 connection that commits (or rolls back) and closes at the end of a with block."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        with closing(self.conn):
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        return False
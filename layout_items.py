@@ -0,0 +1,304 @@
+"""
+Line items from the word geometry of the PDF text layer (the "layout" item engine).
+
+extract_services_from_text() rebuilds items from flattened text lines: the last
+unit word, qty x price checks against the candidate numbers, names merged with
+the lines above/below. In a table-layout invoice the text layer already tells
+which column every word is in. This engine groups the words of a page into
+rows, finds the goods table under its column header row, clusters the table's
+words into columns by x position once, names each column from its header text
+(STT, name, unit, qty, price, amount, tax rate) and reads every item from the
+cells of its row. Wrapped name lines join the item row on their side of the
+largest vertical gap, so top-aligned and vertically centered cells both work.
+
+Selected with HOADON_ITEM_ENGINE=layout (see extract_invoices.ITEM_ENGINE).
+extract_items_from_words() returns None when it cannot read a table (scanned
+pages, no header row, no name/amount column, no item rows); the caller then
+uses the text engine.
+"""
+import re
+from statistics import median
+
+from extract_invoices import TABLE_HEADER_RE, TOTAL_LINE_MARKERS, format_price_value
+
+
+def _keywords(*words):
+    return re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(w) for w in words) + r')(?!\w)')
+
+
+# Column roles, tried in this order on the lowercase header text of a column:
+# "Unit price" is a price before it is a unit, "Thành tiền sau thuế" a total before an amount
+COLUMN_ROLES = [
+    ("tax", _keywords("tiền thuế", "vat amount", "tax amount")),
+    ("rate", _keywords("thuế suất", "vat rate", "tax rate", "%")),
+    ("total", _keywords("sau thuế", "có thuế", "thanh toán", "after vat", "after tax")),
+    ("price", _keywords("đơn giá", "unit price", "price")),
+    ("qty", _keywords("số lượng", "quantity", "qty", "sl")),
+    ("unit", _keywords("đơn vị tính", "đơn vị", "đvt", "unit")),
+    ("amount", _keywords("thành tiền", "amount", "tiền")),
+    ("name", _keywords("tên", "description", "diễn giải", "nội dung", "hàng hóa", "dịch vụ")),
+    ("stt", _keywords("stt", "tt", "no")),
+]
+
+# A header may wrap over a few rows
+MAX_HEADER_ROWS = 3
+
+STT_RE = re.compile(r'\d{1,3}')
+RATE_RE = re.compile(r'\b(0|5|8|10)\s*%')
+# Column number row under the header: "(1) (2) (3) (4) (5) (6)=(4)x(5)", "A B 1 2 3=1x2"
+NUMBER_ROW_WORD_RE = re.compile(r'[\(\[]?[A-Ca-c\d]{1,2}[\)\]]?(?:[=x*][\(\[\]\)A-Ca-c\dx*]*)?')
+
+
+class Row:
+    """Words on one visual line of a page, left to right."""
+
+    def __init__(self, words):
+        self.words = sorted(words, key=lambda w: w["x0"])
+        self.top = min(w["top"] for w in words)
+        self.bottom = max(w["bottom"] for w in words)
+        self.text = " ".join(w["text"] for w in self.words)
+        self.lower = self.text.lower()
+
+    @property
+    def starts_with_digit(self):
+        return self.text[:1].isdigit()
+
+    @property
+    def is_header(self):
+        return bool(TABLE_HEADER_RE.search(self.lower)) and not self.starts_with_digit
+
+    @property
+    def is_total(self):
+        return any(marker in self.lower for marker in TOTAL_LINE_MARKERS) and not self.starts_with_digit
+
+    @property
+    def is_number_row(self):
+        return all(NUMBER_ROW_WORD_RE.fullmatch(w["text"]) for w in self.words)
+
+
+def group_rows(words):
+    """Words of a page grouped into rows, top to bottom: a word joins the row whose first word's middle is within half a word height."""
+    if not words:
+        return []
+    words = sorted(words, key=lambda w: (w["top"] + w["bottom"]) / 2)
+    tolerance = median(w["bottom"] - w["top"] for w in words) / 2
+    rows, current, row_middle = [], [], 0
+    for word in words:
+        middle = (word["top"] + word["bottom"]) / 2
+        if current and middle - row_middle > tolerance:
+            rows.append(Row(current))
+            current = []
+        if not current:
+            row_middle = middle
+        current.append(word)
+    rows.append(Row(current))
+    return rows
+
+
+class Table:
+    """
+    Column bands of a goods table and their roles. Bands are the x extents of the
+    item row words (of the header row words when no item row is recognized yet),
+    merged where they overlap or lie closer than a character width, so every
+    gutter between columns splits a band. Header labels often fill their cells
+    and nearly touch, so they only name the band they overlap most.
+    """
+
+    def __init__(self, header_rows, item_rows):
+        words = [w for row in item_rows or header_rows for w in row.words]
+        gap = median((w["x1"] - w["x0"]) / len(w["text"]) for w in words)
+        bands = []
+        for x0, x1 in sorted((w["x0"], w["x1"]) for w in words):
+            if bands and x0 - bands[-1][1] < gap:
+                bands[-1][1] = max(bands[-1][1], x1)
+            else:
+                bands.append([x0, x1])
+        self.bands = bands
+
+        # A header label is a run of words closer than a character width; it names the band it overlaps most
+        labels = [[] for _ in bands]
+        for row in header_rows:
+            runs = []
+            for word in row.words:
+                if runs and word["x0"] - runs[-1][-1]["x1"] < gap:
+                    runs[-1].append(word)
+                else:
+                    runs.append([word])
+            for run in runs:
+                labels[self._band_of(run[0]["x0"], run[-1]["x1"])].extend(w["text"].lower() for w in run)
+        self.roles = {}
+        for idx, label in enumerate(labels):
+            label = " ".join(label)
+            for role, keywords in COLUMN_ROLES:
+                if keywords.search(label):
+                    self.roles.setdefault(role, idx)
+                    break
+        # An STT column without a label: the band holding the first word of every item row
+        if "stt" not in self.roles and item_rows:
+            first = {self.column_of(row.words[0]) for row in item_rows}
+            if len(first) == 1 and not first & set(self.roles.values()):
+                self.roles["stt"] = first.pop()
+
+    @property
+    def readable(self):
+        return "name" in self.roles and "amount" in self.roles
+
+    def column_of(self, word):
+        """Index of the band the word overlaps most, else the nearest band."""
+        return self._band_of(word["x0"], word["x1"])
+
+    def _band_of(self, x0, x1):
+        overlaps = [min(x1, b1) - max(x0, b0) for b0, b1 in self.bands]
+        best = max(range(len(self.bands)), key=overlaps.__getitem__)
+        if overlaps[best] > 0:
+            return best
+        middle = (x0 + x1) / 2
+        return min(range(len(self.bands)),
+                   key=lambda idx: min(abs(middle - self.bands[idx][0]), abs(middle - self.bands[idx][1])))
+
+    def cells(self, row):
+        """{role: cell text} of a row."""
+        by_column = {}
+        for word in row.words:
+            by_column.setdefault(self.column_of(word), []).append(word["text"])
+        return {role: " ".join(by_column[idx]) for role, idx in self.roles.items() if idx in by_column}
+
+    def is_item_row(self, row):
+        cells = self.cells(row)
+        if "stt" in self.roles:
+            return bool(STT_RE.fullmatch(cells.get("stt", ""))) and bool(cells.get("amount"))
+        return bool(cells.get("amount"))
+
+    def is_name_row(self, row):
+        """A row with words only in the name column: a wrapped name line."""
+        name = self.roles["name"]
+        return all(self.column_of(word) == name for word in row.words)
+
+
+def _item_rows(rows):
+    """Rows that look like item rows before the columns are known: STT first, more words after."""
+    return [row for row in rows if STT_RE.fullmatch(row.words[0]["text"]) and len(row.words) > 2
+            and not row.is_number_row]
+
+
+def _find_table(rows, start):
+    """(Table, header end, body end) row indexes for the first header row at or after start, or None."""
+    for h in range(start, len(rows)):
+        if rows[h].is_header:
+            break
+    else:
+        return None
+    # Wrapped header rows carry column labels and follow at line spacing (a body row has the cell
+    # padding above it); a column number row may follow them
+    header_end = h + 1
+    while header_end < len(rows) and header_end - h < MAX_HEADER_ROWS:
+        row, above = rows[header_end], rows[header_end - 1]
+        if (row.starts_with_digit or row.top - above.bottom > (above.bottom - above.top) / 2
+                or not any(keywords.search(row.lower) for _, keywords in COLUMN_ROLES)):
+            break
+        header_end += 1
+    if header_end < len(rows) and rows[header_end].is_number_row:
+        header_end += 1
+    # The body ends at the next header row, or at the first total line after an item row
+    body_end, seen_item = header_end, False
+    while body_end < len(rows) and not rows[body_end].is_header and not (seen_item and rows[body_end].is_total):
+        seen_item = seen_item or bool(_item_rows(rows[body_end:body_end + 1]))
+        body_end += 1
+    table = Table(rows[h:header_end], _item_rows(rows[header_end:body_end]))
+    return table, header_end, body_end
+
+
+def _read_item(table, row, name):
+    cells = table.cells(row)
+    amount = cells.get("amount", "")
+    tax_rate = None
+    rate_match = RATE_RE.search(cells.get("rate", "") + "%" if "rate" in table.roles else row.text)
+    if rate_match:
+        tax_rate = rate_match.group(1)
+    return {
+        "name": name,
+        "qty": format_price_value(cells.get("qty") or "1"),
+        "unit_price": format_price_value(cells.get("price") or amount),
+        "amount": format_price_value(amount),
+        "tax_rate": tax_rate,
+    }
+
+
+def _table_items(table, rows, continued=False):
+    """
+    Items of the table body rows. A run of wrapped name rows is split at its largest
+    vertical gap (counting the gaps to the rows around it): the part above goes to
+    the item row above, the part below to the item row below.
+    :param continued: The rows continue a table from the previous page without a
+        header row; name rows above the first item row may end the previous item and are dropped
+    """
+    kinds = ["item" if table.is_item_row(row) else "name" if table.is_name_row(row) else None for row in rows]
+    items_at = [idx for idx, kind in enumerate(kinds) if kind == "item"]
+    if not items_at:
+        return []
+    # The body ends at the first total line after the last item row (subtotals between items are skipped)
+    end = next((idx for idx in range(items_at[-1] + 1, len(rows)) if rows[idx].is_total), len(rows))
+
+    names = {idx: [table.cells(rows[idx]).get("name", "")] for idx in items_at}
+    if "stt" not in table.roles:
+        # STT merged into the name column
+        names = {idx: [re.sub(r'^\d{1,3}\s+', '', name[0])] for idx, name in names.items()}
+    idx = 0
+    while idx < end:
+        if kinds[idx] != "name":
+            idx += 1
+            continue
+        run_end = idx
+        while run_end + 1 < end and kinds[run_end + 1] == "name":
+            run_end += 1
+        # gaps[k]: space above run row idx + k; gaps[-1]: space below the run
+        gaps = [rows[k].top - rows[k - 1].bottom for k in range(idx, run_end + 1) if k > 0] or [0]
+        gaps.append(rows[run_end + 1].top - rows[run_end].bottom if run_end + 1 < end else float("inf"))
+        prev_item = idx - 1 if idx > 0 and kinds[idx - 1] == "item" else None
+        next_item = run_end + 1 if run_end + 1 < end and kinds[run_end + 1] == "item" else None
+        if prev_item is None and not continued:
+            # Under the header row: all of the run belongs to the first item
+            split = 0
+        else:
+            # Ties go to the item above (top-aligned cells are the most common)
+            split = max(range(len(gaps)), key=lambda k: (gaps[k], k))
+        for k in range(idx, run_end + 1):
+            text = table.cells(rows[k]).get("name", "")
+            if k - idx < split and prev_item is not None:
+                names[prev_item].append(text)
+            elif k - idx >= split and next_item is not None:
+                names[next_item].insert(len(names[next_item]) - 1, text)
+        idx = run_end + 1
+
+    return [_read_item(table, rows[idx], " ".join(names[idx])) for idx in items_at if idx < end]
+
+
+def extract_items_from_words(page_words):
+    """
+    Line items of a table-layout invoice, in the format of extract_services_from_text(),
+    or None when no goods table can be read.
+    :param page_words: Words per page from read_pdf_pages(..., page_words=[]); None entries are scanned pages
+    """
+    if not page_words or any(words is None for words in page_words):
+        return None
+    services = []
+    open_table = None  # Table without a total line yet, continued on the next page
+    for words in page_words:
+        rows = group_rows(words)
+        found = _find_table(rows, 0)
+        if found is None and open_table is not None:
+            # Continued without a repeated header row: same columns
+            services.extend(_table_items(open_table, rows, continued=True))
+            if any(row.is_total for row in rows):
+                open_table = None
+            continue
+        open_table = None
+        while found is not None:
+            table, header_end, body_end = found
+            if table.readable:
+                body = rows[header_end:body_end]
+                services.extend(_table_items(table, body))
+                # A body running to the end of the page continues on the next one
+                open_table = table if body_end == len(rows) else None
+            found = _find_table(rows, body_end)
+    return services or None
@@ -0,0 +1,210 @@
+"""
+Report rows for the Streamlit app.
+
+Turns extract_invoice_data() results into the rows of the "Kinh doanh" (one wide
+row per invoice) or "Kế toán" (one row per tax rate) report. Used by the job
+queue, so the report can be built without a browser session.
+"""
+import re
+
+import pandas as pd
+
+from extract_invoices import classify_content
+
+AUTO_CATEGORY = "Tự động nhận diện"
+CUSTOM_CATEGORY = "Khác (Nhập tay)"
+
+REPORT_COLUMNS = {
+    "Kinh doanh": [
+        "Team", "Tên nhân viên", "Tên file", "Ngày hóa đơn", "Số hóa đơn",
+        "Đơn vị bán", "Phân loại", "Số tiền trước Thuế",
+        "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác",
+        "Tiền thuế", "Số tiền sau", "Link lấy hóa đơn",
+        "Mã tra cứu", "Mã số thuế", "Mã CQT", "Ký hiệu"
+    ],
+    "Kế toán": [
+        "Team", "Số hóa đơn", "Ngày hóa đơn", "Mã số thuế bên bán",
+        "Số ký hiệu", "Mã tra cứu", "Link tra cứu", "Phân loại",
+        "Số tiền trước VAT", "VAT", "Thuế suất", "Tổng tiền sau thuế",
+        "Tên nhân viên", "Tên file"
+    ],
+}
+
+MONEY_COLUMNS = {
+    "Kinh doanh": ["Số tiền trước Thuế", "Thuế 0%", "Thuế 5%", "Thuế 8%", "Thuế 10%", "Thuế khác", "Tiền thuế", "Số tiền sau"],
+    "Kế toán": ["Số tiền trước VAT", "VAT", "Tổng tiền sau thuế"],
+}
+
+
+def parse_money_str(s):
+    if not s or pd.isna(s):
+        return 0
+    s = str(s).strip()
+    # Robust decimal handling: check order of separators
+    if '.' in s and ',' in s:
+        if s.rfind(',') > s.rfind('.'):
+            s = s[:s.rfind(',')]  # Cut decimal part
+        else:
+            s = s[:s.rfind('.')]
+    elif re.search(r'[,.]\d{2}$', s) and not re.search(r'[,.]\d{3}$', s):
+        s = s[:-3]  # Remove 2-digit decimal suffix
+    s = s.replace(',', '').replace('.', '')
+    try:
+        return int(s)
+    except:
+        return 0
+
+
+def calc_amounts_for_rate(vat_amount, rate_str):
+    """Calculate before-VAT and total from VAT amount and rate"""
+    vat_val = parse_money_str(vat_amount)
+    rate_map = {"0%": 0, "5%": 0.05, "8%": 0.08, "10%": 0.10}
+    rate = rate_map.get(rate_str, 0)
+
+    if vat_val and rate > 0:
+        before_vat = int(round(vat_val / rate))
+        total = before_vat + vat_val
+        return before_vat, vat_val, total
+    elif vat_val:
+        return 0, vat_val, vat_val
+    return 0, 0, 0
+
+
+def invoice_category(data, line_items, category_select, custom_category=""):
+    """Category chosen in the UI, or detected from the invoice content."""
+    if category_select == CUSTOM_CATEGORY and custom_category.strip():
+        return custom_category.strip()
+    if category_select == AUTO_CATEGORY:
+        # First check if OCR already set a classification
+        if data.get("Phân loại") and data.get("Phân loại") != "Khác":
+            return data.get("Phân loại")
+        if line_items:
+            all_item_names = " ".join([item.get("name", "") for item in line_items])
+            return classify_content(all_item_names, data.get("Đơn vị bán", ""))
+        return classify_content("", data.get("Đơn vị bán", ""))
+    return category_select
+
+
+def invoice_rows(data, line_items, file_name, team, employee, category, report_type):
+    """Report row(s) for one invoice: one per invoice for "Kinh doanh", one per tax rate for "Kế toán"."""
+    # Determine tax rate(s)
+    tax_rates = []
+    for rate in ["0%", "5%", "8%", "10%"]:
+        col_name = f"Thuế {rate}"
+        if data.get(col_name) and data.get(col_name) != "":
+            tax_rates.append(rate)
+
+    if data.get("Thuế khác"):
+        tax_rates.append("Khác")
+
+    if not tax_rates:
+        tax_rates = ["N/A"]
+
+    if report_type == "Kinh doanh":
+        # === BUSINESS FORMAT LOGIC (Wide) ===
+        return [{
+            "Team": team,
+            "Tên nhân viên": employee,
+            "Tên file": file_name,
+            "Ngày hóa đơn": data.get("Ngày hóa đơn", ""),
+            "Số hóa đơn": data.get("Số hóa đơn", ""),
+            "Đơn vị bán": data.get("Đơn vị bán", ""),
+            "Phân loại": category,
+            "Số tiền trước Thuế": data.get("Số tiền trước Thuế", ""),
+            "Thuế 0%": data.get("Thuế 0%", ""),
+            "Thuế 5%": data.get("Thuế 5%", ""),
+            "Thuế 8%": data.get("Thuế 8%", ""),
+            "Thuế 10%": data.get("Thuế 10%", ""),
+            "Thuế khác": data.get("Thuế khác", ""),
+            "Tiền thuế": data.get("Tiền thuế", ""),
+            "Số tiền sau": data.get("Số tiền sau", ""),
+            "Link lấy hóa đơn": data.get("Link lấy hóa đơn", "") or data.get("Mã tra cứu", ""),
+            "Mã tra cứu": data.get("Mã tra cứu", ""),
+            "Mã số thuế": data.get("Mã số thuế", ""),
+            "Mã CQT": data.get("Mã CQT", ""),
+            "Ký hiệu": data.get("Ký hiệu", "")
+        }]
+
+    # === ACCOUNTING FORMAT LOGIC (Long) ===
+    base_row = {
+        "Team": team,
+        "Số hóa đơn": data.get("Số hóa đơn", ""),
+        "Ngày hóa đơn": data.get("Ngày hóa đơn", ""),
+        "Mã số thuế bên bán": data.get("Mã số thuế", ""),
+        "Số ký hiệu": data.get("Ký hiệu", ""),
+        "Mã tra cứu": data.get("Mã tra cứu", ""),
+        "Link tra cứu": data.get("Link lấy hóa đơn", "") or data.get("Mã tra cứu", ""),
+        "Phân loại": category,
+        "Số tiền trước VAT": data.get("Số tiền trước Thuế", ""),
+        "Tổng tiền sau thuế": data.get("Số tiền sau", ""),
+        "Tên nhân viên": employee,
+        "Tên file": file_name
+    }
+
+    if len(tax_rates) == 1:
+        # Single rate - simple case
+        rate = tax_rates[0]
+        if rate == "N/A":
+            base_row["VAT"] = data.get("Tiền thuế", "")
+            base_row["Thuế suất"] = ""
+            # Keep original totals for N/A
+        else:
+            vat_str = data.get(f"Thuế {rate}", data.get("Tiền thuế", ""))
+            base_row["VAT"] = vat_str
+            base_row["Thuế suất"] = rate
+            # ONLY calculate if extracted values are MISSING
+            # DO NOT overwrite already-extracted values!
+            if not base_row.get("Số tiền trước VAT") or not str(base_row.get("Số tiền trước VAT")).strip():
+                before_vat, vat_val, total = calc_amounts_for_rate(vat_str, rate)
+                if before_vat:
+                    base_row["Số tiền trước VAT"] = before_vat
+                if total:
+                    base_row["Tổng tiền sau thuế"] = total
+        return [base_row]
+
+    # Multiple rates - create multiple rows with calculated amounts
+    rows = []
+    for rate in tax_rates:
+        row = base_row.copy()
+        if rate == "Khác":
+            row["VAT"] = data.get("Thuế khác", "")
+            row["Thuế suất"] = "Khác"
+        else:
+            vat_str = data.get(f"Thuế {rate}", "")
+            before_vat, vat_val, total = calc_amounts_for_rate(vat_str, rate)
+            row["VAT"] = vat_val if vat_val else vat_str
+            row["Thuế suất"] = rate
+            if before_vat:
+                row["Số tiền trước VAT"] = before_vat
+            if total:
+                row["Tổng tiền sau thuế"] = total
+        rows.append(row)
+    return rows
+
+
+def convert_to_number(x):
+    if pd.isna(x) or x == '': return None
+    x_str = str(x).strip()
+    if re.search(r',\d{2}$', x_str):
+        x_str = x_str.replace('.', '').replace(',', '.')
+    else:
+        x_str = x_str.replace('.', '').replace(',', '')
+    try:
+        return round(float(x_str))
+    except:
+        return x
+
+
+def build_report_df(rows, report_type):
+    """DataFrame with the report's columns in order and money columns converted to numbers."""
+    columns = REPORT_COLUMNS[report_type]
+    df = pd.DataFrame(rows)
+    for col in columns:
+        if col not in df.columns:
+            df[col] = ""
+    df = df[columns]
+
+    for col in MONEY_COLUMNS[report_type]:
+        if col in df.columns:
+            df[col] = df[col].apply(convert_to_number)
+    return df
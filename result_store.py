@@ -0,0 +1,289 @@
+"""
+Persistent storage for invoice extraction results.
+
+ResultCache keeps extract_invoice_data() results on disk, keyed by the SHA-256 of
+the PDF bytes plus EXTRACTOR_VERSION and the PDF text backend / item engine, so re-uploaded invoices are answered
+instantly instead of going through pdfplumber/regex/OCR again.
+
+Manifest remembers what a folder run extracted from each file (size, mtime,
+hash, extractor version -> result), so the next run of main() only extracts
+new, changed or version-stale files. Every result is also appended to a journal
+as soon as it is recorded, so a run killed halfway (crash, OOM, container
+restart) resumes from the files it had already finished.
+"""
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from extract_invoices import EXTRACTOR_VERSION, ITEM_ENGINE, PDF_TEXT_BACKEND
+
+# Cache location and size limit (override with environment variables)
+DEFAULT_CACHE_DIR = os.environ.get(
+    "HOADON_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "results")
+)
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get("HOADON_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# Results depend on the PDF text backend and the line item engine; the default "text"
+# engine keeps the plain backend name so existing cache entries and manifests stay valid
+EXTRACTION_BACKEND = PDF_TEXT_BACKEND if ITEM_ENGINE == "text" else f"{PDF_TEXT_BACKEND}-{ITEM_ENGINE}"
+
+
+def content_hash(payload):
+    """SHA-256 hex digest of PDF bytes, or of a file's content if payload is a path."""
+    h = hashlib.sha256()
+    if isinstance(payload, str):
+        with open(payload, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+    else:
+        h.update(payload)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk (data, line_items) cache with LRU eviction by total size.
+    Entries are JSON files; a hit refreshes the file's mtime, and when the cache
+    grows past max_bytes the least recently used entries are deleted.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES, version=EXTRACTOR_VERSION,
+                 backend=EXTRACTION_BACKEND):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, sha):
+        # Shard by the first two hex chars to keep directories small
+        return os.path.join(self.directory, sha[:2], f"{sha}-v{self.version}-{self.backend}.json")
+
+    def _entries(self):
+        """Yield (path, mtime, size) for every cache file."""
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, st.st_mtime, st.st_size
+
+    def get(self, sha):
+        """Return the cached (data, line_items) for a content hash, or None."""
+        path = self._path(sha)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry["data"], entry["line_items"]
+
+    def put(self, sha, data, line_items):
+        """Store a result; evicts least recently used entries if over the size limit."""
+        path = self._path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        body = json.dumps({"data": data, "line_items": line_items}, ensure_ascii=False).encode('utf-8')
+        # Write to a temp file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"  [CACHE] Could not store result: {e}")
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        with self._lock:
+            self._total_bytes += len(body) - old_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete oldest entries until the cache is at 90% of max_bytes. Caller holds the lock."""
+        target = int(self.max_bytes * 0.9)
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._total_bytes}
+
+
+class Manifest:
+    """
+    Record of the files of one input folder and their extraction results, kept in
+    a JSON file: relative path -> size, mtime, SHA-256, extractor version, PDF text
+    backend (with the item engine), data and line_items.
+
+    get() answers from the manifest when the file is unchanged: same size and
+    mtime, or (after a copy/touch) a new mtime but the same content hash. Files
+    extracted by another EXTRACTOR_VERSION or backend count as changed.
+
+    put() appends the entry to a journal (one JSON line per file, next to the
+    manifest) right away; save() writes the full manifest and deletes the
+    journal. A journal left behind by an interrupted run is replayed on load,
+    and the files it holds are listed in `resumed`.
+    """
+
+    def __init__(self, path, root, version=EXTRACTOR_VERSION, backend=EXTRACTION_BACKEND):
+        self.path = path
+        self.root = root
+        self.version = version
+        self.backend = backend
+        self.journal_path = os.path.splitext(path)[0] + ".journal.jsonl"
+        self.resumed = set()
+        self._files = {}
+        self._dirty = False
+        self._journal = None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self._files = json.load(f).get("files", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"  [MANIFEST] Could not read {path}, starting over: {e}")
+        self._replay_journal()
+
+    def _replay_journal(self):
+        """Apply the entries journaled by a run that did not get to save()."""
+        try:
+            with open(self.journal_path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"  [MANIFEST] Could not read journal {self.journal_path}: {e}")
+            return
+        complete = raw[:raw.rfind(b"\n") + 1]
+        if len(complete) < len(raw):
+            # Last line cut short by the crash: drop it, so this run's first append
+            # starts a line of its own instead of being glued onto the fragment
+            try:
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(len(complete))
+            except OSError as e:
+                print(f"  [MANIFEST] Could not truncate journal {self.journal_path}: {e}")
+        for line in complete.decode('utf-8', errors='replace').splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self._files[record["key"]] = record["entry"]
+            self.resumed.add(record["key"])
+        self._dirty = True  # save() folds the journal into the manifest and removes it
+
+    def is_resumed(self, file_path):
+        """Whether the file was finished by an interrupted run (its result came from the journal)."""
+        return self._key(file_path) in self.resumed
+
+    def _key(self, file_path):
+        return os.path.relpath(file_path, self.root).replace(os.sep, '/')
+
+    def get(self, file_path):
+        """The stored (data, line_items) of an unchanged file, or None if it must be extracted."""
+        entry = self._files.get(self._key(file_path))
+        if entry is None or entry["version"] != self.version or entry["backend"] != self.backend:
+            return None
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime_ns) != (entry["size"], entry["mtime_ns"]):
+            if st.st_size != entry["size"] or content_hash(file_path) != entry["sha256"]:
+                return None
+            entry["mtime_ns"] = st.st_mtime_ns  # Touched or copied, same content
+            self._dirty = True
+        return copy.deepcopy(entry["data"]), copy.deepcopy(entry["line_items"])
+
+    def put(self, file_path, data, line_items, sha256=None):
+        """
+        Record the result of a freshly extracted file and append it to the journal.
+        :param sha256: Content hash already computed for the file (default: hash it now)
+        A file that cannot be read anymore (moved or deleted mid-run) is not recorded.
+        """
+        try:
+            st = os.stat(file_path)
+            sha256 = sha256 or content_hash(file_path)
+        except OSError as e:
+            print(f"  [MANIFEST] Not recording {file_path}: {e}")
+            return
+        key = self._key(file_path)
+        entry = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": sha256,
+            "version": self.version,
+            "backend": self.backend,
+            "data": copy.deepcopy(data),
+            "line_items": copy.deepcopy(line_items),
+        }
+        self._files[key] = entry
+        self._dirty = True
+        try:
+            if self._journal is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal.write(json.dumps({"key": key, "entry": entry}, ensure_ascii=False) + "\n")
+            self._journal.flush()  # In the OS before the next file starts: survives a killed process
+        except OSError as e:
+            print(f"  [MANIFEST] Could not append to journal: {e}")
+
+    def prune(self, file_paths):
+        """Forget files that are no longer in the folder; returns how many were dropped."""
+        keep = {self._key(p) for p in file_paths}
+        gone = [key for key in self._files if key not in keep]
+        for key in gone:
+            del self._files[key]
+        self._dirty = self._dirty or bool(gone)
+        return len(gone)
+
+    def save(self):
+        """Write the manifest if anything changed (temp file + rename, never half-written)."""
+        if not self._dirty:
+            return
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"files": self._files}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._dirty = False
+        # Everything journaled is in the manifest now
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+        self.resumed = set()
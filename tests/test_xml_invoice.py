@@ -0,0 +1,93 @@
+"""Field and line item mapping of xml_invoice.py on a checked-in sample e-invoice XML."""
+import os
+
+import pytest
+
+from extract_invoices import _empty_invoice_data
+from xml_invoice import is_invoice_xml, pair_invoice_sources, parse_invoice_xml
+
+SAMPLE = os.path.join(os.path.dirname(__file__), "data", "hoadon_tdiep.xml")
+
+
+@pytest.fixture(scope="module")
+def sample_bytes():
+    with open(SAMPLE, 'rb') as f:
+        return f.read()
+
+
+def test_fields_inside_tdiep_wrapper():
+    data, _ = parse_invoice_xml(SAMPLE)
+    # Same keys as the PDF path, and the message-level TTChung of TDiep is not read as the invoice's
+    assert data.keys() == _empty_invoice_data("x").keys()
+    assert data["Tên file"] == "hoadon_tdiep.xml"
+    assert data["Ký hiệu"] == "1C25TAA"
+    assert data["Số hóa đơn"] == "00000123"
+    assert data["Ngày hóa đơn"] == "15/03/2025"
+    assert data["Đơn vị bán"] == "CÔNG TY TNHH KHÁCH SẠN BIỂN XANH"
+    assert data["Mã số thuế"] == "0312345678"
+    assert data["Mã CQT"] == "00A1B2C3D4E5F60718293A4B5C6D7E8F90"
+    assert data["Mã tra cứu"] == "AB12CD34EF"
+    assert data["Link lấy hóa đơn"] == "https://tracuu.example.vn"
+
+
+def test_totals_and_tax_per_rate():
+    data, _ = parse_invoice_xml(SAMPLE)
+    assert data["Số tiền trước Thuế"] == "3.550.000"
+    assert data["Tiền thuế"] == "326.000"
+    assert data["Số tiền sau"] == "3.876.000"
+    assert data["Thuế 10%"] == "290.000"
+    assert data["Thuế 8%"] == "36.000"
+    # KCT (not taxed) has no tax column
+    assert data["Thuế 0%"] == data["Thuế 5%"] == data["Thuế khác"] == ""
+
+
+def test_line_items():
+    _, items = parse_invoice_xml(SAMPLE)
+    assert items == [
+        {"name": "Phòng Deluxe", "qty": "2", "unit_price": "1,500,000", "amount": "3,000,000", "tax_rate": "10"},
+        {"name": "Ăn sáng", "qty": "3", "unit_price": "150,000", "amount": "450,000", "tax_rate": "8"},
+        # TChat 3: trade discount, negative amount
+        {"name": "Chiết khấu thương mại", "qty": "", "unit_price": "", "amount": "-100,000", "tax_rate": "10"},
+        # KCT: no tax rate
+        {"name": "Phí đưa đón sân bay", "qty": "1", "unit_price": "200,000", "amount": "200,000", "tax_rate": None},
+        # TChat 4 (note) is left out
+    ]
+
+
+def test_lookup_fields_only_from_ttchung(sample_bytes):
+    # Seller and buyer TTKhac entries are not the invoice's lookup code or link
+    general = sample_bytes.index(b"<TTKhac>"), sample_bytes.index(b"</TTKhac>") + len(b"</TTKhac>")
+    xml = sample_bytes[:general[0]] + sample_bytes[general[1]:]
+    xml = xml.replace(b"</NBan>", "<TTKhac><TTin><TTruong>Website</TTruong><KDLieu>string</KDLieu>"
+                      "<DLieu>https://www.khachsanbienxanh.vn</DLieu></TTin></TTKhac></NBan>".encode())
+    xml = xml.replace(b"</NMua>", "<TTKhac><TTin><TTruong>Mã tra cứu</TTruong><KDLieu>string</KDLieu>"
+                      "<DLieu>KH0001</DLieu></TTin></TTKhac></NMua>".encode())
+    data, items = parse_invoice_xml(xml, "no_lookup.xml")
+    assert data["Link lấy hóa đơn"] == ""
+    assert data["Mã tra cứu"] == ""
+    assert len(items) == 4
+
+
+def test_bytes_input(sample_bytes):
+    assert parse_invoice_xml(sample_bytes, "upload.xml") == parse_invoice_xml(SAMPLE, "upload.xml")
+
+
+def test_not_an_invoice():
+    assert not is_invoice_xml(b"<?xml version='1.0'?><config><item/></config>")
+    with pytest.raises(ValueError):
+        parse_invoice_xml(b"<?xml version='1.0'?><TDiep><DLieu/></TDiep>", "empty.xml")
+
+
+def test_pair_invoice_sources(sample_bytes):
+    sources = [
+        ("a.pdf", b"%PDF-1.4"),
+        ("A.xml", sample_bytes),          # e-invoice of a.pdf: replaces its payload
+        ("b.xml", sample_bytes),          # e-invoice without a PDF: kept
+        ("c.pdf", b"%PDF-1.4"),           # PDF without an XML: kept
+        ("config.xml", b"<config/>"),     # not an e-invoice: dropped
+    ]
+    assert pair_invoice_sources(sources) == [
+        ("a.pdf", sample_bytes),
+        ("b.xml", sample_bytes),
+        ("c.pdf", b"%PDF-1.4"),
+    ]
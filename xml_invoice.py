@@ -0,0 +1,268 @@
+"""
+Official e-invoice XML (Circular 78/2021, Decree 123) as an input format.
+
+MISA, VNPT, Viettel, BKAV, M-Invoice... send the signed XML next to the PDF.
+parse_invoice_xml() reads it with a streaming parser and fills the same data
+dict and line items as extract_invoice_data() does from the PDF text, without
+regexes or OCR. pair_invoice_sources() replaces a PDF by its XML when both are
+given, so the PDF is only parsed when no XML exists.
+
+XML layout (namespaces ignored, a TDiep message wrapper is allowed):
+    HDon/DLHDon/TTChung       KHMSHDon, KHHDon, SHDon, NLap, TTKhac
+    HDon/DLHDon/NDHDon/NBan   Ten, MST (seller)
+    HDon/DLHDon/NDHDon/DSHHDVu/HHDVu   TChat, THHDVu, SLuong, DGia, ThTien, TSuat
+    HDon/DLHDon/NDHDon/TToan  THTTLTSuat/LTSuat (TSuat, ThTien, TThue), TgTCThue, TgTThue, TgTTTBSo, DSLPhi
+    HDon/MCCQT                tax authority code
+"""
+import io
+import os
+import re
+import unicodedata
+import xml.etree.ElementTree as ET
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from extract_invoices import _empty_invoice_data, _format_amount
+
+# Line item kinds (TChat): 1 goods/service, 2 promotion, 3 trade discount, 4 note (no amounts)
+ITEM_NOTE = "4"
+ITEM_DISCOUNT = "3"
+
+# TTKhac/TTin field names (accents and spaces removed, lowercase) that carry the lookup code or link
+LOOKUP_CODE_FIELDS = ("matracuu", "tracuu", "masobimat", "mabimat", "mabaomat", "secret", "searchkey",
+                      "keysearch", "lookupcode", "fkey")
+LOOKUP_LINK_FIELDS = ("link", "url", "website", "trangtracuu", "diachitracuu", "portal")
+
+# Root elements of an e-invoice XML, looked for in the first bytes of a file
+INVOICE_ROOT_RE = re.compile(rb'<(?:[\w.-]+:)?(?:HDon|TDiep)[\s>/]')
+SNIFF_BYTES = 4096
+
+
+def is_invoice_xml(source):
+    """Whether a path or bytes-like source is an e-invoice XML (HDon or TDiep root), judged from its first bytes."""
+    if isinstance(source, str):
+        try:
+            with open(source, 'rb') as f:
+                head = f.read(SNIFF_BYTES)
+        except OSError:
+            return False
+    else:
+        head = bytes(source[:SNIFF_BYTES])
+    head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    return head.startswith(b'<') and bool(INVOICE_ROOT_RE.search(head))
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def _children(elem):
+    """{local tag: stripped text} of an element's direct children."""
+    return {_local(child.tag): (child.text or "").strip() for child in elem}
+
+
+def _number(text):
+    """XML decimal ("6615000", "1500000.00", "-20000") -> Decimal, None if empty or invalid."""
+    try:
+        return Decimal(text.strip().replace(',', '.')) if text and text.strip() else None
+    except InvalidOperation:
+        return None
+
+
+def _amount(text):
+    """XML decimal -> amount rounded to whole VND (int), None if empty or invalid."""
+    value = _number(text)
+    return int(value.to_integral_value(ROUND_HALF_UP)) if value is not None else None
+
+
+def _money(text):
+    """XML decimal -> "1.234.567" like the PDF path, "" if empty."""
+    value = _amount(text)
+    return _format_amount(value) if value is not None else ""
+
+
+def _item_number(text, sign=1):
+    """Line item number in the PDF path's format ("1,800,000"); fractional quantities keep their decimals."""
+    value = _number(text)
+    if value is None:
+        return ""
+    value *= sign
+    if value == value.to_integral_value():
+        return f"{int(value):,}"
+    return format(value.normalize(), 'f')
+
+
+def _field_key(name):
+    """TTin field name without accents, spaces or punctuation: "Mã tra cứu" -> "matracuu"."""
+    name = unicodedata.normalize('NFD', name.lower().replace('đ', 'd'))
+    return re.sub(r'[^a-z0-9]', '', ''.join(c for c in name if not unicodedata.combining(c)))
+
+
+def _rate_key(rate):
+    """TSuat -> "0"/"5"/"8"/"10", "khác" for any other rate, None when not taxed (KCT, KKKNT)."""
+    rate = (rate or "").strip().upper().replace(' ', '')
+    if rate in ("KCT", "KKKNT", ""):
+        return None
+    number = rate.rstrip('%')
+    if number in ("0", "5", "8", "10"):
+        return number
+    return "khác"
+
+
+def _apply_other_info(data, name, value):
+    """Fill the lookup code / link from a TTKhac entry; the first match wins."""
+    key = _field_key(name)
+    if not key or not value:
+        return
+    is_url = value.lower().startswith(("http://", "https://", "www."))
+    if is_url or any(field in key for field in LOOKUP_LINK_FIELDS):
+        if is_url and not data["Link lấy hóa đơn"]:
+            data["Link lấy hóa đơn"] = value
+    elif any(field in key for field in LOOKUP_CODE_FIELDS) and not data["Mã tra cứu"]:
+        data["Mã tra cứu"] = value
+
+
+def parse_invoice_xml(source, filename=None):
+    """
+    Invoice fields and line items of an e-invoice XML, in the format of extract_invoice_data().
+    :param source: File path (str) or the XML bytes
+    :param filename: Name reported in "Tên file" (default: the path's basename)
+    Raises ValueError if the document has no HDon element, ET.ParseError if it is not well-formed.
+    """
+    if isinstance(source, str):
+        filename = filename or os.path.basename(source)
+        stream = open(source, 'rb')
+    else:
+        stream = io.BytesIO(source)
+    data = _empty_invoice_data(filename or "Unknown.xml")
+
+    general, seller, totals = {}, {}, {}
+    items, rate_groups, fees, other_info = [], [], [], []
+    mccqt = ""
+    found = False
+    path = []
+    with stream:
+        for event, elem in ET.iterparse(stream, events=("start", "end")):
+            tag = _local(elem.tag)
+            if event == "start":
+                path.append(tag)
+                continue
+            path.pop()
+            if "HDon" not in path:
+                if tag == "HDon":
+                    found = True
+                    break  # One invoice per file; skip the rest of a TDiep message
+                continue
+            parent = path[-1]
+            if parent == "TTChung":
+                general[tag] = (elem.text or "").strip()
+            elif parent == "NBan":
+                seller[tag] = (elem.text or "").strip()
+            elif parent == "TToan":
+                totals[tag] = (elem.text or "").strip()
+            elif parent == "HDon" and tag == "MCCQT":
+                mccqt = (elem.text or "").strip()
+
+            # Repeated groups are read as a whole and dropped, so memory stays flat
+            if tag == "HHDVu":
+                items.append(_children(elem))
+                elem.clear()
+            elif tag == "LTSuat":
+                rate_groups.append(_children(elem))
+                elem.clear()
+            elif tag == "LPhi":
+                fees.append(_children(elem))
+                elem.clear()
+            elif tag == "TTin":
+                # Lookup code and link are in TTChung/TTKhac; the TTKhac of the seller,
+                # buyer and items carry other data (a seller's website is not the link)
+                if path[-2:] == ["TTChung", "TTKhac"]:
+                    info = _children(elem)
+                    other_info.append((info.get("TTruong", ""), info.get("DLieu", "")))
+                elem.clear()
+            elif tag in ("DSCKS", "Signature"):
+                elem.clear()
+    if not found:
+        raise ValueError("not an e-invoice XML (no HDon element)")
+
+    # General info
+    data["Ký hiệu"] = general.get("KHMSHDon", "") + general.get("KHHDon", "")
+    number = general.get("SHDon", "")
+    data["Số hóa đơn"] = number.zfill(8) if number.isdigit() else number
+    date = re.match(r'(\d{4})-(\d{2})-(\d{2})', general.get("NLap", ""))
+    if date:
+        data["Ngày hóa đơn"] = f"{date.group(3)}/{date.group(2)}/{date.group(1)}"
+    data["Đơn vị bán"] = seller.get("Ten", "")
+    data["Mã số thuế"] = seller.get("MST", "")
+    data["Mã CQT"] = mccqt
+    for name, value in other_info:
+        _apply_other_info(data, name, value)
+
+    # Line items
+    line_items = []
+    for item in items:
+        kind = item.get("TChat", "1")
+        if kind == ITEM_NOTE or not item.get("THHDVu"):
+            continue
+        sign = -1 if kind == ITEM_DISCOUNT else 1
+        rate = _rate_key(item.get("TSuat"))
+        line_items.append({
+            "name": item["THHDVu"],
+            "qty": _item_number(item.get("SLuong")),
+            "unit_price": _item_number(item.get("DGia")),
+            "amount": _item_number(item.get("ThTien"), sign),
+            "tax_rate": rate if rate != "khác" else None,
+        })
+
+    # Tax per rate: the summary table, or the invoice total when every item has the same rate
+    taxes = {}
+    for group in rate_groups:
+        rate = _rate_key(group.get("TSuat"))
+        tax = _amount(group.get("TThue")) or 0
+        if rate is not None and (tax or _amount(group.get("ThTien"))):
+            taxes[rate] = taxes.get(rate, 0) + tax
+    if not rate_groups:
+        item_rates = {_rate_key(item.get("TSuat")) for item in items if item.get("TChat", "1") != ITEM_NOTE}
+        if len(item_rates) == 1 and None not in item_rates:
+            taxes[item_rates.pop()] = _amount(totals.get("TgTThue")) or 0
+    for rate, tax in taxes.items():
+        data["Thuế khác" if rate == "khác" else f"Thuế {rate}%"] = _format_amount(tax)
+
+    # Totals
+    data["Số tiền trước Thuế"] = _money(totals.get("TgTCThue"))
+    data["Tiền thuế"] = _money(totals.get("TgTThue"))
+    data["Số tiền sau"] = _money(totals.get("TgTTTBSo"))
+    for fee in fees:
+        if "phục vụ" in fee.get("TLPhi", "").lower() or re.search(r'\bPV\b', fee.get("TLPhi", "")):
+            data["Phí PV"] = _money(fee.get("TPhi"))
+            break
+    return data, line_items
+
+
+def pair_invoice_sources(sources):
+    """
+    Use the XML of an invoice instead of its PDF when both are given.
+    :param sources: [(name, payload)] with payload a file path or bytes
+    Returns [(name, payload)] in input order: a PDF with an e-invoice XML of the
+    same name (same folder for paths) becomes (PDF name, XML payload), an XML
+    without PDF is kept, XML files that are not e-invoices are dropped.
+    """
+    def stem(name, payload):
+        return os.path.splitext(payload if isinstance(payload, str) else name)[0].lower()
+
+    xml_by_stem = {}
+    pdf_stems = set()
+    for name, payload in sources:
+        if name.lower().endswith('.xml'):
+            if is_invoice_xml(payload):
+                xml_by_stem.setdefault(stem(name, payload), payload)
+        else:
+            pdf_stems.add(stem(name, payload))
+
+    paired = []
+    for name, payload in sources:
+        key = stem(name, payload)
+        if not name.lower().endswith('.xml'):
+            paired.append((name, xml_by_stem.get(key, payload)))
+        elif key not in pdf_stems and xml_by_stem.get(key) is payload:
+            paired.append((name, payload))
+    return paired